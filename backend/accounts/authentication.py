@@ -0,0 +1,70 @@
+"""
+API の認証 (JWT) でデータベースを読まないための仕組み
+
+- StatelessJWTAuthentication: ユーザーを読み込まず、トークンの内容から TokenUser を作る
+- ブラックリストの確認は、有効期限内のブラックリストの jti をプロセスのメモリに
+  JWT_BLACKLIST_CACHE_SECONDS 秒だけ保持して行う
+  (同じプロセスでブラックリストに入れたときはすぐに反映し、他のプロセスには最大でその秒数だけ遅れて反映する)
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from app.metrics import cache_result
+from .tokens import REFRESH_JTI_CLAIM
+
+
+class BlacklistCache:
+    """ 有効期限内のブラックリストの jti を、一定時間だけメモリに保持する """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jtis = frozenset()
+        self._expires = 0
+
+    def _load(self):
+        return frozenset(
+            BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+            .values_list('token__jti', flat=True)
+        )
+
+    def contains(self, *jtis):
+        jtis = [jti for jti in jtis if jti]
+        ttl = settings.JWT_BLACKLIST_CACHE_SECONDS
+        if not ttl:
+            # キャッシュしない設定なら、毎回データベースに問い合わせる
+            return BlacklistedToken.objects.filter(token__jti__in=jtis).exists()
+        hit = time.monotonic() < self._expires
+        if not hit:
+            with self._lock:
+                if time.monotonic() >= self._expires:
+                    self._jtis = self._load()
+                    self._expires = time.monotonic() + ttl
+        cache_result('jwt_blacklist', hit)
+        return not self._jtis.isdisjoint(jtis)
+
+    def invalidate(self):
+        self._expires = 0
+
+
+blacklist_cache = BlacklistCache()
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    データベースを読まずに認証する JWT の認証クラス
+    トークン自身の jti と発行元のリフレッシュトークンの jti が、ブラックリストに入っていないかを確認する
+    ユーザーの無効化やパスワードの変更は、アクセストークンの有効期限が切れるまで反映されない
+    """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if blacklist_cache.contains(token.get(api_settings.JTI_CLAIM), token.get(REFRESH_JTI_CLAIM)):
+            raise InvalidToken({'detail': 'Token is blacklisted', 'code': 'token_not_valid'})
+        return token
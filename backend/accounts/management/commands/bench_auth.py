@@ -0,0 +1,84 @@
+import json
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from accounts.authentication import StatelessJWTAuthentication, blacklist_cache
+from accounts.tokens import RefreshToken
+
+# 比較する認証の方法 (認証クラス, ブラックリストをメモリに保持する秒数)
+VARIANTS = {
+    'database_user': (JWTAuthentication, 0),
+    'stateless_uncached_blacklist': (StatelessJWTAuthentication, 0),
+    'stateless_cached_blacklist': (StatelessJWTAuthentication, 30),
+}
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'mean_us': round(statistics.mean(samples) * 1e6, 1),
+        'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+        'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'API のリクエスト 1 件あたりの JWT の認証にかかる時間とクエリ数を、認証の方法ごとに比較する '
+        '(ユーザーとトークンはトランザクション内で作り、最後にロールバックする)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--blacklisted', type=int, default=10000, help='ブラックリストに入れておくトークンの件数')
+
+    def seed_blacklist(self, user, count):
+        expires_at = timezone.now() + timedelta(days=7)
+        outstanding = OutstandingToken.objects.bulk_create(
+            [
+                OutstandingToken(user=user, jti='bench-%d' % n, token='', expires_at=expires_at)
+                for n in range(count)
+            ],
+            batch_size=1000,
+        )
+        BlacklistedToken.objects.bulk_create(
+            [BlacklistedToken(token=token) for token in outstanding], batch_size=1000
+        )
+
+    def measure(self, authentication, request, iterations):
+        authentication.authenticate(request)
+        samples = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(iterations):
+                started = time.perf_counter()
+                authentication.authenticate(request)
+                samples.append(time.perf_counter() - started)
+        return dict(_summary(samples), queries_per_request=round(len(queries) / iterations, 2))
+
+    def handle(self, *args, **options):
+        report = {'requests': options['requests'], 'blacklisted_tokens': options['blacklisted']}
+        with transaction.atomic():
+            user = get_user_model().objects.create(username='bench-auth-user')
+            self.seed_blacklist(user, options['blacklisted'])
+            access = RefreshToken.for_user(user).access_token
+            request = APIRequestFactory().get(
+                '/api/articles/', HTTP_AUTHORIZATION='Bearer %s' % access
+            )
+            for name, (authentication_class, ttl) in VARIANTS.items():
+                with override_settings(JWT_BLACKLIST_CACHE_SECONDS=ttl):
+                    blacklist_cache.invalidate()
+                    report[name] = self.measure(authentication_class(), request, options['requests'])
+            transaction.set_rollback(True)
+        blacklist_cache.invalidate()
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+
+def purge_expired_tokens(batch_size=1000, now=None, pause=0):
+    """
+    有効期限が切れた発行済みトークンと、そのブラックリストの行を batch_size 件ずつ削除する
+    一度に大量の行を削除してテーブルを長くロックしないように、バッチごとにトランザクションを分ける
+    削除した (発行済みトークン, ブラックリスト) の件数を返す
+    """
+    now = now or timezone.now()
+    expired = OutstandingToken.objects.filter(expires_at__lte=now).order_by('pk')
+    outstanding = blacklisted = 0
+    while True:
+        ids = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            # 先にブラックリストの行を消しておき、OutstandingToken の削除でカスケードの対象を集めずに済ませる
+            blacklisted += BlacklistedToken.objects.filter(token_id__in=ids).delete()[0]
+            outstanding += OutstandingToken.objects.filter(pk__in=ids).delete()[0]
+        if pause:
+            time.sleep(pause)
+    return outstanding, blacklisted
+
+
+class Command(BaseCommand):
+    help = (
+        '有効期限が切れた JWT の発行済みトークンとブラックリストを、一定の件数ずつ削除する '
+        '(cron などで定期的に実行する)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='1 回のトランザクションで削除する件数')
+        parser.add_argument('--pause', type=float, default=0, help='バッチの間に待つ秒数')
+
+    def handle(self, *args, **options):
+        outstanding, blacklisted = purge_expired_tokens(options['batch_size'], pause=options['pause'])
+        self.stdout.write(
+            'deleted %d outstanding tokens and %d blacklisted tokens' % (outstanding, blacklisted)
+        )
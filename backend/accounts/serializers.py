@@ -0,0 +1,19 @@
+from rest_framework_simplejwt import serializers
+
+from .tokens import RefreshToken
+
+
+class TokenObtainPairSerializer(serializers.TokenObtainPairSerializer):
+    token_class = RefreshToken
+
+
+class TokenRefreshSerializer(serializers.TokenRefreshSerializer):
+    token_class = RefreshToken
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        if 'refresh' in data:
+            # ローテーションした場合は、新しいリフレッシュトークンから発行し直す
+            # (古いリフレッシュトークンがブラックリストに入っても、一緒に返したアクセストークンは使えるように)
+            data['access'] = str(self.token_class(data['refresh']).access_token)
+        return data
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from accounts.authentication import blacklist_cache
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def invalidate_blacklist_cache(sender, **kwargs):
+    # ブラックリストに追加されたら、このプロセスのキャッシュをすぐに読み直す
+    # (削除は有効期限が切れたものだけなので、キャッシュに残っていても問題ない。
+    #  post_delete を受け取らないことで、一括削除で 1 行ずつ読み込まずに済む)
+    blacklist_cache.invalidate()
@@ -1,3 +1,124 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.authentication import StatelessJWTAuthentication, blacklist_cache
+from accounts.management.commands.purge_expired_tokens import purge_expired_tokens
+from accounts.tokens import REFRESH_JTI_CLAIM, RefreshToken
+
+UserModel = get_user_model()
+
+
+@override_settings(JWT_BLACKLIST_CACHE_SECONDS=30)
+class StatelessJWTAuthenticationTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(username='test_user', password='top_secret_pass0001')
+        self.authentication = StatelessJWTAuthentication()
+        blacklist_cache.invalidate()
+
+    def _authenticate(self, access):
+        request = APIRequestFactory().get('/api/articles/', HTTP_AUTHORIZATION='Bearer %s' % access)
+        return self.authentication.authenticate(request)
+
+    # simplejwt のシリアライザは読み込んだときの設定を持ち続けるので、override_settings ではなく直接差し替える
+    @mock.patch.object(jwt_serializers.api_settings, 'UPDATE_LAST_LOGIN', False)
+    def test_obtain_should_not_update_last_login(self):
+        response = self.client.post(
+            '/api/token/', {'username': 'test_user', 'password': 'top_secret_pass0001'}
+        )
+        self.assertEqual(response.status_code, 200)
+        access = AccessToken(response.json()['access'])
+        self.assertEqual(access[REFRESH_JTI_CLAIM], RefreshToken(response.json()['refresh'])['jti'])
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_login)
+
+    def test_should_authenticate_without_query(self):
+        access = RefreshToken.for_user(self.user).access_token
+        self._authenticate(access)
+        # ブラックリストを読み込んだ後は、ユーザーもブラックリストもデータベースから読まない
+        with self.assertNumQueries(0):
+            user, _ = self._authenticate(access)
+        self.assertEqual(user.id, str(self.user.id))
+        self.assertTrue(user.is_authenticated)
+
+    def test_blacklisted_refresh_should_reject_access(self):
+        refresh = RefreshToken.for_user(self.user)
+        access = refresh.access_token
+        self._authenticate(access)
+        refresh.blacklist()
+        with self.assertRaises(InvalidToken):
+            self._authenticate(access)
+        # 他のリフレッシュトークンから発行したアクセストークンは使える
+        self._authenticate(RefreshToken.for_user(self.user).access_token)
+
+    @override_settings(JWT_BLACKLIST_CACHE_SECONDS=0)
+    def test_should_query_blacklist_without_cache(self):
+        access = RefreshToken.for_user(self.user).access_token
+        with self.assertNumQueries(1):
+            self._authenticate(access)
+
+    def test_rotated_access_should_survive_blacklisted_refresh(self):
+        refresh = RefreshToken.for_user(self.user)
+        response = self.client.post('/api/token/refresh', {'refresh': str(refresh)})
+        data = response.json()
+        self.assertEqual(AccessToken(data['access'])[REFRESH_JTI_CLAIM], RefreshToken(data['refresh'])['jti'])
+        refresh.blacklist()
+        self._authenticate(data['access'])
+
+
+class JWTAuthenticationDefaultTest(TestCase):
+    """ JWT_STATELESS_AUTH を有効にしていないとき (既定) の API の認証 """
+
+    def setUp(self):
+        self.user = UserModel.objects.create_user(username='test_user', password='top_secret_pass0001')
+
+    def test_stateless_auth_should_be_disabled_by_default(self):
+        self.assertFalse(settings.JWT_STATELESS_AUTH)
+
+    def test_obtain_should_update_last_login(self):
+        response = self.client.post(
+            '/api/token/', {'username': 'test_user', 'password': 'top_secret_pass0001'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+    def test_deactivated_user_should_be_rejected(self):
+        access = RefreshToken.for_user(self.user).access_token
+        authorization = 'Bearer %s' % access
+        self.assertEqual(self.client.get('/api/articles/', HTTP_AUTHORIZATION=authorization).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        # アクセストークンの有効期限内でも、無効にしたユーザーは認証しない
+        self.assertEqual(self.client.get('/api/articles/', HTTP_AUTHORIZATION=authorization).status_code, 401)
+
+
+class PurgeExpiredTokensTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(username='test_user')
+
+    def _token(self, jti, expires_in, blacklisted=False):
+        token = OutstandingToken.objects.create(
+            user=self.user, jti=jti, token='', expires_at=timezone.now() + expires_in
+        )
+        if blacklisted:
+            BlacklistedToken.objects.create(token=token)
+        return token
+
+    def test_should_delete_only_expired_tokens(self):
+        for n in range(5):
+            self._token('expired-%d' % n, timedelta(days=-1), blacklisted=n % 2 == 0)
+        self._token('valid', timedelta(days=1), blacklisted=True)
+
+        self.assertEqual(purge_expired_tokens(batch_size=2), (5, 3))
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), ['valid'])
+        self.assertEqual(BlacklistedToken.objects.count(), 1)
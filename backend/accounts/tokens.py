@@ -0,0 +1,18 @@
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken as BaseRefreshToken
+
+# アクセストークンに入れる、発行元のリフレッシュトークンの jti
+REFRESH_JTI_CLAIM = 'rjti'
+
+
+class RefreshToken(BaseRefreshToken):
+    """
+    アクセストークンに発行元のリフレッシュトークンの jti を入れるリフレッシュトークン
+    リフレッシュトークンをブラックリストに入れると、そこから発行したアクセストークンも使えなくなる
+    """
+
+    @property
+    def access_token(self):
+        access = super().access_token
+        access[REFRESH_JTI_CLAIM] = self[api_settings.JTI_CLAIM]
+        return access
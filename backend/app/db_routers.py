@@ -0,0 +1,106 @@
+"""
+プライマリとレプリカにクエリを振り分けるデータベースルーター
+
+- 書き込みは常にプライマリ (default) に送る
+- DATABASE_REPLICA_APPS のモデルの読み取りは DATABASE_REPLICAS のいずれかに送る
+- 書き込みをしたリクエストと、その後 DATABASE_REPLICA_STICKY_SECONDS の間の同じ利用者の読み取りは
+  プライマリに送る (レプリカの遅延で、編集した本人に古い内容が見えないようにする)
+"""
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# 読み取りだけのリクエストのメソッド
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+# このリクエスト (またはスレッド・タスク) の読み取りをプライマリに固定するかどうか
+_pinned = ContextVar('db_pinned_to_primary', default=False)
+
+
+def pin_to_primary():
+    """ 以降の読み取りをプライマリに送る """
+    _pinned.set(True)
+
+
+def is_pinned_to_primary():
+    return _pinned.get()
+
+
+class PrimaryReplicaRouter:
+    def _replicas(self):
+        return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+    def db_for_read(self, model, **hints):
+        replicas = self._replicas()
+        if not replicas or is_pinned_to_primary():
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label not in settings.DATABASE_REPLICA_APPS:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # 同じリクエストでこの後に読み取る内容は、書き込んだプライマリから読む
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製なので、どのデータベースから読んだオブジェクト同士でも関連付けられる
+        databases = {DEFAULT_DB_ALIAS, *self._replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカにはプライマリから複製されるので、マイグレーションはプライマリだけで行う
+        if db in self._replicas():
+            return False
+        return None
+
+
+class ReplicaStickinessMiddleware:
+    """
+    書き込みをした利用者の読み取りを、しばらくの間プライマリに固定するミドルウェア
+    書き込み系のリクエストが成功したら Cookie を付け、Cookie が有効な間はそのリクエストの読み取りを
+    プライマリに送る
+    ASGI で動かすときに非同期のビューの間にスレッドを挟まないよう、非同期のリクエストにも対応する
+    """
+    cookie_name = 'db_primary'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _pin(self, request):
+        writing = request.method not in SAFE_METHODS
+        return writing, _pinned.set(writing or self.cookie_name in request.COOKIES)
+
+    def _set_cookie(self, writing, response):
+        if writing and response.status_code < 400:
+            response.set_cookie(
+                self.cookie_name, '1',
+                max_age=settings.DATABASE_REPLICA_STICKY_SECONDS,
+                httponly=True, samesite='Lax',
+            )
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        writing, token = self._pin(request)
+        try:
+            return self._set_cookie(writing, self.get_response(request))
+        finally:
+            _pinned.reset(token)
+
+    async def __acall__(self, request):
+        writing, token = self._pin(request)
+        try:
+            return self._set_cookie(writing, await self.get_response(request))
+        finally:
+            _pinned.reset(token)
@@ -0,0 +1,291 @@
+"""
+リクエストごとの処理時間の内訳を計る仕組み
+
+- RequestInstrumentationMiddleware がリクエストごとに RequestMetrics を作り、次の時間を集める
+  - SQL: 全ての接続に付ける execute_wrapper で、クエリの数と時間
+  - テンプレート: TimedDjangoTemplates (TEMPLATES の BACKEND) で、render の時間
+  - オブジェクトストレージ: media.utils が boto3 のイベントとアップロードの呼び出しで記録する時間
+- 集めた内訳は Server-Timing ヘッダーで返す (ブラウザの開発者ツールで見られる)
+- REQUEST_PROFILE_SAMPLE_RATE の割合のリクエストをプロファイルして、REQUEST_PROFILE_SLOW_MS 以上かかったものを
+  REQUEST_PROFILE_DIR に書き出す
+- テストでは measure でクエリの数や時間を計り、予算を超えていないことを確認する (app.testing)
+
+計測中の RequestMetrics は ContextVar に入れるので、非同期のビューや sync_to_async で実行した処理の分も数える
+(コンテキストを引き継がないスレッドプールで実行した処理は数えない)
+"""
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# Server-Timing に出す内訳と、その説明
+TIMING_KINDS = {
+    'sql': 'SQL',
+    'template': 'Template',
+    'storage': 'Object storage',
+}
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """ 1 つのリクエスト (または measure のブロック) の、内訳ごとの回数と秒数 """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.counts = dict.fromkeys(TIMING_KINDS, 0)
+        self.seconds = dict.fromkeys(TIMING_KINDS, 0.0)
+        self.total = 0.0
+        # 計測中の内訳 (入れ子になった同じ内訳の時間を二重に数えない)
+        self.active = set()
+
+    def add(self, kind, seconds):
+        metrics = self
+        while metrics is not None:
+            metrics.counts[kind] += 1
+            metrics.seconds[kind] += seconds
+            metrics = metrics.parent
+
+    @property
+    def queries(self):
+        return self.counts['sql']
+
+    def ms(self, kind=None):
+        return round((self.total if kind is None else self.seconds[kind]) * 1000, 1)
+
+    def server_timing(self):
+        """ Server-Timing ヘッダーの値 """
+        entries = []
+        for kind, description in TIMING_KINDS.items():
+            if self.counts[kind]:
+                entries.append('%s;dur=%.1f;desc="%s (%d)"' % (
+                    kind, self.seconds[kind] * 1000, description, self.counts[kind],
+                ))
+        entries.append('total;dur=%.1f' % (self.total * 1000))
+        return ', '.join(entries)
+
+    def as_dict(self):
+        return {
+            **{'%s_count' % kind: count for kind, count in self.counts.items()},
+            **{'%s_ms' % kind: self.ms(kind) for kind in TIMING_KINDS},
+            'total_ms': self.ms(),
+        }
+
+
+def get_current_metrics():
+    return _current.get()
+
+
+def record(kind, seconds):
+    """ 計測中なら、kind の処理に seconds 秒かかったことを記録する """
+    metrics = _current.get()
+    if metrics is not None and kind not in metrics.active:
+        metrics.add(kind, seconds)
+
+
+@contextmanager
+def timed(kind):
+    """ ブロックの時間を kind の処理として記録する (中で同じ kind を記録しても二重に数えない) """
+    metrics = _current.get()
+    if metrics is None or kind in metrics.active:
+        yield
+        return
+    metrics.active.add(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.active.discard(kind)
+        metrics.add(kind, time.perf_counter() - started)
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add('sql', time.perf_counter() - started)
+
+
+def install_sql_wrapper(connection, **kwargs):
+    """
+    接続に SQL の計測を付ける (何度呼んでも 1 つだけ付ける)
+    connection.execute_wrapper() のブロックは最後に追加したものを取り除くので、先頭に入れる
+    """
+    if _sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _sql_wrapper)
+
+
+def _install_on_new_connection(sender, connection, **kwargs):
+    install_sql_wrapper(connection)
+
+
+# これから接続するデータベースには、接続したときに付ける
+connection_created.connect(_install_on_new_connection)
+
+
+@contextmanager
+def measure():
+    """
+    ブロックの中の SQL・テンプレート・ストレージの回数と時間を計り、RequestMetrics を返す
+    入れ子にすると、内側で計った分は外側にも足す
+    """
+    # このモジュールを読み込む前に接続していたデータベースにも付ける
+    for connection in connections.all(initialized_only=True):
+        install_sql_wrapper(connection)
+    metrics = RequestMetrics(parent=_current.get())
+    token = _current.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.total = time.perf_counter() - started
+        _current.reset(token)
+
+
+class TimedTemplate:
+    """ render の時間を記録するテンプレート (それ以外はバックエンドのテンプレートと同じ) """
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """ render の時間を記録する Django テンプレートのバックエンド """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def _profile_path(request, elapsed):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'root'
+    return os.path.join(
+        settings.REQUEST_PROFILE_DIR,
+        '%s-%s-%s-%dms' % (time.strftime('%Y%m%d-%H%M%S'), request.method, slug[:80], elapsed * 1000),
+    )
+
+
+class _CProfiler:
+    extension = '.prof'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        # snakeviz や python -m pstats で開ける形式
+        self.profile.dump_stats(path)
+
+
+class _Pyinstrument:
+    extension = '.html'
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImproperlyConfigured("REQUEST_PROFILER = 'pyinstrument' requires the pyinstrument package")
+        self.profiler = Profiler()
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            output.write(self.profiler.output_html())
+
+
+PROFILERS = {'cprofile': _CProfiler, 'pyinstrument': _Pyinstrument}
+
+
+class RequestInstrumentationMiddleware:
+    """
+    リクエストごとに SQL・テンプレート・ストレージの時間を計り、Server-Timing ヘッダーで返すミドルウェア
+    REQUEST_PROFILE_SAMPLE_RATE を 0 より大きくすると、その割合のリクエストをプロファイルして、
+    遅かったものを書き出す (プロファイラはスレッド単位なので、同期のリクエストだけを対象にする)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _finish(self, request, response, metrics):
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing()
+        if metrics.total * 1000 >= settings.REQUEST_SLOW_MS:
+            logger.warning(
+                'slow request: %s %s %.1fms (%d queries)', request.method, request.path,
+                metrics.total * 1000, metrics.queries, extra={'metrics': metrics.as_dict()},
+            )
+        return response
+
+    def _sampled(self):
+        rate = settings.REQUEST_PROFILE_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def _profile(self, request):
+        profiler = PROFILERS[settings.REQUEST_PROFILER]()
+        with measure() as metrics:
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+        if metrics.total * 1000 >= settings.REQUEST_PROFILE_SLOW_MS:
+            path = _profile_path(request, metrics.total) + profiler.extension
+            os.makedirs(settings.REQUEST_PROFILE_DIR, exist_ok=True)
+            profiler.write(path)
+            logger.warning('profiled slow request: %s %s -> %s', request.method, request.path, path)
+        return response, metrics
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if self._sampled():
+            response, metrics = self._profile(request)
+        else:
+            with measure() as metrics:
+                response = self.get_response(request)
+        return self._finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        with measure() as metrics:
+            response = await self.get_response(request)
+        return self._finish(request, response, metrics)
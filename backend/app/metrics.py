@@ -0,0 +1,172 @@
+"""
+Prometheus の形式のメトリクス (GET /metrics)
+
+- HTTP: URL の名前 (app.urls の name) ごとのレイテンシのヒストグラムと、処理中のリクエストの数
+- データベース: リクエストあたりのクエリの数とクエリの時間 (app.instrumentation で計ったもの)、新しく開いた接続の数
+- キャッシュ: キャッシュごとの当たり・外れの回数 (当たりの割合は PromQL で計算する)
+- 画像: 変換の段階 (デコード・縮小・エンコードなど) ごとの時間
+- オブジェクトストレージ: 操作ごとのレイテンシと、アップロードしたバイト数
+
+gunicorn などで複数のワーカープロセスを動かすときは、環境変数 PROMETHEUS_MULTIPROC_DIR に
+全ワーカーで共有するディレクトリを指定する。各プロセスの値はそこにファイルとして書かれ、
+/metrics は全プロセスの値を合算して返す (ディレクトリの準備とプロセスの終了の記録は gunicorn.conf.py で行う)
+"""
+import hmac
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from app.instrumentation import get_current_metrics
+
+# API の応答時間を見るためのバケット (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# リクエストあたりのクエリの数のバケット (N+1 になると大きいほうに寄る)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+# 画像の変換の段階ごとの時間のバケット (秒)
+IMAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by URL name',
+    ('method', 'view', 'status'), buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'HTTP requests being processed',
+    ('method',), multiprocess_mode='livesum',
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    'db_queries_per_request', 'Number of SQL queries per HTTP request',
+    ('view',), buckets=QUERY_COUNT_BUCKETS,
+)
+DB_QUERY_SECONDS = Counter(
+    'db_query_duration_seconds', 'Time spent in SQL queries during HTTP requests', ('view',),
+)
+DB_CONNECTIONS_OPENED = Counter(
+    'db_connections_opened', 'Database connections opened', ('alias',),
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests', 'Cache lookups by result', ('cache', 'result'),
+)
+IMAGE_STAGE_DURATION = Histogram(
+    'image_processing_stage_duration_seconds', 'Image pipeline time by stage',
+    ('stage',), buckets=IMAGE_BUCKETS,
+)
+STORAGE_OPERATION_DURATION = Histogram(
+    'storage_operation_duration_seconds', 'Object storage latency by operation',
+    ('operation',), buckets=LATENCY_BUCKETS,
+)
+STORAGE_UPLOAD_BYTES = Counter(
+    'storage_upload_bytes', 'Bytes uploaded to object storage',
+)
+
+# URL に一致しなかったリクエストの view ラベル (任意の URL でラベルの種類を増やさない)
+UNMATCHED_VIEW = '<unmatched>'
+# method ラベルに使うメソッド (それ以外のクライアントが送ってきた任意のメソッドは OTHER_METHOD にまとめる)
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'))
+OTHER_METHOD = 'other'
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def image_stage(stage):
+    """ 画像の変換の段階の時間を計る (with 文とデコレータのどちらでも使える) """
+    return IMAGE_STAGE_DURATION.labels(stage).time()
+
+
+def observe_storage(operation, seconds, size=None):
+    STORAGE_OPERATION_DURATION.labels(operation).observe(seconds)
+    if size is not None:
+        STORAGE_UPLOAD_BYTES.inc(size)
+
+
+def _count_connection(sender, connection, **kwargs):
+    DB_CONNECTIONS_OPENED.labels(connection.alias).inc()
+
+
+connection_created.connect(_count_connection)
+
+
+def _method_label(request):
+    return request.method if request.method in HTTP_METHODS else OTHER_METHOD
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else UNMATCHED_VIEW
+
+
+class MetricsMiddleware:
+    """
+    リクエストごとのレイテンシとクエリの数を記録するミドルウェア
+    クエリの数は RequestInstrumentationMiddleware の計測を使うので、その後ろに置く
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _observe(self, request, response, started):
+        view = _view_name(request)
+        HTTP_REQUEST_DURATION.labels(_method_label(request), view, response.status_code).observe(
+            time.perf_counter() - started
+        )
+        metrics = get_current_metrics()
+        if metrics is not None:
+            DB_QUERIES_PER_REQUEST.labels(view).observe(metrics.queries)
+            DB_QUERY_SECONDS.labels(view).inc(metrics.seconds['sql'])
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with HTTP_REQUESTS_IN_PROGRESS.labels(_method_label(request)).track_inprogress():
+            response = self.get_response(request)
+        return self._observe(request, response, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with HTTP_REQUESTS_IN_PROGRESS.labels(_method_label(request)).track_inprogress():
+            response = await self.get_response(request)
+        return self._observe(request, response, started)
+
+
+def get_registry():
+    """ /metrics で返すレジストリ (複数プロセスのときは、全プロセスの値を合算するレジストリ) """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_view(request):
+    """
+    Prometheus がスクレイプするエンドポイント (METRICS_TOKEN の Bearer トークンを求める)
+    METRICS_TOKEN を設定していなければ、DEBUG のときだけトークンなしで返す
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
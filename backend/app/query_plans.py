@@ -0,0 +1,94 @@
+"""
+よく実行されるクエリ (一覧・詳細などの QuerySet) を登録しておき、EXPLAIN の結果から
+テーブル全体の走査や、インデックスを使わない並び替えが起きていないかを確認する仕組み
+
+各アプリは query_plans モジュールで register_queryset を使って QuerySet を登録し、
+AppConfig.ready で読み込む。explain_querysets コマンドとテストから確認する
+"""
+import re
+
+from django.db import connections
+
+# データベースごとの、実行計画で問題とみなすパターン
+PLAN_PROBLEMS = {
+    'sqlite': (
+        # インデックスを使わない全件の走査 (SCAN <テーブル> の後に USING ... INDEX が続かないもの)
+        # FTS5 などの仮想テーブルは、テーブル側の索引で引くので対象外にする
+        ('full_scan', re.compile(r'\bSCAN (?!.*\bUSING (COVERING )?INDEX\b)(?!CONSTANT ROW)(?!\S+ VIRTUAL TABLE)\S+')),
+        ('filesort', re.compile(r'USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)')),
+    ),
+    'postgresql': (
+        ('full_scan', re.compile(r'\bSeq Scan\b')),
+        ('filesort', re.compile(r'^\s*(->\s*)?(Incremental )?Sort\b', re.MULTILINE)),
+    ),
+    'mysql': (
+        ('full_scan', re.compile(r'\btype\W+ALL\b|Table scan')),
+        ('filesort', re.compile(r'Using filesort|Sort:')),
+    ),
+}
+
+_registry = {}
+
+
+class HotQuerySet:
+    """ 登録された QuerySet と、許容する問題 (件数を数えるための走査など) """
+
+    def __init__(self, name, factory, allow=(), reason=''):
+        self.name = name
+        self.factory = factory
+        self.allow = frozenset(allow)
+        self.reason = reason
+
+    def build(self):
+        return self.factory()
+
+
+def register_queryset(name, allow=(), reason=''):
+    """
+    QuerySet を返す関数を、実行計画を確認する対象として登録するデコレータ
+    allow には、そのクエリでは避けられない問題 ('full_scan' / 'filesort') を理由とともに指定する
+    """
+    def decorator(factory):
+        _registry[name] = HotQuerySet(name, factory, allow, reason)
+        return factory
+    return decorator
+
+
+def get_registered_querysets():
+    return dict(_registry)
+
+
+def aggregate_queryset(queryset, **aggregates):
+    """
+    queryset.aggregate(**aggregates) と同じ SQL を実行する QuerySet を作る
+    aggregate() はその場で実行されてしまうので、EXPLAIN するために QuerySet のまま組み立てる
+    """
+    queryset = queryset.order_by()
+    for alias, aggregate in aggregates.items():
+        queryset.query.add_annotation(aggregate, alias)
+    queryset.query.default_cols = False
+    return queryset
+
+
+def find_plan_problems(plan, vendor):
+    """ 実行計画の文字列から、問題の種類と該当する行の組のリストを返す """
+    problems = []
+    for kind, pattern in PLAN_PROBLEMS.get(vendor, ()):
+        for line in plan.splitlines():
+            if pattern.search(line):
+                problems.append((kind, line.strip()))
+    return problems
+
+
+def explain(hot):
+    """
+    登録された QuerySet の EXPLAIN を実行して、(実行計画, 許容されない問題のリスト) を返す
+    QuerySet を読み取るデータベースで実行する
+    """
+    queryset = hot.build()
+    vendor = connections[queryset.db].vendor
+    plan = queryset.explain()
+    problems = [
+        (kind, line) for kind, line in find_plan_problems(plan, vendor) if kind not in hot.allow
+    ]
+    return plan, problems
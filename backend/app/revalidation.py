@@ -0,0 +1,132 @@
+"""
+記事や画像が変わったことを Next.js に伝えて、静的に生成したページを作り直してもらう仕組み
+
+- 変更はトランザクションのコミット後に publish_change で受け付け、再検証が必要なパスとタグを溜める
+- 最後の変更から REVALIDATION_DEBOUNCE_SECONDS 秒たつか、最初の変更から REVALIDATION_MAX_DELAY_SECONDS 秒たったら、
+  溜まったパスとタグを REVALIDATION_MAX_BATCH 件ずつまとめて REVALIDATION_WEBHOOK_URL に POST する
+- 送信はバックグラウンドのスレッドで行うので、リクエストの処理は待たない
+- REVALIDATION_WEBHOOK_URL が空なら何もしない
+"""
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Webhook に付ける共有の秘密鍵のヘッダー (frontend/src/app/api/revalidate/route.ts で確認する)
+SECRET_HEADER = 'X-Revalidate-Secret'
+
+
+def send_revalidation(paths, tags):
+    """ 1 回分のパスとタグを Webhook に送る (失敗したら例外を送出する) """
+    body = json.dumps({'paths': sorted(paths), 'tags': sorted(tags)}).encode()
+    request = urllib.request.Request(
+        settings.REVALIDATION_WEBHOOK_URL,
+        data=body,
+        method='POST',
+        headers={
+            'Content-Type': 'application/json',
+            SECRET_HEADER: settings.REVALIDATION_WEBHOOK_SECRET,
+        },
+    )
+    with urllib.request.urlopen(request, timeout=settings.REVALIDATION_TIMEOUT) as response:
+        response.read()
+
+
+def _chunks(paths, tags, size):
+    # パスとタグを合わせて size 件ずつに分ける
+    items = [('path', path) for path in sorted(paths)] + [('tag', tag) for tag in sorted(tags)]
+    for start in range(0, len(items), size):
+        chunk = items[start:start + size]
+        yield {v for k, v in chunk if k == 'path'}, {v for k, v in chunk if k == 'tag'}
+
+
+class RevalidationDispatcher:
+    """ 再検証するパスとタグを溜めておき、間引いてまとめて送る (プロセス単位) """
+
+    def __init__(self, send=send_revalidation):
+        self.send = send
+        self._condition = threading.Condition()
+        self._paths = set()
+        self._tags = set()
+        self._first_at = self._last_at = None
+        self._thread = None
+
+    def publish(self, paths=(), tags=()):
+        with self._condition:
+            self._paths.update(paths)
+            self._tags.update(tags)
+            now = time.monotonic()
+            self._first_at = self._first_at or now
+            self._last_at = now
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='revalidation', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _due(self):
+        """ 送るまでの残りの秒数 (溜まっていなければ None) """
+        if self._first_at is None:
+            return None
+        return max(0, min(
+            self._last_at + settings.REVALIDATION_DEBOUNCE_SECONDS,
+            self._first_at + settings.REVALIDATION_MAX_DELAY_SECONDS,
+        ) - time.monotonic())
+
+    def _take(self):
+        paths, tags = self._paths, self._tags
+        self._paths, self._tags = set(), set()
+        self._first_at = self._last_at = None
+        return paths, tags
+
+    def _run(self):
+        while True:
+            with self._condition:
+                remaining = self._due()
+                while remaining is None or remaining > 0:
+                    # 新しい変更が来たら待ち時間を計算し直す (しばらく何も来なければスレッドを終える)
+                    if not self._condition.wait(timeout=remaining if remaining is not None else 60):
+                        if remaining is None:
+                            self._thread = None
+                            return
+                    remaining = self._due()
+                paths, tags = self._take()
+            self._deliver(paths, tags)
+
+    def _deliver(self, paths, tags):
+        for chunk_paths, chunk_tags in _chunks(paths, tags, settings.REVALIDATION_MAX_BATCH):
+            for attempt in range(settings.REVALIDATION_RETRIES + 1):
+                try:
+                    self.send(chunk_paths, chunk_tags)
+                    break
+                except Exception:
+                    if attempt == settings.REVALIDATION_RETRIES:
+                        # 届かなくても、Next.js 側の revalidate の期限が来れば作り直される
+                        logger.exception(
+                            'revalidation webhook failed: paths=%s tags=%s', chunk_paths, chunk_tags
+                        )
+                    else:
+                        time.sleep(0.5 * 2 ** attempt)
+
+    def flush(self):
+        """ 溜まっているパスとタグをすぐに送る (テストやコマンドの終了時に使う) """
+        with self._condition:
+            paths, tags = self._take()
+        if paths or tags:
+            self._deliver(paths, tags)
+
+
+dispatcher = RevalidationDispatcher()
+
+
+def publish_change(paths=(), tags=()):
+    """ 現在のトランザクションがコミットされたら、パスとタグの再検証を依頼する """
+    if not settings.REVALIDATION_WEBHOOK_URL:
+        return
+    paths, tags = tuple(paths), tuple(tags)
+    transaction.on_commit(lambda: dispatcher.publish(paths, tags))
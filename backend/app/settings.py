@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import tempfile
 from datetime import timedelta
 from pathlib import Path
 
@@ -48,6 +50,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 他のミドルウェアの分も含めて計るので、最初に置く
+    'app.instrumentation.RequestInstrumentationMiddleware',
+    # URL の名前ごとのレイテンシとクエリの数を Prometheus のメトリクスに記録する (app.metrics)
+    'app.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,13 +61,18 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.db_routers.ReplicaStickinessMiddleware',
 ]
 
 ROOT_URLCONF = 'app.urls'
 
+# ASGI サーバーで動かすときに 1 にすると、記事の読み取り系のビューと画像 API を非同期版に差し替える
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS') == '1'
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # render の時間を Server-Timing に出すため、Django テンプレートのバックエンドを包んだものを使う
+        'BACKEND': 'app.instrumentation.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,10 +92,86 @@ WSGI_APPLICATION = 'app.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
+# DATABASE_PROFILE で使うデータベースを切り替える
+#   'sqlite': 開発用の db.sqlite3
+#   'postgresql': POSTGRES_* の環境変数で指定した PostgreSQL (本番用)
+DATABASE_PROFILE = os.getenv('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgresql':
+    def _postgres(host):
+        database = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'HOST': host,
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'NAME': os.getenv('POSTGRES_DB', 'blog'),
+            'USER': os.getenv('POSTGRES_USER', 'blog'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            # 接続をリクエストをまたいで使い回し、使う前に切れていないかを確認する
+            'CONN_MAX_AGE': int(os.getenv('POSTGRES_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+        # POSTGRES_POOL でコネクションプールの種類を選ぶ
+        #   'psycopg': psycopg のプロセス内のコネクションプールを使う (CONN_MAX_AGE は 0 にする必要がある)
+        #   'pgbouncer': PgBouncer (トランザクションプーリング) を経由する。サーバーサイドカーソルは使えない
+        pool = os.getenv('POSTGRES_POOL', '')
+        if pool == 'psycopg':
+            database['CONN_MAX_AGE'] = 0
+            database['OPTIONS']['pool'] = {
+                'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', '2')),
+                'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', '10')),
+            }
+        elif pool == 'pgbouncer':
+            database['DISABLE_SERVER_SIDE_CURSORS'] = True
+        return database
+
+    DATABASES = {'default': _postgres(os.getenv('POSTGRES_HOST', 'localhost'))}
+    # POSTGRES_REPLICA_HOSTS (カンマ区切り) を指定すると、読み取り専用のレプリカとして登録する
+    for number, host in enumerate(filter(None, os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',')), 1):
+        DATABASES['replica_%d' % number] = dict(_postgres(host.strip()), TEST={'MIRROR': 'default'})
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        }
+    }
+    # SQLITE_CONCURRENT=1 で、同時に読み書きするリクエストが多い環境 (小規模な本番や負荷試験) 向けの設定にする
+    #   - WAL にして、読み取りと書き込みが互いを待たないようにする
+    #   - 書き込みのトランザクションは BEGIN IMMEDIATE で始め、ロックの取り合いによる
+    #     "database is locked" を避ける (ロックが空くまで timeout 秒待つ)
+    #   - WAL では synchronous=NORMAL でもデータベースは壊れない (電源断で直前のコミットを失うことはある)
+    if os.getenv('SQLITE_CONCURRENT') == '1':
+        DATABASES['default']['OPTIONS'] = {
+            'init_command': ';'.join([
+                'PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                # 256MB までメモリマップで読み、ページキャッシュは接続ごとに 64MB (負の値は KiB 単位)
+                'PRAGMA mmap_size=268435456',
+                'PRAGMA cache_size=-65536',
+                'PRAGMA temp_store=MEMORY',
+            ]),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),
+        }
+
+# 読み取りを振り分けるレプリカの別名と、レプリカから読み取るアプリ
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica_')]
+DATABASE_REPLICA_APPS = ('blog',)
+# 書き込みをした利用者の読み取りを、プライマリに固定しておく秒数 (レプリカの遅延より長くする)
+DATABASE_REPLICA_STICKY_SECONDS = 10
+DATABASE_ROUTERS = ['app.db_routers.PrimaryReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# 既定ではプロセス内のメモリを使い、CACHE_BACKEND / CACHE_LOCATION を指定すると
+# Redis や Memcached などの複数プロセスで共有できるキャッシュに切り替えられる
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'blog'),
     }
 }
 
@@ -136,9 +223,140 @@ LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+# 記事一覧 (トップページと記事一覧 API) の 1 ページあたりの件数
+ARTICLE_PAGE_SIZE = 20
+# 読了時間の計算に使う、1 分間に読める日本語の文字数とそれ以外の語数
+ARTICLE_READING_SPEED = {'cjk_chars': 500, 'words': 200}
+
+# 記事詳細 (HTML の断片と API のレスポンス) のキャッシュ設定
+ARTICLE_CACHE_ALIAS = 'default'
+ARTICLE_CACHE_TIMEOUT = 60 * 60 * 24
+# キャッシュを再構築している間、他のリクエストを待たせる最大秒数
+ARTICLE_CACHE_LOCK_TIMEOUT = 5
+
+# 記事の一括登録 (NDJSON / CSV) で、1 回のトランザクションで登録する件数と、レスポンスに含めるエラーの件数の上限
+ARTICLE_IMPORT_CHUNK_SIZE = 1000
+ARTICLE_IMPORT_MAX_ERRORS = 100
+# 記事の書き出しで、1 回のクエリで読む件数
+ARTICLE_EXPORT_CHUNK_SIZE = 1000
+
+# 画像を保存するオブジェクトストレージ
+# 'minio' なら MINIO_* の環境変数で指定した MinIO に、'local' ならプロセス内のメモリに保存する (開発・テスト用)
+OBJECT_STORAGE_BACKEND = os.getenv('OBJECT_STORAGE_BACKEND', 'minio')
+LOCAL_OBJECT_STORAGE_URL = 'http://localhost:9000/'
+# S3 クライアントのコネクションプールとタイムアウト (秒)
+MINIO_MAX_POOL_CONNECTIONS = 20
+MINIO_CONNECT_TIMEOUT = 5
+MINIO_READ_TIMEOUT = 30
+# 1 回のアップロードで作られる画像 (オリジナルと縮小画像) を並列に送るスレッド数
+MINIO_UPLOAD_CONCURRENCY = 8
+# この大きさを超えるファイルはマルチパートで分割し、パートを並列に送る
+MINIO_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MINIO_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MINIO_MULTIPART_CONCURRENCY = 4
+
+# 画像アップロード時に作成する縮小画像の設定 (長辺のピクセル数と JPEG の品質)
+IMAGE_RENDITIONS = {
+    'display': {'long_side': 1000, 'quality': 85},
+    'thumbnail': {'long_side': 300, 'quality': 80},
+}
+# srcset / <picture> 用に作成する縮小画像の幅と形式 (形式は優先する順。AVIF は Pillow が対応している場合のみ作る)
+IMAGE_SRCSET_WIDTHS = (320, 640, 1000, 1600)
+IMAGE_SRCSET_FORMATS = ('avif', 'webp', 'jpeg')
+# srcset 用の縮小画像の形式ごとの品質
+IMAGE_FORMAT_QUALITY = {'avif': 60, 'webp': 80, 'jpeg': 82}
+# JPEG 以外の形式でアップロードされたオリジナル画像を JPEG に変換するときの品質
+IMAGE_ORIGINAL_QUALITY = 90
+# この形式でアップロードされたオリジナル画像は、変換せずにそのまま保存する
+IMAGE_PASSTHROUGH_FORMATS = ('JPEG', 'PNG', 'WEBP')
+# アップロードできる画像のバイト数と画素数の上限
+IMAGE_UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+IMAGE_MAX_PIXELS = 50_000_000
+# エンコードした画像をメモリに置いておく上限 (バイト数)。これを超えると一時ファイルに書き出す
+IMAGE_SPOOL_MAX_MEMORY = 1024 * 1024
+# アップロードされたファイルをメモリに置いておく上限 (バイト数)。これを超えると一時ファイルに書き出す
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2 * 1024 * 1024
+# アップロードを受け取りながら内容のハッシュ値を計算する (重複した画像の検出に使う)
+FILE_UPLOAD_HANDLERS = [
+    'media.upload_handlers.HashingMemoryFileUploadHandler',
+    'media.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+# ブラウザからオブジェクトストレージに直接アップロードするときの、署名付き URL の有効期間 (秒) と受け付ける形式
+IMAGE_DIRECT_UPLOAD_EXPIRES = 15 * 60
+IMAGE_DIRECT_UPLOAD_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/gif', 'image/avif')
+# この大きさを超えるファイルはマルチパートアップロードにして、MINIO_MULTIPART_CHUNKSIZE ずつのパートの URL を発行する
+IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD = MINIO_MULTIPART_THRESHOLD
+# GET /api/image/<id>/<幅>x<高さ>.<形式> で、初めて要求されたときに作る縮小画像の大きさ (この枠に収まるように縮小する) と形式
+# (ここにない大きさや形式は 404 にして、任意の大きさの画像を作らせない)
+IMAGE_TRANSFORM_SIZES = (
+    (160, 160), (320, 320), (640, 640), (1000, 1000), (1600, 1600),
+    # OGP 画像
+    (1200, 630),
+)
+IMAGE_TRANSFORM_FORMATS = ('avif', 'webp', 'jpeg')
+# 作成済みの縮小画像へのリダイレクトを、ブラウザや CDN にキャッシュさせる秒数
+IMAGE_TRANSFORM_REDIRECT_MAX_AGE = 24 * 60 * 60
+# 同じ縮小画像を作っている他のリクエストを待つ最大秒数
+IMAGE_TRANSFORM_WAIT_TIMEOUT = 30
+# まとめてアップロードできるファイルの数 (DATA_UPLOAD_MAX_NUMBER_FILES を超えないようにする) と、
+# ファイルごとの変換と保存を並列に行うスレッド数 (プロセス内の全リクエストで共有する)
+IMAGE_BATCH_MAX_FILES = 100
+IMAGE_BATCH_WORKERS = 4
+# 画像のエンコードを並列に行うスレッド数
+IMAGE_PROCESSING_WORKERS = 4
+# 'sync' ならアップロードのリクエスト内で縮小画像まで作成して 201 を返し、
+# 'async' ならオリジナル画像だけを保存して 202 を返し、縮小画像はバックグラウンドで作成する
+IMAGE_PROCESSING_MODE = os.getenv('IMAGE_PROCESSING_MODE', 'sync')
+# 'async' のときに使うキュー
+#   'thread': 同じプロセス内のスレッドで処理する
+#             (キューはメモリ上にあるので、再起動やデプロイで処理前の画像が pending のまま残る。
+#             残った画像は process_images --once で処理できる)
+#   'database': pending 状態の Image を process_images コマンドのワーカーが処理する
+#               (キューがデータベースにあるので、再起動しても失われないのはこれだけ)
+#   'immediate': コミット直後に同じスレッドで処理する (開発・テスト用)
+IMAGE_QUEUE_BACKEND = os.getenv('IMAGE_QUEUE_BACKEND', 'thread')
+# processing のまま、この秒数を過ぎた画像は、ワーカーが途中で止まったものとして pending に戻す
+# (database キューのワーカーが、pending の画像を取り出す前に戻す)
+IMAGE_PROCESSING_TIMEOUT = int(os.getenv('IMAGE_PROCESSING_TIMEOUT', '600'))
+
+# リクエストごとの SQL・テンプレート・オブジェクトストレージの時間を、Server-Timing ヘッダーで返す
+# (処理時間の内訳が外から見えるので、公開する環境では 0 にする)
+SERVER_TIMING = os.getenv('SERVER_TIMING', '1') == '1'
+# これ以上かかったリクエストを、内訳とともにログに出す (ミリ秒)
+REQUEST_SLOW_MS = float(os.getenv('REQUEST_SLOW_MS', '1000'))
+# この割合のリクエストをプロファイルして、REQUEST_PROFILE_SLOW_MS 以上かかったものを REQUEST_PROFILE_DIR に書き出す
+# REQUEST_PROFILER は 'cprofile' (.prof) か 'pyinstrument' (.html。pyinstrument のインストールが必要)
+REQUEST_PROFILE_SAMPLE_RATE = float(os.getenv('REQUEST_PROFILE_SAMPLE_RATE', '0'))
+REQUEST_PROFILE_SLOW_MS = float(os.getenv('REQUEST_PROFILE_SLOW_MS', '500'))
+REQUEST_PROFILER = os.getenv('REQUEST_PROFILER', 'cprofile')
+REQUEST_PROFILE_DIR = os.getenv('REQUEST_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'blog-profiles'))
+# GET /metrics (Prometheus) に求める Bearer トークン (空なら DEBUG のときだけトークンなしで返し、それ以外は 403)
+# 複数のワーカープロセスで動かすときは、環境変数 PROMETHEUS_MULTIPROC_DIR も指定する (app.metrics)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# 記事や画像が変わったときに、Next.js にページの再生成を依頼する Webhook (空なら依頼しない)
+REVALIDATION_WEBHOOK_URL = os.getenv('REVALIDATION_WEBHOOK_URL', '')
+REVALIDATION_WEBHOOK_SECRET = os.getenv('REVALIDATION_WEBHOOK_SECRET', '')
+# 最後の変更からこの秒数だけ待ってまとめて送る (変更が続いても、最初の変更から MAX_DELAY 秒たったら送る)
+REVALIDATION_DEBOUNCE_SECONDS = float(os.getenv('REVALIDATION_DEBOUNCE_SECONDS', '1'))
+REVALIDATION_MAX_DELAY_SECONDS = 10
+# 1 回の Webhook で送るパスとタグの上限、タイムアウト (秒)、失敗したときに再送する回数
+REVALIDATION_MAX_BATCH = 100
+REVALIDATION_TIMEOUT = 5
+REVALIDATION_RETRIES = 2
+
+# API の認証で、リクエストごとにユーザーをデータベースから読み込まず、トークンの内容だけで認証するかどうか
+# (ユーザーの無効化や削除、パスワードの変更が、アクセストークンの有効期限が切れるまで反映されなくなるので、
+# 既定では無効にして、必要なときだけ JWT_STATELESS_AUTH=1 で有効にする)
+JWT_STATELESS_AUTH = os.getenv('JWT_STATELESS_AUTH', '0') == '1'
+# トークンのブラックリストをメモリに保持する秒数 (0 ならリクエストごとにデータベースに問い合わせる)
+JWT_BLACKLIST_CACHE_SECONDS = int(os.getenv('JWT_BLACKLIST_CACHE_SECONDS', '30'))
+
 # djangorestframework-simplejwt を利用するための設定
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'accounts.authentication.StatelessJWTAuthentication'
+        if JWT_STATELESS_AUTH else
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     )
 }
@@ -147,5 +365,8 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=2),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
     'ROTATE_REFRESH_TOKENS': True,
-    'UPDATE_LAST_LOGIN': True,
+    # トークンの発行のたびに last_login を書き込む (JWT_UPDATE_LAST_LOGIN=0 で書き込まない)
+    'UPDATE_LAST_LOGIN': os.getenv('JWT_UPDATE_LAST_LOGIN', '1') == '1',
+    'TOKEN_OBTAIN_SERIALIZER': 'accounts.serializers.TokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'accounts.serializers.TokenRefreshSerializer',
 }
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+テストで、リクエストのクエリの数と処理時間が予算の中に収まっていることを確認するヘルパー
+
+    class ArticleViewTest(BudgetTestMixin, TestCase):
+        def test_top_budget(self):
+            with self.assertWithinBudget(queries=3, ms=500):
+                self.client.get('/')
+
+クエリの数は N+1 の検出に使うので、件数を変えても同じ予算で通ることを確かめる (assertConstantQueries)
+時間の予算は遅い CI でも落ちない程度に緩くして、桁違いの退行だけを捕まえる
+"""
+from contextlib import contextmanager
+
+from app.instrumentation import measure
+
+
+class BudgetTestMixin:
+    @contextmanager
+    def assertWithinBudget(self, queries=None, ms=None, storage_calls=None):
+        """ ブロックの中の SQL の数・全体の時間 (ミリ秒)・ストレージの呼び出しの数が、予算以下であることを確認する """
+        with measure() as metrics:
+            yield metrics
+        report = metrics.as_dict()
+        if queries is not None:
+            self.assertLessEqual(
+                metrics.queries, queries, 'query budget exceeded: %(sql_count)d queries (%(sql_ms)sms)' % report,
+            )
+        if ms is not None:
+            self.assertLessEqual(metrics.ms(), ms, 'time budget exceeded: %s' % report)
+        if storage_calls is not None:
+            self.assertLessEqual(metrics.counts['storage'], storage_calls, 'storage budget exceeded: %s' % report)
+
+    def assertConstantQueries(self, request, grow):
+        """
+        request() のクエリの数が、grow() でデータを増やした後も変わらないことを確認する (N+1 の検出)
+        1 回目はキャッシュなどの準備のために実行して、2 回目と 3 回目を比べる
+        """
+        request()
+        with measure() as before:
+            request()
+        grow()
+        with measure() as after:
+            request()
+        self.assertEqual(
+            before.queries, after.queries,
+            'query count grew with the data: %d -> %d' % (before.queries, after.queries),
+        )
+        return after.queries
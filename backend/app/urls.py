@@ -14,6 +14,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
@@ -22,19 +23,63 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 
+from app.metrics import metrics_view
+from blog import async_views as blog_async_views
 from blog.views import top, ArticleViewSet
-from media.views import ImageUploadView
+from media import async_views as media_async_views
+from media.views import (
+    ImageBatchUploadView,
+    ImageDetailView,
+    ImageRenditionView,
+    ImageUploadView,
+    UploadSessionCompleteView,
+    UploadSessionDetailView,
+    UploadSessionView,
+)
 
 router = routers.DefaultRouter()
 router.register('articles', ArticleViewSet)
 
+if settings.ASYNC_VIEWS:
+    # ASGI で動かすときは、読み取り系のビューとアップロードを非同期版に差し替える
+    # (記事の一覧と詳細は、ルーターより先に登録して優先させる)
+    top_view = blog_async_views.top
+    api_patterns = [
+        path('api/articles/', blog_async_views.article_list),
+        path('api/articles/<int:pk>/', blog_async_views.article_retrieve),
+    ]
+    image_upload_view = media_async_views.image_upload
+    image_batch_upload_view = media_async_views.image_batch_upload
+    image_detail_view = media_async_views.image_detail
+    image_rendition_view = media_async_views.image_rendition
+else:
+    top_view = top
+    api_patterns = []
+    image_upload_view = ImageUploadView.as_view()
+    image_batch_upload_view = ImageBatchUploadView.as_view()
+    image_detail_view = ImageDetailView.as_view()
+    image_rendition_view = ImageRenditionView.as_view()
+
 urlpatterns = [
-    path('', top, name='top'),
+    path('', top_view, name='top'),
     path('articles/', include('blog.urls')),
     path('admin/', admin.site.urls),
     path('accounts/', include('accounts.urls')),
+    *api_patterns,
     path('api/', include(router.urls)),
-    path('api/image/', ImageUploadView.as_view(), name='image_upload'),
+    path('api/image/', image_upload_view, name='image_upload'),
+    path('api/image/batch/', image_batch_upload_view, name='image_batch_upload'),
+    path('api/image/<int:pk>/', image_detail_view, name='image_detail'),
+    path('api/image/<int:pk>/<int:width>x<int:height>.<str:fmt>', image_rendition_view, name='image_rendition'),
+    # ブラウザからオブジェクトストレージに直接アップロードする
+    path('api/image/uploads/', UploadSessionView.as_view(), name='upload_session'),
+    path('api/image/uploads/<uuid:token>/', UploadSessionDetailView.as_view(), name='upload_session_detail'),
+    path(
+        'api/image/uploads/<uuid:token>/complete/',
+        UploadSessionCompleteView.as_view(),
+        name='upload_session_complete',
+    ),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics', metrics_view, name='metrics'),
 ]
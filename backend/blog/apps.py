@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class BlogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blog'
+
+    def ready(self):
+        # シグナルハンドラを登録する
+        from blog import signals  # noqa: F401
+        # 実行計画を確認するクエリを登録する
+        from blog import query_plans  # noqa: F401
@@ -0,0 +1,177 @@
+"""
+ASGI で動かすときに使う、読み取り系のビューの非同期版 (ASYNC_VIEWS = True のときに URL に登録する)
+
+記事の取得には非同期の ORM を使い、キャッシュに当たった場合はスレッドを使わずに応答する
+書き込み系のリクエストは、同期版の ArticleViewSet をスレッドで実行して処理する
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from blog.cache import (
+    aget_article_header,
+    aget_or_build,
+    article_cache_key,
+    get_article_version,
+)
+from blog.conditional import (
+    acollection_validators,
+    article_validators,
+    page_validators,
+    patch_html_response,
+)
+from blog.filters import ArticleSearchFilter
+from blog.models import Article
+from blog.pagination import InvalidCursor, KeysetPaginator
+from blog.search import get_search_backend
+from blog.serializers import ArticleSerializer
+from blog.views import ArticleViewSet, _build_article_page
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+async def _auser(request):
+    # テンプレートから request.user を参照しても同期の ORM を呼ばないように、先に非同期で読み込んでおく
+    user = await request.auser()
+    request.user = user
+    return user
+
+
+async def top(request):
+    user = await _auser(request)
+    paginator = KeysetPaginator(
+        Article.objects.for_listing(),
+        ordering=('-created_at', '-id'),
+        page_size=settings.ARTICLE_PAGE_SIZE,
+    )
+    try:
+        page = await paginator.apage(request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404("ページが見つかりません。")
+    validators = page_validators(request, page, 'top', user.pk)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return patch_html_response(not_modified)
+    context = {"articles": page, "page": page}
+    response = render(request, "articles/top.html", context)
+    return patch_html_response(validators.apply(response))
+
+
+async def article_detail(request, article_id):
+    user = await _auser(request)
+    header = await aget_article_header(article_id)
+    if header is None:
+        raise Http404("記事が見つかりません。")
+    updated_at, username = header
+    validators = article_validators(request, article_id, updated_at, 'html', user.pk, username)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return patch_html_response(not_modified)
+
+    article = await aget_or_build(
+        article_cache_key(article_id, 'html'),
+        get_article_version(updated_at),
+        lambda: _build_article_page(article_id),
+    )
+    response = render(request, "articles/article_detail.html", {'article': article, 'username': username})
+    return patch_html_response(validators.apply(response))
+
+
+def _json_response(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def _api_view(request, action, **kwargs):
+    """ ArticleViewSet のフィルタやシリアライザを使うために、リクエストを渡したインスタンスを作る """
+    view = ArticleViewSet(action=action, kwargs=kwargs, format_kwarg=None)
+    view.request = Request(request, parsers=view.get_parsers())
+    view.args = ()
+    return view
+
+
+# 書き込み系のリクエストを処理する同期版のビュー
+_sync_list = ArticleViewSet.as_view({'get': 'list', 'post': 'create'})
+_sync_detail = ArticleViewSet.as_view({
+    'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+})
+
+
+def _needs_sync_checks(view, request):
+    """
+    認証・権限の確認を同期版のビューに任せる必要があるかどうか
+    Authorization ヘッダがある (不正なトークンは 401 にする) か、AllowAny 以外の権限があるときは、
+    同期版のビューをスレッドで実行して DRF の initial() (認証・権限・スロットリング) を通す
+    """
+    return 'HTTP_AUTHORIZATION' in request.META or not all(
+        isinstance(permission, AllowAny) for permission in view.get_permissions()
+    )
+
+
+@sync_to_async
+def _run_sync(view, request, **kwargs):
+    # レスポンスの描画 (JSON へのシリアライズ) まで同じスレッドで済ませる
+    return view(request, **kwargs).render()
+
+
+# DRF のビューと同じく、JWT で認証する API なので CSRF の検証は行わない
+@csrf_exempt
+async def article_list(request):
+    """ 記事一覧 API (GET /api/articles/) の非同期版 """
+    if request.method not in SAFE_METHODS:
+        return await _run_sync(_sync_list, request)
+
+    view = _api_view(request, 'list')
+    if _needs_sync_checks(view, request):
+        return await _run_sync(_sync_list, request)
+    if request.GET.get(ArticleSearchFilter.search_param):
+        # 検索の索引があるかどうかの確認 (初回だけクエリを実行する) は同期の ORM を使うので、スレッドで済ませておく
+        await sync_to_async(get_search_backend)()
+    queryset = view.filter_queryset(view.get_queryset())
+    validators = await acollection_validators(view.request, queryset, 'api-list')
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    paginator = view.paginator
+    try:
+        page = await paginator.apaginate_queryset(queryset, view.request, view=view)
+    except APIException as e:
+        return _json_response({'detail': str(e.detail)}, status=e.status_code)
+    serializer = view.get_serializer(page, many=True)
+    data = paginator.get_paginated_response(serializer.data).data
+    return validators.apply(_json_response(data))
+
+
+@csrf_exempt
+async def article_retrieve(request, pk):
+    """ 記事詳細 API (GET /api/articles/<pk>/) の非同期版 """
+    if request.method not in SAFE_METHODS:
+        return await _run_sync(_sync_detail, request, pk=pk)
+
+    view = _api_view(request, 'retrieve', pk=pk)
+    # 絞り込んだ表現 (キャッシュしない) と、認証・権限の確認 (認証で同期の ORM を使う) が必要なリクエストは、
+    # 同期版のビューをスレッドで実行して処理する
+    if view._is_projected() or _needs_sync_checks(view, request):
+        return await _run_sync(_sync_detail, request, pk=pk)
+
+    article = await view.get_queryset().filter(pk=pk).afirst()
+    if article is None:
+        return _json_response({'detail': str(NotFound.default_detail)}, status=404)
+    view.check_object_permissions(view.request, article)
+    validators = article_validators(view.request, article.pk, article.updated_at, 'api')
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    data = await aget_or_build(
+        article_cache_key(article.pk, 'api'),
+        get_article_version(article.updated_at),
+        lambda: dict(ArticleSerializer(Article.objects.get(pk=article.pk)).data),
+    )
+    return validators.apply(_json_response(data))
@@ -0,0 +1,191 @@
+"""
+記事の一括登録 (NDJSON / CSV) と、全件の書き出し
+
+- 一括登録は行を chunk_size 件ずつ検証し、正しい行だけを bulk_create で登録する
+  (チャンクごとにトランザクションを分けるので、途中の行の誤りで全体がやり直しにならない)
+- bulk_create はシグナルを送らないので、本文の HTML の変換・検索の索引・Next.js への再検証の依頼は
+  ここでまとめて行う
+- 書き出しは主キーの順にチャンクずつ読み、1 チャンクずつ文字列にして返すので、件数によらず一定のメモリで済む
+"""
+import csv
+import io
+import itertools
+import json
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import reset_queries, transaction
+from rest_framework import serializers
+
+from app.revalidation import publish_change
+from blog.models import Article
+from blog.rendering import render_into
+from blog.search import index_articles
+from blog.signals import article_revalidation_targets
+
+# 対応する形式と Content-Type
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# 書き出すカラム (created_by は投稿者の ID)
+EXPORT_FIELDS = ('id', 'title', 'abstract', 'body', 'created_by', 'created_at', 'updated_at')
+
+
+class ArticleImportSerializer(serializers.ModelSerializer):
+    """
+    一括登録する 1 行分の検証
+    投稿者はチャンクごとにまとめて存在を確認するので、ここでは ID の形式だけを確認する
+    """
+    created_by = serializers.IntegerField(source='created_by_id', required=False, min_value=1)
+
+    class Meta:
+        model = Article
+        fields = ('title', 'abstract', 'body', 'created_by')
+
+
+@dataclass
+class ImportReport:
+    created: int = 0
+    failed: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, errors):
+        self.failed += 1
+        # エラーの詳細は先頭の ARTICLE_IMPORT_MAX_ERRORS 件だけ返す
+        if len(self.errors) < settings.ARTICLE_IMPORT_MAX_ERRORS:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def as_dict(self):
+        return {'created': self.created, 'failed': self.failed, 'errors': self.errors}
+
+
+def _decoded_lines(stream):
+    # バイト列の行を文字列にする (UTF-8 では改行のバイトが文字の途中に現れないので、行ごとに変換できる)
+    for number, raw in enumerate(stream):
+        line = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        yield line.lstrip('﻿') if number == 0 else line
+
+
+def read_ndjson(stream):
+    """ 1 行に 1 件の JSON オブジェクトを読み、(行番号, データ, エラー) を返す """
+    for line_number, line in enumerate(_decoded_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, {'non_field_errors': ['Invalid JSON: %s' % e]}
+            continue
+        if not isinstance(data, dict):
+            yield line_number, None, {'non_field_errors': ['Expected a JSON object.']}
+            continue
+        yield line_number, data, None
+
+
+def read_csv(stream):
+    """ 1 行目を見出しとする CSV を読み、(行番号, データ, エラー) を返す """
+    reader = csv.DictReader(_decoded_lines(stream))
+    for row in reader:
+        # 見出しより列が多い行は、余った値が None のキーに入る
+        if None in row:
+            yield reader.line_num, None, {'non_field_errors': ['Too many columns.']}
+            continue
+        yield reader.line_num, {k: v for k, v in row.items() if v is not None}, None
+
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv}
+
+
+def _validate(rows, default_user_id, report):
+    """ チャンク内の行を検証し、登録できる記事 (本文は HTML に変換済み) のリストを返す """
+    # ListSerializer と同じように 1 つのシリアライザで全行を検証する (行ごとにフィールドを組み立て直さない)
+    serializer = ArticleImportSerializer()
+    valid = []
+    for line, data, errors in rows:
+        if errors:
+            report.add_error(line, errors)
+            continue
+        try:
+            values = dict(serializer.run_validation(data))
+        except serializers.ValidationError as e:
+            report.add_error(line, e.detail)
+            continue
+        values.setdefault('created_by_id', default_user_id)
+        if values['created_by_id'] is None:
+            report.add_error(line, {'created_by': ['This field is required.']})
+            continue
+        valid.append((line, Article(**values)))
+
+    user_ids = {article.created_by_id for _, article in valid}
+    existing = set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+    articles = []
+    for line, article in valid:
+        if article.created_by_id not in existing:
+            report.add_error(line, {'created_by': ['Invalid pk "%s" - object does not exist.' % article.created_by_id]})
+            continue
+        render_into(article)
+        articles.append(article)
+    return articles
+
+
+def import_articles(rows, default_user_id=None, chunk_size=None):
+    """
+    read_ndjson / read_csv が返す行を一括登録して、ImportReport を返す
+    default_user_id は created_by を指定しない行の投稿者
+    """
+    chunk_size = chunk_size or settings.ARTICLE_IMPORT_CHUNK_SIZE
+    report = ImportReport()
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        articles = _validate(chunk, default_user_id, report)
+        if not articles:
+            continue
+        with transaction.atomic():
+            created = Article.objects.bulk_create(articles)
+            index_articles(created)
+        report.created += len(created)
+        # DEBUG のときに、登録した本文を含む SQL が connection.queries に溜まり続けないようにする
+        if settings.DEBUG:
+            reset_queries()
+
+    if report.created:
+        # 新しい記事には詳細ページのキャッシュがまだないので、一覧だけを作り直してもらう
+        paths, tags = article_revalidation_targets(0)
+        publish_change(paths[:1], tags[:1])
+    return report
+
+
+def iter_export_rows(chunk_size=None):
+    """ 記事を主キーの順に chunk_size 件ずつ読み、行 (辞書) のリストを返す """
+    chunk_size = chunk_size or settings.ARTICLE_EXPORT_CHUNK_SIZE
+    columns = tuple('created_by_id' if name == 'created_by' else name for name in EXPORT_FIELDS)
+    queryset = Article.objects.order_by('pk').values_list(*columns)
+    last_pk = 0
+    while rows := list(queryset.filter(pk__gt=last_pk)[:chunk_size]):
+        yield [dict(zip(EXPORT_FIELDS, row)) for row in rows]
+        last_pk = rows[-1][0]
+
+
+def export_ndjson(chunk_size=None):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for rows in iter_export_rows(chunk_size):
+        yield ''.join(encoder.encode(row) + '\n' for row in rows)
+
+
+def export_csv(chunk_size=None):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for rows in iter_export_rows(chunk_size):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+EXPORTERS = {'ndjson': export_ndjson, 'csv': export_csv}
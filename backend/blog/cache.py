@@ -0,0 +1,128 @@
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from app.metrics import cache_result
+from blog.models import Article
+
+# 記事ごとにキャッシュする表現の種類 (HTML の断片と API の詳細レスポンス)
+ARTICLE_CACHE_VARIANTS = ('html', 'api')
+
+# 同じプロセス内で同じキーを再構築しようとしているスレッドをまとめるためのロック
+_local_locks = weakref.WeakValueDictionary()
+_local_locks_guard = threading.Lock()
+
+
+def get_article_cache():
+    return caches[settings.ARTICLE_CACHE_ALIAS]
+
+
+def article_cache_key(article_id, variant):
+    return 'blog:article:%d:%s' % (int(article_id), variant)
+
+
+def get_article_header(article_id):
+    """
+    記事の (updated_at, 投稿者のユーザー名) だけを 1 クエリで取得する (記事がなければ None)
+    ユーザー名は記事を更新しなくても変わるので、キャッシュには入れずに毎回ここで読む
+    """
+    return (
+        Article.objects.filter(pk=article_id)
+        .values_list('updated_at', 'created_by__username')
+        .first()
+    )
+
+
+async def aget_article_header(article_id):
+    """ get_article_header() の非同期版 """
+    return await (
+        Article.objects.filter(pk=article_id)
+        .values_list('updated_at', 'created_by__username')
+        .afirst()
+    )
+
+
+def get_article_version(updated_at):
+    """ updated_at をキャッシュのバージョン文字列に変換する """
+    return updated_at.isoformat()
+
+
+def _get_local_lock(key):
+    with _local_locks_guard:
+        lock = _local_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _local_locks[key] = lock
+        return lock
+
+
+def _lookup(cache, key, version):
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version:
+        return True, entry[1]
+    return False, None
+
+
+def get_or_build(key, version, builder):
+    """
+    キャッシュから version に一致する値を取り出し、なければ builder() で作り直して保存する
+
+    キャッシュには (version, value) の組を保存しているので、古い版の値が返ることはない。
+    再構築は 1 つのリクエストだけが行い (プロセス内はスレッドロック、プロセス間は cache.add によるロック)、
+    同時に来た他のリクエストはその結果を待って使う。
+    """
+    cache = get_article_cache()
+    hit, value = _lookup(cache, key, version)
+    cache_result('article', hit)
+    if hit:
+        return value
+
+    with _get_local_lock(key):
+        hit, value = _lookup(cache, key, version)
+        if hit:
+            return value
+
+        lock_key = key + ':lock'
+        if cache.add(lock_key, version, settings.ARTICLE_CACHE_LOCK_TIMEOUT):
+            try:
+                value = builder()
+                cache.set(key, (version, value), settings.ARTICLE_CACHE_TIMEOUT)
+            finally:
+                cache.delete(lock_key)
+            return value
+
+        # 別のプロセスが再構築中なので、出来上がるまで少し待つ
+        deadline = time.monotonic() + settings.ARTICLE_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+            hit, value = _lookup(cache, key, version)
+            if hit:
+                return value
+            if cache.get(lock_key) is None:
+                break
+        # 待ちきれなかった場合は自分で作って返す (キャッシュには書き込まない)
+        return builder()
+
+
+async def aget_or_build(key, version, builder):
+    """
+    get_or_build() の非同期版
+    キャッシュに当たった場合はイベントループの上で返し、再構築が必要な場合だけスレッドで get_or_build を実行する
+    """
+    entry = await get_article_cache().aget(key)
+    if entry is not None and entry[0] == version:
+        cache_result('article', True)
+        return entry[1]
+    # 外れた回数は get_or_build で数える
+    return await sync_to_async(get_or_build)(key, version, builder)
+
+
+def invalidate_article(article_id):
+    """ 記事に紐づくキャッシュを全て削除する """
+    get_article_cache().delete_many(
+        [article_cache_key(article_id, variant) for variant in ARTICLE_CACHE_VARIANTS]
+    )
@@ -0,0 +1,101 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+
+class Validators:
+    """
+    ETag と Last-Modified の組
+    本文やテンプレートを読み込む前に計算しておき、条件付き GET なら 304 を返すのに使う
+    """
+
+    def __init__(self, parts, last_modified):
+        digest = hashlib.md5(
+            '|'.join(str(part) for part in parts).encode(), usedforsecurity=False
+        ).hexdigest()
+        self.etag = 'W/"%s"' % digest
+        self.last_modified = int(last_modified.timestamp()) if last_modified else None
+
+    def not_modified(self, request):
+        """ クライアントのキャッシュが最新なら 304 のレスポンスを返す (そうでなければ None) """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        response = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified
+        )
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def apply(self, response):
+        response.headers.setdefault('ETag', self.etag)
+        if self.last_modified and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+
+def _query_string_key(request):
+    # 同じ URL でもクエリパラメータ (カーソルや ?fields= など) が違えば別の表現として扱う
+    return '&'.join('%s=%s' % item for item in sorted(request.GET.lists()))
+
+
+def article_validators(request, article_id, updated_at, variant, *extra):
+    """
+    記事 1 件分の Validators を updated_at から作る
+    ログイン状態などで内容が変わる場合は、その値を extra に渡して ETag に含める
+    """
+    return Validators(
+        (variant, article_id, updated_at.isoformat(), _query_string_key(request)) + extra,
+        updated_at,
+    )
+
+
+def page_validators(request, page, variant, *extra):
+    """
+    一覧の 1 ページ分の Validators を、表示する記事の ID と更新日時・投稿者名、前後のページへのカーソルから作る
+    ページの取得 (1 クエリ) の後、テンプレートを描画する前に使う
+    ページの外の記事を削除しても、このページの表示が変わらなければ ETag も変わらない
+    """
+    return Validators(
+        (variant, _query_string_key(request), page.next_cursor, page.previous_cursor)
+        + tuple(
+            '%s@%s@%s' % (article.pk, article.updated_at.isoformat(), article.created_by.username)
+            for article in page
+        )
+        + extra,
+        None,
+    )
+
+
+def collection_validators(request, queryset, variant, *extra):
+    """
+    記事一覧の Validators を、更新日時の最大値と件数から作る (集計クエリ 1 回)
+    古い記事を削除しても更新日時の最大値は変わらないので、Last-Modified は付けずに
+    件数を含む ETag だけで判定する (If-Modified-Since だけのリクエストには 200 を返す)
+    """
+    summary = queryset.aggregate(last_modified=Max('updated_at'), count=Count('pk'))
+    return _summary_validators(request, summary, variant, *extra)
+
+
+async def acollection_validators(request, queryset, variant, *extra):
+    """ collection_validators() の非同期版 """
+    summary = await queryset.aaggregate(last_modified=Max('updated_at'), count=Count('pk'))
+    return _summary_validators(request, summary, variant, *extra)
+
+
+def _summary_validators(request, summary, variant, *extra):
+    last_modified = summary['last_modified']
+    return Validators(
+        (variant, summary['count'], last_modified.isoformat() if last_modified else '',
+         _query_string_key(request)) + extra,
+        None,
+    )
+
+
+def patch_html_response(response):
+    # HTML はユーザごとに内容が違うので、共有キャッシュには保存させない
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
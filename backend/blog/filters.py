@@ -0,0 +1,17 @@
+from rest_framework.filters import BaseFilterBackend
+
+from blog.search import get_search_backend, parse_query
+
+
+class ArticleSearchFilter(BaseFilterBackend):
+    """
+    クエリパラメータ ?q= に一致する記事だけに絞り込むフィルタ
+    検索用の索引を使って絞り込むので、並び順とページングは他のフィルタやページネーションに任せる
+    """
+    search_param = 'q'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = parse_query(request.query_params.get(self.search_param))
+        if not terms:
+            return queryset
+        return get_search_backend().filter(queryset, terms)
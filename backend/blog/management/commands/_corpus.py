@@ -0,0 +1,45 @@
+import itertools
+import random
+
+from blog.models import Article
+
+# ベンチマーク用の記事を組み立てる語 (日本語の記事に英単語の技術用語が混ざる想定)
+WORDS = (
+    'ブログ', '記事', '検索', '全文検索', '索引', 'データベース', '高速化', '画像', '縮小', '配信',
+    'キャッシュ', 'ページング', '認証', 'トークン', '非同期', 'ワーカー', '設定', '本番環境', '開発環境',
+    '東京', '大阪', '旅行', '料理', '写真', '日記', '読書', '映画', '音楽', '散歩', '天気',
+    'Django', 'Next.js', 'React', 'TypeScript', 'Python', 'SQLite', 'PostgreSQL', 'MinIO', 'Docker', 'API',
+)
+PARTICLES = ('は', 'が', 'を', 'に', 'で', 'と', 'の', 'から', 'まで')
+# 語彙を実際の記事に近い規模にするための、カタカナの音節を組み合わせた造語
+SYLLABLES = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン'
+ENDINGS = ('。', 'です。', 'ました。', 'について書きます。', 'を試しました。')
+
+
+def _vocabulary(rng, size=5000):
+    generated = {''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(3, 5))) for _ in range(size)}
+    return list(WORDS) + sorted(generated)
+
+
+def _sentence(rng, vocabulary, cum_weights):
+    # 出現頻度が Zipf 分布に近くなるように、先頭の語ほど選ばれやすくする
+    words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 6))
+    return ''.join(word + rng.choice(PARTICLES) for word in words[:-1]) + words[-1] + rng.choice(ENDINGS)
+
+
+def iter_article_fields(count, seed=0):
+    """ 日本語の文章からなる記事のフィールド (title, abstract, body の辞書) を count 件分、順に作る """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng)
+    cum_weights = list(itertools.accumulate(1 / (rank + 10) for rank in range(len(vocabulary))))
+    for _ in range(count):
+        yield {
+            'title': ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=3)),
+            'abstract': _sentence(rng, vocabulary, cum_weights),
+            'body': ''.join(_sentence(rng, vocabulary, cum_weights) for _ in range(rng.randint(5, 30))),
+        }
+
+
+def build_articles(count, user, seed=0):
+    """ 日本語の文章からなる記事を count 件分作る (保存はしない) """
+    return [Article(created_by=user, **fields) for fields in iter_article_fields(count, seed)]
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment
+from PIL import Image
+
+from blog.models import Article
+
+from ._corpus import build_articles
+
+# 比較する設定 (ASYNC_VIEWS の値)
+MODES = {'wsgi': '0', 'asgi': '1'}
+
+
+def _percentile(samples, ratio):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * ratio))] * 1000, 2)
+
+
+def _jpeg(size=(800, 600)):
+    buffer = BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = (
+        '1 つのワーカーに記事の一覧・詳細の読み取りと画像のアップロードを同時に送り、'
+        'WSGI (同期のビューをスレッドで処理) と ASGI (ASYNC_VIEWS=1 の非同期のビュー) で'
+        'スループットと p99 のレイテンシを比較する (一時ファイルのデータベースとメモリ上のストレージを使う)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=32, help='同時にリクエストを送るクライアントの数')
+        parser.add_argument('--threads', type=int, default=4, help='WSGI のワーカーがリクエストを処理するスレッド数')
+        parser.add_argument('--duration', type=float, default=10.0, help='1 つの設定あたりの計測時間 (秒)')
+        parser.add_argument('--upload-ratio', type=float, default=0.05, help='リクエストのうち画像のアップロードの割合')
+        parser.add_argument('--storage-latency', type=float, default=0.05,
+                            help='オブジェクトストレージの 1 操作あたりの遅延 (秒)')
+        parser.add_argument('--articles', type=int, default=1000, help='最初に入れておく記事の件数')
+        # 以下はこのコマンドが自分自身を子プロセスとして起動するときに使う
+        parser.add_argument('--role', choices=('seed', 'worker'), help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['role'] == 'seed':
+            return self.seed(options)
+        if options['role'] == 'worker':
+            return self.work(options)
+
+        report = {
+            key: options[key]
+            for key in ('concurrency', 'threads', 'duration', 'upload_ratio', 'storage_latency')
+        }
+        for mode, flag in MODES.items():
+            report[mode] = self.run_mode(flag, options)
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+
+    def _child(self, env, *args):
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+        return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+
+    def run_mode(self, flag, options):
+        """ 新しいデータベースを作り、ASYNC_VIEWS を切り替えたプロセスで負荷をかける """
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                DATABASE_PROFILE='sqlite',
+                SQLITE_PATH=os.path.join(directory, 'bench.sqlite3'),
+                SQLITE_CONCURRENT='1',
+                OBJECT_STORAGE_BACKEND='local',
+                IMAGE_PROCESSING_MODE='sync',
+                ASYNC_VIEWS=flag,
+            )
+            for args in (('migrate', '-v0'), ('bench_asgi', '--role', 'seed',
+                                                '--articles', str(options['articles']))):
+                if self._child(env, *args).wait() != 0:
+                    raise RuntimeError('failed to prepare database: %s' % ' '.join(args))
+            worker = self._child(
+                env, 'bench_asgi', '--role', 'worker',
+                *('--%s=%s' % (key.replace('_', '-'), options[key])
+                  for key in ('concurrency', 'threads', 'duration', 'upload_ratio', 'storage_latency')),
+            )
+            # 結果は最後の行に出力する (それより前の行はビューのログ)
+            result = json.loads(worker.communicate()[0].splitlines()[-1])
+
+        latencies = result['latencies']
+        return {
+            'requests_per_second': round(sum(len(v) for v in latencies.values()) / result['elapsed'], 1),
+            'errors': result['errors'],
+            **{
+                '%s_%s' % (kind, name): _percentile(latencies[kind], ratio)
+                for kind in latencies for name, ratio in (('p50_ms', 0.5), ('p99_ms', 0.99))
+            },
+            'p99_ms': _percentile([s for v in latencies.values() for s in v], 0.99),
+        }
+
+    def seed(self, options):
+        user = get_user_model().objects.create(username='bench-writer')
+        Article.objects.bulk_create(build_articles(options['articles'], user), batch_size=500)
+
+    def work(self, options):
+        from media.local_storage import local_storage
+
+        # テストクライアントのホスト名 (testserver) を許可し、DEBUG のクエリの記録を止める
+        setup_test_environment()
+        local_storage.latency = options['storage_latency']
+        max_id = Article.objects.order_by('-id').values_list('id', flat=True).first()
+        close_old_connections()
+        image = _jpeg()
+        result = {'latencies': {'read': [], 'upload': []}, 'errors': 0}
+
+        def next_request(rng):
+            # (種類, メソッド名, パス, 追加の引数)
+            if rng.random() < options['upload_ratio']:
+                # 末尾に乱数を付けて、重複した画像として扱われないようにする
+                upload = SimpleUploadedFile(
+                    'bench.jpg', image + os.urandom(16), content_type='image/jpeg'
+                )
+                return 'upload', 'post', '/api/image/', {'data': {'title': 'bench', 'image': upload}}
+            if rng.random() < 0.5:
+                return 'read', 'get', '/api/articles/', {}
+            return 'read', 'get', '/api/articles/%d/' % rng.randint(1, max_id), {}
+
+        def record(kind, status_code, started):
+            if status_code < 400:
+                result['latencies'][kind].append(time.perf_counter() - started)
+            else:
+                result['errors'] += 1
+
+        run = self.run_asgi if settings.ASYNC_VIEWS else self.run_wsgi
+        started = time.perf_counter()
+        asyncio.run(run(options, next_request, record))
+        result['elapsed'] = time.perf_counter() - started
+        self.stdout.write(json.dumps(result))
+
+    async def _clients(self, options, send):
+        """ concurrency 個のクライアントが、前の応答を受け取ったらすぐ次のリクエストを送る """
+        deadline = time.perf_counter() + options['duration']
+
+        async def client(n):
+            rng = random.Random(n)
+            while time.perf_counter() < deadline:
+                await send(rng)
+
+        await asyncio.gather(*(client(n) for n in range(options['concurrency'])))
+
+    async def run_wsgi(self, options, next_request, record):
+        # WSGI のワーカー (gunicorn の gthread) と同じく、threads 個のスレッドでリクエストを順に処理する
+        # レイテンシにはスレッドが空くまで待つ時間も含める
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(options['threads'])
+
+        def call(method, path, extra):
+            try:
+                return getattr(Client(), method)(path, **extra).status_code
+            finally:
+                close_old_connections()
+
+        async def send(rng):
+            kind, method, path, extra = next_request(rng)
+            started = time.perf_counter()
+            status_code = await loop.run_in_executor(executor, call, method, path, extra)
+            record(kind, status_code, started)
+
+        try:
+            await self._clients(options, send)
+        finally:
+            executor.shutdown()
+
+    async def run_asgi(self, options, next_request, record):
+        client = AsyncClient()
+
+        async def send(rng):
+            kind, method, path, extra = next_request(rng)
+            started = time.perf_counter()
+            response = await getattr(client, method)(path, **extra)
+            record(kind, response.status_code, started)
+
+        await self._clients(options, send)
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from accounts.tokens import RefreshToken
+from blog import bulk
+from blog.models import Article
+
+from ._corpus import iter_article_fields
+
+
+def _max_rss_mb():
+    # Linux では ru_maxrss の単位は KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Command(BaseCommand):
+    help = (
+        '記事の一括登録と書き出しの速度とメモリを計測する (一時ファイルのデータベースを使う) '
+        '--rows 件の NDJSON を import_articles と同じ処理で登録して全件を書き出し、'
+        '同じ件数を /api/articles/import/ と 1 件ずつの POST で登録した場合と比較する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='一括登録と書き出しに使う件数')
+        parser.add_argument('--http-rows', type=int, default=2000, help='API 経由で登録して比較する件数')
+        parser.add_argument('--chunk-size', type=int, default=settings.ARTICLE_IMPORT_CHUNK_SIZE)
+        # 以下はこのコマンドが自分自身を子プロセスとして起動するときに使う
+        # (段階ごとにプロセスを分けて、それぞれのメモリの最大使用量を計る)
+        parser.add_argument('--role', choices=('import', 'export', 'http'), help=argparse.SUPPRESS)
+        parser.add_argument('--path', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['role']:
+            setup_test_environment()
+            result = getattr(self, 'run_%s' % options['role'])(options)
+            result['max_rss_mb'] = _max_rss_mb()
+            self.stdout.write(json.dumps(result))
+            return
+
+        report = {'rows': options['rows'], 'chunk_size': options['chunk_size']}
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                DATABASE_PROFILE='sqlite',
+                SQLITE_PATH=os.path.join(directory, 'bench.sqlite3'),
+                # 計測中に Next.js への Webhook を送らない
+                REVALIDATION_WEBHOOK_URL='',
+            )
+            path = os.path.join(directory, 'articles.ndjson')
+            self.write_corpus(path, options['rows'])
+            report['ndjson_mb'] = round(os.path.getsize(path) / 2 ** 20, 1)
+
+            self._child(env, 'migrate', '-v0')
+            common = ('--rows', str(options['rows']), '--http-rows', str(options['http_rows']),
+                      '--chunk-size', str(options['chunk_size']), '--path', path)
+            for role in ('import', 'export', 'http'):
+                report[role] = self._child(env, 'bench_bulk_articles', '--role', role, *common)
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+
+    def _child(self, env, *args):
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+        completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True, check=True)
+        lines = completed.stdout.strip().splitlines()
+        # 結果の JSON は最後の行に出力する
+        return json.loads(lines[-1]) if lines else None
+
+    def write_corpus(self, path, rows):
+        with open(path, 'w', encoding='utf-8') as f:
+            for fields in iter_article_fields(rows):
+                f.write(json.dumps(fields, ensure_ascii=False) + '\n')
+
+    def _user(self):
+        user, _ = get_user_model().objects.get_or_create(username='bench-bulk-writer')
+        return user
+
+    def run_import(self, options):
+        """ import_articles コマンドと同じ処理で、ファイルを一括登録する """
+        user = self._user()
+        started = time.perf_counter()
+        with open(options['path'], 'rb') as f:
+            report = bulk.import_articles(bulk.read_ndjson(f), user.pk, options['chunk_size'])
+        elapsed = time.perf_counter() - started
+        return {
+            'created': report.created,
+            'failed': report.failed,
+            'seconds': round(elapsed, 1),
+            'rows_per_second': round(report.created / elapsed, 1),
+        }
+
+    def run_export(self, options):
+        """ /api/articles/export/ の応答を読み捨てながら、全件の書き出しにかかる時間を計る """
+        client = Client(
+            HTTP_AUTHORIZATION='Bearer %s' % RefreshToken.for_user(self._user()).access_token
+        )
+        result = {}
+        for file_format in bulk.EXPORTERS:
+            started = time.perf_counter()
+            response = client.get('/api/articles/export/', {'file_format': file_format})
+            size = rows = 0
+            for chunk in response.streaming_content:
+                size += len(chunk)
+                rows += chunk.count(b'\n')
+            elapsed = time.perf_counter() - started
+            result[file_format] = {
+                'mb': round(size / 2 ** 20, 1),
+                'lines': rows,
+                'seconds': round(elapsed, 1),
+                'rows_per_second': round(Article.objects.count() / elapsed, 1),
+            }
+        return result
+
+    def run_http(self, options):
+        """ 同じ件数を、一括登録の API と 1 件ずつの POST で登録して比べる """
+        user = self._user()
+        client = Client(
+            HTTP_AUTHORIZATION='Bearer %s' % RefreshToken.for_user(user).access_token
+        )
+        with open(options['path'], 'rb') as f:
+            lines = [f.readline() for _ in range(options['http_rows'])]
+
+        started = time.perf_counter()
+        response = client.post(
+            '/api/articles/import/', b''.join(lines), content_type=bulk.CONTENT_TYPES['ndjson']
+        )
+        bulk_elapsed = time.perf_counter() - started
+        assert response.status_code == 200, response.content
+
+        started = time.perf_counter()
+        for line in lines:
+            response = client.post(
+                '/api/articles/', dict(json.loads(line), created_by=user.pk),
+                content_type='application/json',
+            )
+            assert response.status_code == 201, response.content
+        single_elapsed = time.perf_counter() - started
+        return {
+            'rows': len(lines),
+            'bulk_rows_per_second': round(len(lines) / bulk_elapsed, 1),
+            'per_row_post_rows_per_second': round(len(lines) / single_elapsed, 1),
+        }
@@ -0,0 +1,76 @@
+import json
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blog.models import Article
+from blog.search import LikeSearchBackend, get_search_backend, parse_query
+
+from ._corpus import build_articles
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 2),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+    }
+
+
+def _measure(backend, terms, iterations, page_size):
+    # 検索結果の 1 ページ目を表示するときと同じく、件数と先頭のページを取得する
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        count = backend.count(terms)
+        backend.search(terms, 0, page_size)
+        samples.append(time.perf_counter() - started)
+    return dict(_summary(samples), hits=count)
+
+
+class Command(BaseCommand):
+    help = (
+        '生成した記事で、LIKE による部分一致検索と索引を使った全文検索の速さを比較する '
+        '(記事はトランザクション内で作り、最後にロールバックする)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=100000)
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--queries', default='全文検索,PostgreSQL キャッシュ,東京 旅行 写真,日記,非同期ワーカー')
+
+    def handle(self, *args, **options):
+        queries = [q for q in options['queries'].split(',') if q]
+        with transaction.atomic():
+            user = get_user_model().objects.create(username='bench-search-user')
+            started = time.perf_counter()
+            Article.objects.bulk_create(build_articles(options['articles'], user), batch_size=1000)
+            insert_seconds = time.perf_counter() - started
+
+            # bulk_create はシグナルを送らないので、索引はまとめて作り直す
+            indexed = get_search_backend(write=True)
+            started = time.perf_counter()
+            indexed.rebuild()
+            index_seconds = time.perf_counter() - started
+
+            scan = LikeSearchBackend(indexed.using)
+            report = {
+                'articles': options['articles'],
+                'backend': type(indexed).__name__,
+                'insert_seconds': round(insert_seconds, 2),
+                'index_build_seconds': round(index_seconds, 2),
+                'queries': {},
+            }
+            for q in queries:
+                terms = parse_query(q)
+                report['queries'][q] = {
+                    'like_scan': _measure(scan, terms, options['iterations'], options['page_size']),
+                    'index': _measure(indexed, terms, options['iterations'], options['page_size']),
+                }
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
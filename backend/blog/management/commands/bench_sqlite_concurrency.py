@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from blog.models import Article
+
+from ._corpus import build_articles
+
+# 比較する設定 (SQLITE_CONCURRENT の値)
+MODES = {'default': '0', 'concurrent': '1'}
+
+
+def _percentile(samples, ratio):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * ratio))] * 1000, 2)
+
+
+class Command(BaseCommand):
+    help = (
+        '/api/articles/ に読み取りと書き込みを混ぜたリクエストを複数のプロセスから同時に送り、'
+        'SQLite の既定の設定と SQLITE_CONCURRENT=1 の設定でスループットとエラー数を比較する '
+        '(一時ファイルのデータベースを使う)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=10.0, help='1 つの設定あたりの計測時間 (秒)')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='リクエストのうち書き込みの割合')
+        parser.add_argument('--articles', type=int, default=1000, help='最初に入れておく記事の件数')
+        # 以下はこのコマンドが自分自身を子プロセスとして起動するときに使う
+        parser.add_argument('--role', choices=('seed', 'worker'), help=argparse.SUPPRESS)
+        parser.add_argument('--seed', type=int, default=0, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['role'] == 'seed':
+            return self.seed(options)
+        if options['role'] == 'worker':
+            return self.work(options)
+
+        report = {
+            'processes': options['processes'],
+            'duration_seconds': options['duration'],
+            'write_ratio': options['write_ratio'],
+        }
+        for mode, flag in MODES.items():
+            report[mode] = self.run_mode(flag, options)
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+
+    def _child(self, env, *args):
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+        return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+
+    def run_mode(self, flag, options):
+        """ 新しいデータベースを作り、ワーカーのプロセスを同時に起動して結果を集計する """
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                DATABASE_PROFILE='sqlite',
+                SQLITE_PATH=os.path.join(directory, 'bench.sqlite3'),
+                SQLITE_CONCURRENT=flag,
+            )
+            for args in (('migrate', '-v0'), ('bench_sqlite_concurrency', '--role', 'seed',
+                                                '--articles', str(options['articles']))):
+                if self._child(env, *args).wait() != 0:
+                    raise RuntimeError('failed to prepare database: %s' % ' '.join(args))
+
+            workers = [
+                self._child(
+                    env, 'bench_sqlite_concurrency', '--role', 'worker', '--seed', str(n),
+                    '--duration', str(options['duration']), '--write-ratio', str(options['write_ratio']),
+                )
+                for n in range(options['processes'])
+            ]
+            results = [json.loads(worker.communicate()[0]) for worker in workers]
+
+        reads = [s for r in results for s in r['read_latencies']]
+        writes = [s for r in results for s in r['write_latencies']]
+        elapsed = max(r['elapsed'] for r in results)
+        return {
+            'requests_per_second': round((len(reads) + len(writes)) / elapsed, 1),
+            'reads': len(reads),
+            'writes': len(writes),
+            'errors': sum(r['errors'] for r in results),
+            'error_samples': sorted({e for r in results for e in r['error_samples']})[:3],
+            'read_p50_ms': _percentile(reads, 0.5),
+            'read_p99_ms': _percentile(reads, 0.99),
+            'write_p50_ms': _percentile(writes, 0.5),
+            'write_p99_ms': _percentile(writes, 0.99),
+        }
+
+    def seed(self, options):
+        user = get_user_model().objects.create(username='bench-writer')
+        Article.objects.bulk_create(build_articles(options['articles'], user), batch_size=500)
+
+    def work(self, options):
+        rng = random.Random(options['seed'])
+        client = Client(HTTP_HOST='localhost')
+        user_id = get_user_model().objects.values_list('id', flat=True).first()
+        max_id = Article.objects.order_by('-id').values_list('id', flat=True).first()
+        result = {'read_latencies': [], 'write_latencies': [], 'errors': 0, 'error_samples': []}
+
+        started = time.perf_counter()
+        deadline = started + options['duration']
+        while time.perf_counter() < deadline:
+            write = rng.random() < options['write_ratio']
+            request_started = time.perf_counter()
+            try:
+                if write and rng.random() < 0.5:
+                    response = client.post('/api/articles/', {
+                        'title': 'bench %d' % rng.randrange(1 << 30),
+                        'abstract': 'ベンチマーク',
+                        'body': '同時に書き込む記事の本文です。' * 20,
+                        'created_by': user_id,
+                    }, content_type='application/json')
+                elif write:
+                    response = client.patch('/api/articles/%d/' % rng.randint(1, max_id), {
+                        'body': '更新した本文です。' * rng.randint(1, 40),
+                    }, content_type='application/json')
+                elif rng.random() < 0.5:
+                    response = client.get('/api/articles/')
+                else:
+                    response = client.get('/api/articles/%d/' % rng.randint(1, max_id))
+                ok = response.status_code < 500
+            except Exception as e:
+                # "database is locked" はテストクライアントから例外として送出される
+                ok = False
+                if len(result['error_samples']) < 3:
+                    result['error_samples'].append('%s: %s' % (type(e).__name__, e))
+            if ok:
+                key = 'write_latencies' if write else 'read_latencies'
+                result[key].append(time.perf_counter() - request_started)
+            else:
+                result['errors'] += 1
+        result['elapsed'] = time.perf_counter() - started
+        self.stdout.write(json.dumps(result))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.query_plans import explain, get_registered_querysets
+
+
+class Command(BaseCommand):
+    help = (
+        '登録されたよく実行されるクエリの EXPLAIN を表示し、'
+        'テーブル全体の走査やインデックスを使わない並び替えがあれば報告する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='確認するクエリの名前 (省略すると全て)')
+        parser.add_argument('--verbose-plan', action='store_true', help='問題がないクエリの実行計画も表示する')
+
+    def handle(self, *args, **options):
+        registered = get_registered_querysets()
+        names = options['names'] or sorted(registered)
+        unknown = set(names) - set(registered)
+        if unknown:
+            raise CommandError('unknown queryset: %s' % ', '.join(sorted(unknown)))
+
+        failed = []
+        for name in names:
+            hot = registered[name]
+            plan, problems = explain(hot)
+            if problems:
+                failed.append(name)
+                self.stdout.write(self.style.ERROR('NG  %s' % name))
+            else:
+                self.stdout.write(self.style.SUCCESS('OK  %s' % name))
+            if hot.allow:
+                self.stdout.write('    allowed: %s (%s)' % (', '.join(sorted(hot.allow)), hot.reason))
+            for kind, line in problems:
+                self.stdout.write('    %s: %s' % (kind, line))
+            if problems or options['verbose_plan']:
+                for line in plan.splitlines():
+                    self.stdout.write('      | ' + line)
+        if failed:
+            raise CommandError('%d queryset(s) have full scans or filesorts' % len(failed))
@@ -0,0 +1,37 @@
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from app.revalidation import dispatcher
+from blog import bulk
+
+
+class Command(BaseCommand):
+    help = (
+        'NDJSON か CSV のファイル (- なら標準入力) を 1 行 1 記事として一括登録し、'
+        '登録できた件数と誤りのある行を JSON で出力する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=tuple(bulk.READERS), default='ndjson')
+        parser.add_argument('--chunk-size', type=int, help='1 回のトランザクションで登録する件数')
+        parser.add_argument('--user', help='created_by を指定しない行の投稿者のユーザー名')
+
+    def handle(self, *args, **options):
+        user_id = None
+        if options['user']:
+            try:
+                user_id = get_user_model().objects.get_by_natural_key(options['user']).pk
+            except get_user_model().DoesNotExist:
+                raise CommandError('user "%s" does not exist' % options['user'])
+
+        stream = sys.stdin.buffer if options['path'] == '-' else open(options['path'], 'rb')
+        with stream:
+            rows = bulk.READERS[options['format']](stream)
+            report = bulk.import_articles(rows, user_id, options['chunk_size'])
+        # プロセスが終わる前に、Next.js への再検証の依頼を送っておく
+        dispatcher.flush()
+        self.stdout.write(json.dumps(report.as_dict(), indent=2, ensure_ascii=False))
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from app.instrumentation import measure
+from blog.bulk import import_articles
+from blog.models import Article
+
+from ._corpus import iter_article_fields
+from .bench_asgi import _jpeg, _percentile
+
+# 負荷をかけるエンドポイントと、既定の割合
+DEFAULT_MIX = 'top=30,article_detail=30,api_articles=25,token=5,image_upload=10'
+ENDPOINTS = ('top', 'article_detail', 'api_articles', 'token', 'image_upload')
+# 計測用の利用者のパスワード (全員同じ)
+PASSWORD = 'loadtest-pass-0001'
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in filter(None, value.split(',')):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('unknown endpoint: %s (choose from %s)' % (name, ', '.join(ENDPOINTS)))
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('the mix must have a positive weight')
+    return mix
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(samples, elapsed):
+    """ エンドポイントごとの (秒, クエリ数, ステータス) のリストをまとめる """
+    ok = [sample for sample in samples if sample[2] < 400]
+    latencies = [seconds for seconds, _, _ in ok]
+    queries = [count for _, count, _ in samples]
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'requests_per_second': round(len(samples) / elapsed, 1),
+        'p50_ms': _percentile(latencies, 0.5),
+        'p95_ms': _percentile(latencies, 0.95),
+        'p99_ms': _percentile(latencies, 0.99),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'max_queries': max(queries, default=None),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        '利用者・日本語の記事・画像の合成データを入れた一時データベースに対して、'
+        '/、/articles/<id>/、/api/articles/、/api/token/、/api/image/ に指定した同時実行数で負荷をかけ、'
+        'エンドポイントごとのスループット・p50/p95/p99・リクエストあたりのクエリ数を JSON で出力する '
+        '(保存先はメモリ上のストレージ。--seed が同じなら同じデータとリクエストの順になるので、コミット間で比較できる)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help='同時にリクエストを送るクライアント (スレッド) の数')
+        parser.add_argument('--duration', type=float, default=20.0, help='計測する時間 (秒)')
+        parser.add_argument('--warmup', type=int, default=20, help='計測の前に送って結果に含めないリクエストの数')
+        parser.add_argument('--mix', type=_parse_mix, default=_parse_mix(DEFAULT_MIX),
+                            help='エンドポイントと割合 (既定: %s)' % DEFAULT_MIX)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--articles', type=int, default=2000)
+        parser.add_argument('--images', type=int, default=20, help='最初にアップロードしておく画像の枚数')
+        parser.add_argument('--image-size', default='1200x800', help='アップロードする画像の大きさ (幅x高さ)')
+        parser.add_argument('--storage-latency', type=float, default=0.01,
+                            help='オブジェクトストレージの 1 操作あたりの遅延 (秒)')
+        parser.add_argument('--image-processing-mode', choices=('sync', 'async'), default='sync')
+        parser.add_argument('--seed', type=int, default=0, help='データとリクエストの順を決める乱数の種')
+        parser.add_argument('--output', help='結果の JSON を書き出すファイル')
+        parser.add_argument('--baseline', help='比較する以前の結果の JSON (スループットと p95 の変化の割合を出す)')
+        # 以下はこのコマンドが自分自身を子プロセスとして起動するときに使う
+        parser.add_argument('--role', choices=('worker',), help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['role'] == 'worker':
+            return self.work(options)
+
+        report = {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'cpus': os.cpu_count(),
+            'config': {
+                key: options[key]
+                for key in ('concurrency', 'duration', 'warmup', 'mix', 'users', 'articles', 'images',
+                            'image_size', 'storage_latency', 'image_processing_mode', 'seed')
+            },
+            **self.run(options),
+        }
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                report['change'] = self.compare(json.load(baseline), report)
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
+
+    def _child(self, env, *args):
+        command = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+        return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+
+    def run(self, options):
+        """ 一時ファイルのデータベースを作り、別のプロセスで合成データを入れてから負荷をかける """
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                DATABASE_PROFILE='sqlite',
+                SQLITE_PATH=os.path.join(directory, 'loadtest.sqlite3'),
+                SQLITE_CONCURRENT='1',
+                OBJECT_STORAGE_BACKEND='local',
+                IMAGE_PROCESSING_MODE=options['image_processing_mode'],
+                ASYNC_VIEWS='0',
+                REVALIDATION_WEBHOOK_URL='',
+                REQUEST_PROFILE_SAMPLE_RATE='0',
+            )
+            if self._child(env, 'migrate', '-v0').wait() != 0:
+                raise CommandError('failed to migrate the load test database')
+            worker = self._child(
+                env, 'loadtest', '--role', 'worker',
+                '--mix', ','.join('%s=%s' % item for item in options['mix'].items()),
+                *('--%s=%s' % (key.replace('_', '-'), options[key])
+                  for key in ('concurrency', 'duration', 'warmup', 'users', 'articles', 'images',
+                              'image_size', 'storage_latency', 'seed')),
+            )
+            stdout = worker.communicate()[0]
+            if worker.returncode != 0:
+                raise CommandError('the load test worker failed')
+            # 結果は最後の行に出力する (それより前の行はビューのログ)
+            return json.loads(stdout.splitlines()[-1])
+
+    def compare(self, baseline, report):
+        """ 以前の結果からの変化の割合 (1.0 なら同じ。スループットは大きいほど、p95 は小さいほど良い) """
+        change = {}
+        for name, current in report['endpoints'].items():
+            previous = baseline.get('endpoints', {}).get(name)
+            if not previous:
+                continue
+            change[name] = {
+                key: round(current[key] / previous[key], 3) if current[key] and previous[key] else None
+                for key in ('requests_per_second', 'p95_ms', 'queries_per_request')
+            }
+        return change
+
+    def seed(self, options):
+        """ 利用者と記事を入れる (記事は一括登録と同じく、本文の HTML と検索の索引も作る) """
+        # パスワードのハッシュは遅いので 1 回だけ計算して全員で使う
+        password = make_password(PASSWORD)
+        users = get_user_model().objects.bulk_create([
+            get_user_model()(username='loadtest-%d' % n, password=password)
+            for n in range(options['users'])
+        ])
+        # bulk_create で主キーが返らないデータベースに備えて読み直す
+        user_ids = list(get_user_model().objects.filter(username__startswith='loadtest-').values_list('pk', flat=True))
+        rows = (
+            (line, {**fields, 'created_by': user_ids[line % len(user_ids)]}, None)
+            for line, fields in enumerate(iter_article_fields(options['articles'], seed=options['seed']))
+        )
+        report = import_articles(rows)
+        if report.failed:
+            raise CommandError('failed to seed articles: %s' % report.errors[:3])
+        return [user.username for user in users]
+
+    def work(self, options):
+        from media.local_storage import local_storage
+
+        # テストクライアントのホスト名 (testserver) を許可し、DEBUG のクエリの記録を止める
+        setup_test_environment()
+        if options['users'] < 1:
+            raise CommandError('--users must be at least 1')
+        seed_started = time.perf_counter()
+        usernames = self.seed(options)
+        article_ids = list(Article.objects.values_list('pk', flat=True))
+        width, _, height = options['image_size'].partition('x')
+        image = _jpeg((int(width), int(height)))
+
+        client = Client()
+        for n in range(options['images']):
+            client.post('/api/image/', {'title': 'seed-%d' % n, 'image': self._image_file(image)})
+        close_old_connections()
+        seed_seconds = time.perf_counter() - seed_started
+        local_storage.latency = options['storage_latency']
+
+        names = list(options['mix'])
+        weights = [options['mix'][name] for name in names]
+        # 各エンドポイントの (メソッド, パス, 追加の引数) を返す関数
+        requests = {
+            'top': lambda rng: ('get', '/', {}),
+            'article_detail': lambda rng: ('get', '/articles/%d/' % rng.choice(article_ids), {}),
+            'api_articles': lambda rng: ('get', '/api/articles/', {}),
+            'token': lambda rng: ('post', '/api/token/', {
+                'data': {'username': rng.choice(usernames), 'password': PASSWORD},
+            }),
+            'image_upload': lambda rng: ('post', '/api/image/', {
+                'data': {'title': 'loadtest', 'image': self._image_file(image)},
+            }),
+        }
+
+        def send(client, rng):
+            name = rng.choices(names, weights)[0]
+            method, path, extra = requests[name](rng)
+            with measure() as metrics:
+                status_code = getattr(client, method)(path, **extra).status_code
+            return name, metrics.total, metrics.queries, status_code
+
+        rng = random.Random(options['seed'])
+        for _ in range(options['warmup']):
+            send(client, rng)
+        close_old_connections()
+
+        samples = defaultdict(list)
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['duration']
+
+        def run_client(number):
+            client = Client()
+            rng = random.Random('%s-%s' % (options['seed'], number))
+            try:
+                while time.perf_counter() < deadline:
+                    name, seconds, queries, status_code = send(client, rng)
+                    with lock:
+                        samples[name].append((seconds, queries, status_code))
+            finally:
+                close_old_connections()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_client, args=(n,)) for n in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        everything = [sample for values in samples.values() for sample in values]
+        result = {
+            'seed_seconds': round(seed_seconds, 2),
+            'elapsed_seconds': round(elapsed, 2),
+            'total': _summary(everything, elapsed),
+            'endpoints': {name: _summary(samples[name], elapsed) for name in names if samples[name]},
+        }
+        self.stdout.write(json.dumps(result))
+
+    def _image_file(self, image):
+        # 末尾に乱数を付けて、重複した画像として扱われないようにする
+        return SimpleUploadedFile('loadtest.jpg', image + os.urandom(16), content_type='image/jpeg')
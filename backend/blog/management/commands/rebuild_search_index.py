@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blog.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = '全ての記事の検索用の索引を作り直す (bulk_create などシグナルを通らない更新の後に使う)'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = get_search_backend(write=True).rebuild()
+        self.stdout.write('indexed %d article(s)' % count)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+from blog.rendering import render_queryset
+
+
+class Command(BaseCommand):
+    help = (
+        '記事の本文を Markdown から HTML に変換し直す '
+        '(本文が前回の変換から変わった記事だけ。bulk_create で作った記事や、変換の規則を変えたときに使う)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='本文が変わっていない記事も変換し直す')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        rendered = render_queryset(Article.objects.all(), options['force'], options['batch_size'])
+        self.stdout.write('rendered %d articles' % rendered)
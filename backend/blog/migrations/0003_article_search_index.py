@@ -0,0 +1,63 @@
+from django.db import DatabaseError, migrations
+
+# このマイグレーションを作った時点の索引の定義 (blog.search を変えても、ここは変えない)
+FTS_TABLE = 'blog_article_fts'
+PG_TRGM_INDEXES = {
+    'title': 'blog_article_title_trgm',
+    'abstract': 'blog_article_abstract_trgm',
+    'body': 'blog_article_body_trgm',
+}
+
+
+def create_search_index(apps, schema_editor):
+    # SQLite では FTS5 (trigram) の索引テーブルを、PostgreSQL では pg_trgm の GIN インデックスを作る
+    # FTS5 や pg_trgm を使えない環境では何もせず、LIKE による検索になる
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5"
+                    "(title, abstract, body, tokenize='trigram')" % FTS_TABLE
+                )
+        except DatabaseError:
+            # FTS5 (trigram は 3.34 以降) に対応していない SQLite
+            return
+        # 既存の記事を索引に登録する
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO %s (rowid, title, abstract, body) '
+                'SELECT id, title, abstract, body FROM blog_article' % FTS_TABLE
+            )
+            cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (FTS_TABLE, FTS_TABLE))
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for column, name in PG_TRGM_INDEXES.items():
+                # Django の icontains が生成する UPPER("カラム"::text) LIKE UPPER(...) に合わせた式インデックス
+                cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS %s ON blog_article '
+                    'USING gin ((UPPER(%s::text)) gin_trgm_ops)' % (name, column)
+                )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            for name in PG_TRGM_INDEXES.values():
+                cursor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_rename_titlr_article_title'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
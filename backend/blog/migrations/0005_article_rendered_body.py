@@ -0,0 +1,125 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:55
+
+import hashlib
+import html as html_lib
+import math
+import re
+
+import markdown
+import nh3
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+from markdown.extensions.toc import slugify_unicode
+
+# このマイグレーションを作った時点の変換の規則 (RENDERER_VERSION = '1')
+# blog.rendering を変えても、ここは変えない (版を上げたら render_articles で作り直す)
+RENDERER_VERSION = '1'
+RENDERED_FIELDS = ('body_html', 'toc_html', 'word_count', 'reading_time', 'body_hash')
+ALLOWED_TAGS = {
+    'a', 'abbr', 'blockquote', 'br', 'code', 'dd', 'del', 'div', 'dl', 'dt', 'em', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'hr', 'img', 'ins', 'li', 'ol', 'p', 'pre', 'span', 'strong', 'sub', 'sup',
+    'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title', 'class'},
+    'abbr': {'title'},
+    'code': {'class'},
+    'div': {'class'},
+    'img': {'src', 'alt', 'title', 'width', 'height'},
+    'td': {'align', 'style'},
+    'th': {'align', 'style'},
+    **{'h%d' % level: {'id'} for level in range(1, 7)},
+}
+ALLOWED_URL_SCHEMES = {'http', 'https', 'mailto'}
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]')
+WORD_PATTERN = re.compile(r'[^\W぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]+')
+
+
+def _sanitize(html):
+    return nh3.clean(
+        html,
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRIBUTES,
+        url_schemes=ALLOWED_URL_SCHEMES,
+        filter_style_properties={'text-align'},
+        link_rel='noopener noreferrer nofollow',
+    )
+
+
+def _render(converter, article):
+    converter.reset()
+    article.body_html = _sanitize(converter.convert(article.body))
+    article.toc_html = _sanitize(converter.toc) if converter.toc_tokens else ''
+    text = html_lib.unescape(nh3.clean(article.body_html, tags=set()))
+    cjk, words = len(CJK_PATTERN.findall(text)), len(WORD_PATTERN.findall(text))
+    speed = settings.ARTICLE_READING_SPEED
+    article.word_count = cjk + words
+    article.reading_time = math.ceil(cjk / speed['cjk_chars'] + words / speed['words']) if cjk + words else 0
+    article.body_hash = hashlib.sha256(('%s\0%s' % (RENDERER_VERSION, article.body)).encode()).hexdigest()
+
+
+def render_articles(apps, schema_editor):
+    # 既存の記事の本文を HTML に変換しておく
+    converter = markdown.Markdown(
+        extensions=('extra', 'sane_lists', 'toc'),
+        extension_configs={
+            'toc': {'slugify': slugify_unicode, 'permalink': '¶', 'permalink_class': 'headerlink', 'toc_depth': '2-4'},
+        },
+        output_format='html',
+    )
+    Article = apps.get_model('blog', 'Article')
+    manager = Article.objects.db_manager(schema_editor.connection.alias)
+    queryset = manager.only('id', 'body').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:500])
+        if not batch:
+            return
+        now = timezone.now()
+        for article in batch:
+            _render(converter, article)
+            article.updated_at = now
+        manager.bulk_update(batch, (*RENDERED_FIELDS, 'updated_at'))
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0004_article_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='body_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='本文のハッシュ値'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='body_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='本文 (HTML)'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='reading_time',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='読了時間 (分)'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='toc_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='目次 (HTML)'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='文字数'),
+        ),
+        migrations.AlterField(
+            model_name='article',
+            name='body',
+            field=models.TextField(blank=True, help_text='Markdown で記述できます。', verbose_name='記事本文'),
+        ),
+        migrations.RunPython(render_articles, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,58 @@
 from django.conf import settings
 from django.db import models
 
+from blog.rendering import RENDERED_FIELDS, render_into
+
+
+class ArticleQuerySet(models.QuerySet):
+    def for_listing(self):
+        """ 一覧表示に必要なカラム (と ETag に使う更新日時) だけを、投稿者と JOIN して取得する """
+        return self.select_related('created_by').only(
+            'id', 'title', 'created_at', 'updated_at', 'created_by__username'
+        )
+
 
 class Article(models.Model):
     title = models.CharField('記事タイトル', max_length=128)
     abstract = models.TextField('記事概要', blank=True)
-    body = models.TextField('記事本文', blank=True)
+    body = models.TextField('記事本文', blank=True, help_text='Markdown で記述できます。')
+    # 本文を Markdown から変換して無害化した HTML と目次 (本文が変わったときだけ作り直す)
+    body_html = models.TextField('本文 (HTML)', blank=True, editable=False)
+    toc_html = models.TextField('目次 (HTML)', blank=True, editable=False)
+    word_count = models.PositiveIntegerField('文字数', default=0, editable=False)
+    reading_time = models.PositiveIntegerField('読了時間 (分)', default=0, editable=False)
+    body_hash = models.CharField('本文のハッシュ値', max_length=64, blank=True, editable=False)
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         verbose_name='投稿者',
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        # 投稿者で絞り込むクエリは Meta.indexes の複合インデックスを使う
+        db_index=False,
     )
     created_at = models.DateTimeField("投稿日", auto_now_add=True)
     updated_at = models.DateTimeField("更新日", auto_now=True)
 
+    objects = ArticleQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 一覧の並び順 (created_at, id)。昇順・降順のどちらのキーセットページングにも使う
+            models.Index(fields=['created_at', 'id'], name='blog_article_created_idx'),
+            # 投稿者ごとの一覧 (投稿者で絞り込んで新しい順)
+            models.Index(fields=['created_by', 'created_at', 'id'], name='blog_article_author_idx'),
+            # 一覧の条件付き GET で使う最終更新日時 (件数もこのインデックスだけで数えられる)
+            models.Index(fields=['updated_at'], name='blog_article_updated_idx'),
+        ]
+
     def __str__(self):
         return self.title
+
+    def render_body(self, force=False):
+        """ 本文が前回の変換から変わっていれば HTML などを作り直す (作り直したら True を返す) """
+        return render_into(self, force)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None or 'body' in update_fields:
+            if self.render_body() and update_fields is not None:
+                update_fields = {*update_fields, *RENDERED_FIELDS}
+        super().save(*args, update_fields=update_fields, **kwargs)
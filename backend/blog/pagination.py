@@ -0,0 +1,243 @@
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(Exception):
+    """ カーソル文字列を解釈できなかったときに送出する例外 """
+
+
+def encode_cursor(position, reverse=False):
+    """ ソートキーの値のリストを URL に載せられる文字列に変換する関数 """
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in position]
+    payload = json.dumps({'p': values, 'r': int(reverse)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ encode_cursor で作ったカーソル文字列を (ソートキーの値, 逆方向かどうか) に戻す関数 """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, reverse = payload['p'], bool(payload['r'])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values, reverse
+
+
+class KeysetPage:
+    """ KeysetPaginator が返す 1 ページ分の結果 """
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    (created_at, id) のようなソートキーの組でページングを行うクラス
+    OFFSET を使わず「前のページの最後の行より後ろ」を WHERE 句で絞り込むので、
+    何ページ目であっても 1 ページあたり 1 回のクエリで済む
+    """
+
+    def __init__(self, queryset, ordering, page_size):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.page_size = page_size
+        # 降順・昇順は全てのキーで揃えておく (複合インデックスをそのまま使えるようにするため)
+        descending = {field.startswith('-') for field in self.ordering}
+        if len(descending) != 1:
+            raise ValueError('all ordering fields must share the same direction')
+
+    def _field_names(self):
+        return [field.lstrip('-') for field in self.ordering]
+
+    def _position_filter(self, position, forward):
+        """ 指定した位置より後ろ (forward=False なら前) の行を表す Q オブジェクトを作る """
+        descending = self.ordering[0].startswith('-')
+        lookup = 'lt' if descending == forward else 'gt'
+        names = self._field_names()
+        condition = Q()
+        for i, name in enumerate(names):
+            clause = Q(**{'%s__%s' % (name, lookup): position[i]})
+            for prev_name, prev_value in zip(names[:i], position[:i]):
+                clause &= Q(**{prev_name: prev_value})
+            condition |= clause
+        # 先頭のキーの範囲条件を重ねておくと、OR を含んでいてもインデックスを途中から読める
+        head = Q(**{'%s__%se' % (names[0], lookup): position[0]})
+        return head & condition
+
+    def _decode(self, cursor):
+        """ カーソルの値をモデルのフィールドの型に変換する """
+        values, reverse = decode_cursor(cursor)
+        names = self._field_names()
+        if len(values) != len(names):
+            raise InvalidCursor(cursor)
+        position = []
+        for name, value in zip(names, values):
+            field = self.queryset.model._meta.get_field(name)
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                raise InvalidCursor(cursor)
+            if value is None:
+                raise InvalidCursor(cursor)
+            position.append(value)
+        return position, reverse
+
+    def _position_of(self, obj):
+        return [getattr(obj, name) for name in self._field_names()]
+
+    def get_page_queryset(self, position=None, reverse=False):
+        """ 指定した位置から 1 ページ分 (と次のページの有無を判定するための 1 件) を取得する QuerySet """
+        if reverse:
+            ordering = [f[1:] if f.startswith('-') else '-' + f for f in self.ordering]
+        else:
+            ordering = list(self.ordering)
+
+        queryset = self.queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._position_filter(position, forward=not reverse))
+        return queryset[:self.page_size + 1]
+
+    def _parse(self, cursor):
+        if cursor:
+            return self._decode(cursor)
+        return None, False
+
+    def _build_page(self, rows, position, reverse):
+        # 1 件余分に取得して次のページがあるかどうかを判定する
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or reverse:
+                next_cursor = encode_cursor(self._position_of(rows[-1]))
+            if (has_more and reverse) or (position is not None and not reverse):
+                previous_cursor = encode_cursor(self._position_of(rows[0]), reverse=True)
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+    def page(self, cursor=None):
+        """ カーソル文字列に対応するページを取得する """
+        position, reverse = self._parse(cursor)
+        rows = list(self.get_page_queryset(position, reverse))
+        return self._build_page(rows, position, reverse)
+
+    async def apage(self, cursor=None):
+        """ page() の非同期版 (非同期の ORM で取得する) """
+        position, reverse = self._parse(cursor)
+        rows = [obj async for obj in self.get_page_queryset(position, reverse)]
+        return self._build_page(rows, position, reverse)
+
+
+class ArticleCursorPagination(BasePagination):
+    """
+    記事一覧 API 用のカーソル (キーセット) ページネーション
+    OrderingFilter で指定された並び順の末尾に id を足したものをソートキーとして使う
+    """
+    cursor_query_param = 'cursor'
+    page_size = None
+    default_ordering = ('created_at', 'id')
+
+    def get_page_size(self, request):
+        return self.page_size or settings.ARTICLE_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = None
+        for backend in getattr(view, 'filter_backends', ()):
+            if hasattr(backend, 'get_ordering'):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        if not ordering:
+            return self.default_ordering
+
+        # 先頭のキーの向きに合わせて id をタイブレーカーとして付け足す
+        head = ordering[0]
+        if head.lstrip('-') == 'id':
+            return (head,)
+        return (head, '-id' if head.startswith('-') else 'id')
+
+    def _get_paginator(self, queryset, request, view):
+        self.request = request
+        self.ordering = self.get_ordering(request, queryset, view)
+        return KeysetPaginator(queryset, self.ordering, self.get_page_size(request))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        paginator = self._get_paginator(queryset, request, view)
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return list(self.page)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """ paginate_queryset() の非同期版 """
+        paginator = self._get_paginator(queryset, request, view)
+        try:
+            self.page = await paginator.apage(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return list(self.page)
+
+    def _build_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self._build_link(self.page.next_cursor),
+            'previous': self._build_link(self.page.previous_cursor),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ArticleSearchPagination(PageNumberPagination):
+    """
+    記事の検索結果用のページネーション
+    関連度順の結果はキーセットで区切れないので、ページ番号 (OFFSET) で区切る
+    """
+    page_size = None
+
+    def get_page_size(self, request):
+        return self.page_size or settings.ARTICLE_PAGE_SIZE
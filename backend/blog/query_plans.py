@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from app.query_plans import aggregate_queryset, register_queryset
+from blog.models import Article
+from blog.pagination import KeysetPaginator
+from blog.serializers import ArticleSummarySerializer
+
+# 実行計画を確認するときに使う、適当な値 (実行計画は値によらない)
+SAMPLE_ID = 1
+
+
+def _top_paginator():
+    return KeysetPaginator(
+        Article.objects.for_listing(),
+        ordering=('-created_at', '-id'),
+        page_size=settings.ARTICLE_PAGE_SIZE,
+    )
+
+
+@register_queryset('blog.top.first_page')
+def top_first_page():
+    # トップページ (新しい順の 1 ページ目)
+    return _top_paginator().get_page_queryset()
+
+
+@register_queryset('blog.top.next_page')
+def top_next_page():
+    # トップページの 2 ページ目以降 (カーソルの位置より古い記事)
+    return _top_paginator().get_page_queryset([timezone.now(), SAMPLE_ID])
+
+
+@register_queryset('blog.api.list')
+def api_list():
+    # 記事一覧 API (既定の並び順は created_at, id の昇順)
+    columns = set(ArticleSummarySerializer.Meta.fields) | {'id', 'created_at'}
+    paginator = KeysetPaginator(
+        Article.objects.only(*columns), ('created_at', 'id'), settings.ARTICLE_PAGE_SIZE
+    )
+    return paginator.get_page_queryset([timezone.now(), SAMPLE_ID])
+
+
+@register_queryset('blog.author.list')
+def author_list():
+    # 投稿者ごとの記事一覧 (新しい順)
+    paginator = KeysetPaginator(
+        Article.objects.for_listing().filter(created_by_id=SAMPLE_ID),
+        ('-created_at', '-id'),
+        settings.ARTICLE_PAGE_SIZE,
+    )
+    return paginator.get_page_queryset([timezone.now(), SAMPLE_ID])
+
+
+@register_queryset('blog.detail.updated_at')
+def detail_updated_at():
+    # 記事詳細の条件付き GET とキャッシュのバージョンに使う更新日時
+    return Article.objects.filter(pk=SAMPLE_ID).values_list('updated_at', flat=True)[:1]
+
+
+@register_queryset('blog.detail')
+def detail():
+    # 記事詳細 (投稿者を JOIN して 1 件取得する)
+    return Article.objects.select_related('created_by').filter(pk=SAMPLE_ID)
+
+
+@register_queryset(
+    'blog.collection.validators',
+    allow=('full_scan',),
+    reason='一覧の ETag のために件数を数えるので、全件をたどるのは避けられない (インデックスだけで済ませる)',
+)
+def collection_validators():
+    # 一覧 API の条件付き GET に使う、最終更新日時と件数
+    return aggregate_queryset(
+        Article.objects.all(), last_modified=Max('updated_at'), count=Count('pk')
+    )
@@ -0,0 +1,151 @@
+"""
+記事の本文 (Markdown) を、保存するときに一度だけ HTML に変換する仕組み
+
+- Markdown を HTML に変換し、見出しにアンカー (id と ¶ のリンク) を付けて目次を作る
+- 本文に直接書かれた HTML も含めて、許可したタグと属性だけを残すように無害化する
+- 文字数と読了時間 (分) を数える
+"""
+import hashlib
+import html as html_lib
+import math
+import re
+import threading
+from dataclasses import dataclass
+
+import markdown
+import nh3
+from django.conf import settings
+from django.utils import timezone
+from markdown.extensions.toc import slugify_unicode
+
+# 出力の形式や無害化の規則を変えたときは上げて、render_articles で作り直す
+RENDERER_VERSION = '1'
+
+# 本文から作る (保存時に自動で更新する) フィールド
+RENDERED_FIELDS = ('body_html', 'toc_html', 'word_count', 'reading_time', 'body_hash')
+
+MARKDOWN_EXTENSIONS = ('extra', 'sane_lists', 'toc')
+MARKDOWN_EXTENSION_CONFIGS = {
+    'toc': {
+        # 日本語の見出しからもアンカーの id を作る
+        'slugify': slugify_unicode,
+        'permalink': '¶',
+        'permalink_class': 'headerlink',
+        'toc_depth': '2-4',
+    },
+}
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'blockquote', 'br', 'code', 'dd', 'del', 'div', 'dl', 'dt', 'em', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'hr', 'img', 'ins', 'li', 'ol', 'p', 'pre', 'span', 'strong', 'sub', 'sup',
+    'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title', 'class'},
+    'abbr': {'title'},
+    'code': {'class'},
+    'div': {'class'},
+    'img': {'src', 'alt', 'title', 'width', 'height'},
+    # 表の列の揃え (style は text-align だけを残す)
+    'td': {'align', 'style'},
+    'th': {'align', 'style'},
+    **{'h%d' % level: {'id'} for level in range(1, 7)},
+}
+ALLOWED_URL_SCHEMES = {'http', 'https', 'mailto'}
+
+# 日本語 (かな・漢字) は 1 文字ずつ、それ以外は空白などで区切られた語を数える
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]')
+WORD_PATTERN = re.compile(r'[^\W぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]+')
+
+
+@dataclass(frozen=True)
+class RenderedBody:
+    html: str
+    toc_html: str
+    word_count: int
+    reading_time: int
+
+
+def body_hash(body):
+    """ 本文と変換の版から作るハッシュ値 (これが変わったときだけ HTML を作り直す) """
+    return hashlib.sha256(('%s\0%s' % (RENDERER_VERSION, body)).encode()).hexdigest()
+
+
+def sanitize_html(html):
+    return nh3.clean(
+        html,
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRIBUTES,
+        url_schemes=ALLOWED_URL_SCHEMES,
+        filter_style_properties={'text-align'},
+        link_rel='noopener noreferrer nofollow',
+    )
+
+
+def count_words(text):
+    """ (日本語の文字数 + それ以外の語数, 読了時間の分) を返す """
+    cjk = len(CJK_PATTERN.findall(text))
+    words = len(WORD_PATTERN.findall(text))
+    speed = settings.ARTICLE_READING_SPEED
+    minutes = cjk / speed['cjk_chars'] + words / speed['words']
+    return cjk + words, math.ceil(minutes) if cjk + words else 0
+
+
+_local = threading.local()
+
+
+def _get_converter():
+    # Markdown のインスタンスは作るのに変換と同じくらいの時間がかかるので、スレッドごとに使い回す
+    converter = getattr(_local, 'converter', None)
+    if converter is None:
+        converter = _local.converter = markdown.Markdown(
+            extensions=MARKDOWN_EXTENSIONS,
+            extension_configs=MARKDOWN_EXTENSION_CONFIGS,
+            output_format='html',
+        )
+    return converter.reset()
+
+
+def render_markdown(body):
+    converter = _get_converter()
+    html = sanitize_html(converter.convert(body))
+    # 見出しが 1 つもなければ目次は出さない
+    toc_html = sanitize_html(converter.toc) if converter.toc_tokens else ''
+    word_count, reading_time = count_words(html_lib.unescape(nh3.clean(html, tags=set())))
+    return RenderedBody(html, toc_html, word_count, reading_time)
+
+
+def render_into(article, force=False):
+    """ 記事の本文が前回の変換から変わっていれば、HTML などのフィールドを作り直す (作り直したら True を返す) """
+    digest = body_hash(article.body)
+    if digest == article.body_hash and not force:
+        return False
+    rendered = render_markdown(article.body)
+    article.body_html = rendered.html
+    article.toc_html = rendered.toc_html
+    article.word_count = rendered.word_count
+    article.reading_time = rendered.reading_time
+    article.body_hash = digest
+    return True
+
+
+def render_queryset(queryset, force=False, batch_size=500):
+    """
+    QuerySet の記事の HTML を、必要なものだけ batch_size 件ずつ作り直して保存する (作り直した件数を返す)
+    bulk_create で作った記事や、RENDERER_VERSION を上げたときに使う
+    """
+    queryset = queryset.only('id', 'body', 'body_hash').order_by('pk')
+    rendered = 0
+    last_pk = None
+    while True:
+        batch = list((queryset.filter(pk__gt=last_pk) if last_pk else queryset)[:batch_size])
+        if not batch:
+            return rendered
+        changed = [article for article in batch if render_into(article, force)]
+        # bulk_update はシグナルを送らないので、更新日時を進めて記事のキャッシュと ETag を新しい版にする
+        now = timezone.now()
+        for article in changed:
+            article.updated_at = now
+        queryset.model.objects.bulk_update(changed, (*RENDERED_FIELDS, 'updated_at'))
+        rendered += len(changed)
+        last_pk = batch[-1].pk
@@ -0,0 +1,330 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from blog.models import Article
+
+# SQLite の全文検索用のテーブル (FTS5)。rowid に記事の id を入れる
+FTS_TABLE = 'blog_article_fts'
+# 検索するカラム
+SEARCH_COLUMNS = ('title', 'abstract', 'body')
+# bm25 でスコアを計算するときのカラムごとの重み (タイトルに一致した記事を上位にする)
+SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+# trigram トークナイザは 3 文字未満の語を索引から引けない
+MIN_INDEXED_TERM_LENGTH = 3
+# スニペットの前後に含める文字数
+SNIPPET_CONTEXT = 40
+
+# スニペットの強調部分を示す印 (本文に現れない制御文字を使い、エスケープした後で <mark> に置き換える)
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+# PostgreSQL で部分一致検索に使う pg_trgm の GIN インデックス
+# Django の icontains が生成する UPPER("カラム"::text) LIKE UPPER(...) に合わせて式インデックスにする
+PG_TRGM_INDEXES = {
+    column: 'blog_article_%s_trgm' % column for column in SEARCH_COLUMNS
+}
+
+
+def parse_query(q):
+    """ 検索文字列を空白 (全角の空白を含む) で区切った語のリストにする (重複は除く) """
+    terms = []
+    for term in (q or '').split():
+        if term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms
+
+
+def highlight(text, terms, context=SNIPPET_CONTEXT):
+    """
+    text のうち最初に語が現れる位置の前後を切り出し、語を <mark> で囲んだ HTML を返す
+    語が現れない場合は先頭から切り出す
+    """
+    text = text or ''
+    if not terms:
+        return escape(text[:context * 2])
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, match.start() - context) if match else 0
+    end = min(len(text), (match.end() if match else 0) + context)
+    fragment = pattern.sub(lambda m: _MARK_START + m.group(0) + _MARK_END, text[start:end])
+    return _render_marks(
+        ('…' if start > 0 else '') + fragment + ('…' if end < len(text) else '')
+    )
+
+
+def _render_marks(text):
+    """ 印を付けたテキストをエスケープして、印を <mark> タグに置き換える """
+    return escape(text).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _like_filter(terms):
+    """ 全ての語をいずれかのカラムに含む記事を表す Q オブジェクト """
+    condition = Q()
+    for term in terms:
+        term_condition = Q()
+        for column in SEARCH_COLUMNS:
+            term_condition |= Q(**{'%s__icontains' % column: term})
+        condition &= term_condition
+    return condition
+
+
+def _snippet_source(article, terms):
+    """ スニペットを切り出すカラムの値 (語を含む最初のカラム、なければ概要) """
+    lowered = [term.lower() for term in terms]
+    for column in ('body', 'abstract', 'title'):
+        value = getattr(article, column) or ''
+        if any(term in value.lower() for term in lowered):
+            return value
+    return article.abstract or article.body
+
+
+class SearchResults:
+    """
+    検索結果の遅延評価されるシーケンス
+    Django の Paginator に渡すと、件数の取得とページ分の取得がそれぞれ 1 回のクエリになる
+    """
+
+    def __init__(self, backend, terms):
+        self.backend = backend
+        self.terms = terms
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.terms) if self.terms else 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        if index.stop is None or not self.terms:
+            return []
+        return self.backend.search(self.terms, start, index.stop - start)
+
+
+class LikeSearchBackend:
+    """
+    索引を使わない部分一致検索 (全文検索の索引がないデータベース用)
+    新しい記事ほど上位に並べ、スニペットは Python で切り出す
+    """
+    vendor = None
+
+    def __init__(self, using):
+        self.using = using
+
+    def filter(self, queryset, terms):
+        return queryset.filter(_like_filter(terms))
+
+    def count(self, terms):
+        return Article.objects.using(self.using).filter(_like_filter(terms)).count()
+
+    def search(self, terms, offset, limit):
+        articles = list(
+            Article.objects.using(self.using).select_related('created_by')
+            .filter(_like_filter(terms)).order_by('-created_at', '-id')[offset:offset + limit]
+        )
+        for article in articles:
+            article.search_rank = None
+            article.search_snippet = highlight(_snippet_source(article, terms), terms)
+        return articles
+
+    # 索引を持たないので、記事の保存・削除時には何もしない
+    def index(self, article):
+        pass
+
+    def index_many(self, articles):
+        pass
+
+    def remove(self, article_id):
+        pass
+
+    def rebuild(self):
+        return 0
+
+
+class SQLiteSearchBackend(LikeSearchBackend):
+    """
+    SQLite の FTS5 (trigram トークナイザ) を使った全文検索
+    trigram は 3 文字ずつの部分文字列で索引を作るので、分かち書きをしなくても日本語を検索できる
+    3 文字未満の語は索引から引けないため、索引のテーブルに対する LIKE で絞り込む
+    """
+    vendor = 'sqlite'
+
+    def _match(self, terms):
+        """ 索引で引ける語の MATCH 式と、それ以外の語の LIKE 条件 (SQL とパラメータ) を作る """
+        indexed = [t for t in terms if len(t) >= MIN_INDEXED_TERM_LENGTH]
+        short = [t for t in terms if len(t) < MIN_INDEXED_TERM_LENGTH]
+        where, params = [], []
+        if indexed:
+            where.append('%s MATCH %%s' % FTS_TABLE)
+            params.append(' '.join('"%s"' % t.replace('"', '""') for t in indexed))
+        for term in short:
+            like = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where.append('(%s)' % ' OR '.join(
+                "%s LIKE %%s ESCAPE '\\'" % column for column in SEARCH_COLUMNS
+            ))
+            params.extend([like] * len(SEARCH_COLUMNS))
+        return ' AND '.join(where), params, bool(indexed)
+
+    def filter(self, queryset, terms):
+        where, params, _ = self._match(terms)
+        return queryset.filter(
+            id__in=RawSQL('SELECT rowid FROM %s WHERE %s' % (FTS_TABLE, where), params)
+        )
+
+    def count(self, terms):
+        where, params, _ = self._match(terms)
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM %s WHERE %s' % (FTS_TABLE, where), params)
+            return cursor.fetchone()[0]
+
+    def search(self, terms, offset, limit):
+        where, params, ranked = self._match(terms)
+        if ranked:
+            # bm25 は小さいほど関連度が高い。スニペットは一致が最も多いカラムから切り出す
+            sql = (
+                "SELECT rowid, bm25(%s, %s), snippet(%s, -1, '%s', '%s', '…', 24) "
+                'FROM %s WHERE %s ORDER BY 2, rowid DESC LIMIT %%s OFFSET %%s' % (
+                    FTS_TABLE, ', '.join(str(w) for w in SEARCH_WEIGHTS),
+                    FTS_TABLE, _MARK_START, _MARK_END, FTS_TABLE, where,
+                )
+            )
+        else:
+            sql = 'SELECT rowid, NULL, NULL FROM %s WHERE %s ORDER BY rowid DESC LIMIT %%s OFFSET %%s' % (
+                FTS_TABLE, where,
+            )
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params + [limit, offset])
+            rows = cursor.fetchall()
+
+        ids = [row[0] for row in rows]
+        articles = Article.objects.using(self.using).select_related('created_by').in_bulk(ids)
+        results = []
+        for article_id, rank, snippet in rows:
+            article = articles.get(article_id)
+            if article is None:
+                continue
+            article.search_rank = -rank if rank is not None else None
+            if snippet is not None:
+                article.search_snippet = _render_marks(snippet)
+            else:
+                article.search_snippet = highlight(_snippet_source(article, terms), terms)
+            results.append(article)
+        return results
+
+    def index(self, article):
+        """ 記事 1 件分の索引を作り直す """
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [article.pk])
+            cursor.execute(
+                'INSERT INTO %s (rowid, title, abstract, body) VALUES (%%s, %%s, %%s, %%s)' % FTS_TABLE,
+                [article.pk, article.title, article.abstract, article.body],
+            )
+
+    def index_many(self, articles):
+        """ 複数の記事の索引をまとめて作り直す (一括登録した記事に使う) """
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(
+                'DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [[article.pk] for article in articles]
+            )
+            cursor.executemany(
+                'INSERT INTO %s (rowid, title, abstract, body) VALUES (%%s, %%s, %%s, %%s)' % FTS_TABLE,
+                [[article.pk, article.title, article.abstract, article.body] for article in articles],
+            )
+
+    def remove(self, article_id):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [article_id])
+
+    def rebuild(self):
+        """ 全ての記事の索引を作り直して、索引に入れた件数を返す """
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % FTS_TABLE)
+            cursor.execute(
+                'INSERT INTO %s (rowid, title, abstract, body) '
+                'SELECT id, title, abstract, body FROM blog_article' % FTS_TABLE
+            )
+            cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (FTS_TABLE, FTS_TABLE))
+            cursor.execute('SELECT count(*) FROM %s' % FTS_TABLE)
+            return cursor.fetchone()[0]
+
+
+class PostgreSQLSearchBackend(LikeSearchBackend):
+    """
+    PostgreSQL の pg_trgm を使った検索
+    icontains による部分一致を GIN (gin_trgm_ops) インデックスで引き、trigram の類似度で並べる
+    索引は PostgreSQL が更新するので、記事の保存・削除時には何もしない
+    """
+    vendor = 'postgresql'
+
+    def search(self, terms, offset, limit):
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        q = ' '.join(terms)
+        rank = sum(
+            (TrigramWordSimilarity(q, column) * weight for column, weight in zip(SEARCH_COLUMNS, SEARCH_WEIGHTS)),
+        )
+        articles = list(
+            Article.objects.using(self.using).select_related('created_by')
+            .filter(_like_filter(terms)).annotate(search_rank=rank)
+            .order_by('-search_rank', '-id')[offset:offset + limit]
+        )
+        for article in articles:
+            article.search_snippet = highlight(_snippet_source(article, terms), terms)
+        return articles
+
+
+_fts_tables = {}
+
+
+def has_fts_table(connection):
+    """ FTS5 の索引テーブルが作成済みかどうか (データベースごとに 1 回だけ確認する) """
+    key = (connection.alias, connection.settings_dict['NAME'])
+    if key not in _fts_tables:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+            )
+            _fts_tables[key] = cursor.fetchone() is not None
+    return _fts_tables[key]
+
+
+def reset_fts_tables():
+    """ 索引テーブルの有無の確認結果を捨てる (マイグレーションで作成・削除した後に呼ぶ) """
+    _fts_tables.clear()
+
+
+def get_search_backend(write=False):
+    """ 記事を保存しているデータベースに合った検索バックエンドを返す """
+    using = router.db_for_write(Article) if write else router.db_for_read(Article)
+    connection = connections[using]
+    if connection.vendor == 'sqlite' and has_fts_table(connection):
+        return SQLiteSearchBackend(using)
+    if connection.vendor == 'postgresql':
+        return PostgreSQLSearchBackend(using)
+    return LikeSearchBackend(using)
+
+
+def search_articles(q):
+    """ 検索文字列に一致する記事を、関連度の高い順に並べた SearchResults を返す """
+    return SearchResults(get_search_backend(), parse_query(q))
+
+
+def index_article(article):
+    get_search_backend(write=True).index(article)
+
+
+def index_articles(articles):
+    get_search_backend(write=True).index_many(articles)
+
+
+def remove_article(article_id):
+    get_search_backend(write=True).remove(article_id)
@@ -1,8 +1,68 @@
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
 from .models import Article
 
 
-class ArticleSerializer(serializers.ModelSerializer):
+def _split_param(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class FieldProjectionMixin:
+    """
+    クエリパラメータ ?fields= / ?omit= で、レスポンスに含めるフィールドを絞り込む Mixin
+    GET などの読み取り系リクエストのときだけ有効になる
+    """
+    fields_query_param = 'fields'
+    omit_query_param = 'omit'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return
+
+        requested = request.query_params.get(self.fields_query_param)
+        omitted = request.query_params.get(self.omit_query_param)
+        keep = set(self.fields)
+        if requested:
+            keep &= _split_param(requested)
+        if omitted:
+            keep -= _split_param(omitted)
+        for name in set(self.fields) - keep:
+            self.fields.pop(name)
+
+    def get_model_columns(self):
+        """ 残ったフィールドを返すのに必要なモデルのカラム名 (QuerySet.only に渡す値) を返す """
+        columns = set()
+        for field in self.fields.values():
+            source = field.source.split('.')[0]
+            if source == '*':
+                continue
+            columns.add(source)
+        return columns
+
+
+class ArticleSerializer(FieldProjectionMixin, serializers.ModelSerializer):
+    """ body は Markdown の原文、body_html と toc_html は保存時に変換・無害化した HTML """
     class Meta:
         model = Article
-        fields = ('title', 'abstract', 'body', 'created_by', 'created_at', 'updated_at')
\ No newline at end of file
+        fields = (
+            'title', 'abstract', 'body', 'body_html', 'toc_html', 'word_count', 'reading_time',
+            'created_by', 'created_at', 'updated_at',
+        )
+
+
+class ArticleSummarySerializer(FieldProjectionMixin, serializers.ModelSerializer):
+    """ 記事一覧用の軽量なシリアライザ (本文と概要は返さない) """
+    class Meta:
+        model = Article
+        fields = ('id', 'title', 'reading_time', 'created_by', 'created_at', 'updated_at')
+
+
+class ArticleSearchResultSerializer(ArticleSummarySerializer):
+    """ 検索結果用のシリアライザ (関連度のスコアと、一致した部分を <mark> で囲んだ HTML を返す) """
+    rank = serializers.FloatField(source='search_rank', read_only=True, allow_null=True)
+    snippet = serializers.CharField(source='search_snippet', read_only=True)
+
+    class Meta(ArticleSummarySerializer.Meta):
+        fields = ArticleSummarySerializer.Meta.fields + ('rank', 'snippet')
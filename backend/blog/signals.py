@@ -0,0 +1,45 @@
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from app.revalidation import publish_change
+from blog.cache import invalidate_article
+from blog.models import Article
+from blog.search import SEARCH_COLUMNS, index_article, remove_article, reset_fts_tables
+
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+def invalidate_article_cache(sender, instance, **kwargs):
+    # 記事が保存・削除されたら、その記事のキャッシュを破棄する
+    invalidate_article(instance.pk)
+
+
+@receiver(post_save, sender=Article)
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    # 検索対象のカラムが変わったときだけ、その記事の索引を作り直す
+    if update_fields is not None and not set(update_fields) & set(SEARCH_COLUMNS):
+        return
+    index_article(instance)
+
+
+@receiver(post_delete, sender=Article)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_article(instance.pk)
+
+
+@receiver(post_migrate)
+def reset_search_index_state(sender, **kwargs):
+    # マイグレーションで索引テーブルを作成・削除したら、次の検索でもう一度確認する
+    reset_fts_tables()
+
+
+def article_revalidation_targets(article_id):
+    """ 記事が変わったときに Next.js で作り直すパスとタグ """
+    return ('/', '/articles/%d' % article_id), ('articles', 'article:%d' % article_id)
+
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+def revalidate_article(sender, instance, **kwargs):
+    paths, tags = article_revalidation_targets(instance.pk)
+    publish_change(paths, tags)
@@ -1,10 +1,47 @@
-from django.test import TestCase, Client, RequestFactory
+import asyncio
+import contextvars
+import http.server
+import json
+import os
+import pstats
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    AsyncRequestFactory, TestCase, TransactionTestCase, Client, RequestFactory, override_settings,
+)
 from django.urls import resolve
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.http import http_date
+from django.test.utils import CaptureQueriesContext
+from prometheus_client import REGISTRY
 from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import BasePermission
 from rest_framework.test import APIClient, APITestCase
 
+from app.instrumentation import RequestInstrumentationMiddleware, measure
+from app.testing import BudgetTestMixin
+from app.db_routers import PrimaryReplicaRouter, ReplicaStickinessMiddleware, is_pinned_to_primary
+from app.revalidation import SECRET_HEADER, dispatcher
+from app.query_plans import HotQuerySet, explain, get_registered_querysets
+from blog import async_views
+from blog.bulk import import_articles
+from blog.cache import article_cache_key, get_article_cache, get_or_build
 from blog.models import Article
+from blog.rendering import RENDERER_VERSION, render_markdown, render_queryset
+from blog.search import LikeSearchBackend, SQLiteSearchBackend, get_search_backend, highlight
 from blog.views import (
     top,
     article_new,
@@ -43,6 +80,51 @@ class TopPageTest(TestCase):
         self.assertContains(response, self.user.username)
 
 
+class TopPagePaginationTest(TestCase):
+    def setUp(self):
+        self.users = [
+            UserModel.objects.create(username="user_%d" % i, email="user%d@example.com" % i)
+            for i in range(3)
+        ]
+        for i in range(7):
+            Article.objects.create(
+                title="title_%d" % i, body="body", created_by=self.users[i % 3]
+            )
+
+    @override_settings(ARTICLE_PAGE_SIZE=3)
+    def test_should_walk_pages_newest_first(self):
+        titles, cursor = [], None
+        while True:
+            response = self.client.get("/", {"cursor": cursor} if cursor else {})
+            page = response.context["page"]
+            titles += [article.title for article in page]
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(titles, ["title_%d" % i for i in reversed(range(7))])
+
+    @override_settings(ARTICLE_PAGE_SIZE=3)
+    def test_previous_cursor_returns_previous_page(self):
+        first = self.client.get("/").context["page"]
+        second = self.client.get("/", {"cursor": first.next_cursor}).context["page"]
+        back = self.client.get("/", {"cursor": second.previous_cursor}).context["page"]
+        self.assertEqual(
+            [a.pk for a in back], [a.pk for a in first]
+        )
+        self.assertTrue(back.has_next)
+
+    def test_should_use_single_query_regardless_of_authors(self):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        # 投稿者の数によらず、記事一覧の取得は 1 クエリで済むこと
+        with self.assertNumQueries(1):
+            top(request)
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get("/", {"cursor": "broken"})
+        self.assertEqual(response.status_code, 404)
+
+
 class CreateArticleTest(TestCase):
     def setUp(self):
         self.user = UserModel.objects.create(
@@ -86,6 +168,270 @@ class ArticleDetailTest(TestCase):
         response = self.client.get("/articles/%s/" % self.article.id)
         self.assertContains(response, self.article.title, status_code=200)
 
+    def test_should_render_markdown_body(self):
+        self.article.body = "## 見出し\n\n**強調**と<script>alert(1)</script>"
+        self.article.save()
+        response = self.client.get("/articles/%s/" % self.article.id)
+        self.assertContains(response, '<strong>強調</strong>', html=True)
+        self.assertContains(response, 'href="#見出し"')
+        self.assertNotContains(response, '<script>')
+
+
+class ArticleRenderingTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+
+    def test_should_add_heading_anchors_and_toc(self):
+        rendered = render_markdown("## はじめに\n\n本文\n\n### Django の設定\n\n本文")
+        self.assertIn('<h2 id="はじめに">', rendered.html)
+        self.assertIn('class="headerlink"', rendered.html)
+        self.assertIn('href="#django-の設定"', rendered.toc_html)
+        self.assertEqual(render_markdown("見出しのない本文").toc_html, '')
+
+    def test_should_sanitize_html(self):
+        rendered = render_markdown(
+            '<img src="x.png" onerror="alert(1)"> [link](javascript:alert(1)) '
+            '<a href="https://example.com" style="color: red">ok</a>'
+        )
+        self.assertNotIn('onerror', rendered.html)
+        self.assertNotIn('javascript:', rendered.html)
+        self.assertNotIn('style=', rendered.html)
+        self.assertIn('rel="noopener noreferrer nofollow"', rendered.html)
+
+    @override_settings(ARTICLE_READING_SPEED={'cjk_chars': 10, 'words': 2})
+    def test_should_count_japanese_characters_and_words(self):
+        rendered = render_markdown("日本語の文章 with English words")
+        self.assertEqual(rendered.word_count, 6 + 3)
+        self.assertEqual(rendered.reading_time, 3)
+        self.assertEqual(render_markdown("").reading_time, 0)
+
+    def test_should_render_only_when_body_changes(self):
+        with mock.patch('blog.rendering.render_markdown', wraps=render_markdown) as render:
+            article = Article.objects.create(title="title", body="# 本文", created_by=self.user)
+            article.title = "changed"
+            article.save()
+            article.save(update_fields=['title'])
+            self.assertEqual(render.call_count, 1)
+
+            article.body = "# 新しい本文"
+            article.save(update_fields=['body'])
+            self.assertEqual(render.call_count, 2)
+        article.refresh_from_db()
+        self.assertIn('新しい本文', article.body_html)
+
+    def test_should_render_bulk_created_articles(self):
+        Article.objects.bulk_create([Article(title="bulk", body="*本文*", created_by=self.user)])
+        self.assertEqual(render_queryset(Article.objects.all()), 1)
+        self.assertEqual(render_queryset(Article.objects.all()), 0)
+        self.assertEqual(Article.objects.get().body_html, '<p><em>本文</em></p>')
+
+    def test_should_rerender_when_renderer_changes(self):
+        article = Article.objects.create(title="title", body="本文", created_by=self.user)
+        with mock.patch('blog.rendering.RENDERER_VERSION', RENDERER_VERSION + '-next'):
+            self.assertEqual(render_queryset(Article.objects.all()), 1)
+        updated = Article.objects.get()
+        self.assertGreater(updated.updated_at, article.updated_at)
+
+
+class ArticleCacheTest(TestCase):
+    def setUp(self):
+        get_article_cache().clear()
+        self.user = UserModel.objects.create(
+            username="test_user",
+            email="test@example.com",
+            password="top_secret_pass0001",
+        )
+        self.article = Article.objects.create(
+            title="title1",
+            abstract="abstract",
+            body="original body",
+            created_by=self.user
+        )
+
+    def test_should_serve_cached_page_with_single_query(self):
+        self.client.get("/articles/%s/" % self.article.id)
+        # 2 回目以降は更新日時の確認だけで済むこと
+        with self.assertNumQueries(1):
+            response = self.client.get("/articles/%s/" % self.article.id)
+        self.assertContains(response, "original body")
+
+    def test_should_not_serve_stale_page_after_edit(self):
+        self.client.force_login(self.user)
+        self.client.get("/articles/%s/" % self.article.id)
+        self.client.post(
+            "/articles/%s/edit/" % self.article.id,
+            {'title': 'title1', 'abstract': 'abstract', 'body': 'edited body'},
+        )
+        response = self.client.get("/articles/%s/" % self.article.id)
+        self.assertContains(response, "edited body")
+        self.assertNotContains(response, "original body")
+
+    def test_should_show_renamed_author(self):
+        """ 投稿者のユーザー名を変えたら、記事を更新していなくても詳細ページに新しい名前が出ることを確認する関数 """
+        url = "/articles/%s/" % self.article.id
+        response = self.client.get(url)
+        self.assertContains(response, "by test_user")
+        self.user.username = "renamed_user"
+        self.user.save()
+        with self.assertNumQueries(1):
+            revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(revalidated, "by renamed_user", status_code=200)
+        self.assertNotContains(revalidated, "test_user")
+        # トップページも 304 を返さずに新しい名前を出す
+        top = self.client.get("/")
+        self.user.username = "renamed_again"
+        self.user.save()
+        self.assertContains(self.client.get("/", HTTP_IF_NONE_MATCH=top['ETag']), "renamed_again")
+
+    def test_should_not_serve_stale_api_response_after_update(self):
+        url = '/api/articles/%s/' % self.article.id
+        self.client.get(url)
+        self.client.patch(url, {'body': 'patched body'}, content_type='application/json')
+        response = self.client.get(url)
+        self.assertEqual(response.json()['body'], 'patched body')
+
+    def test_should_return_404_after_delete(self):
+        self.client.get("/articles/%s/" % self.article.id)
+        self.article.delete()
+        response = self.client.get("/articles/%s/" % self.article.id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_should_ignore_entry_of_old_version(self):
+        # シグナルを経由しない更新でも、更新日時が変われば古いキャッシュは使われないこと
+        key = article_cache_key(self.article.id, 'html')
+        get_article_cache().set(key, ('old-version', {'html': 'stale'}))
+        response = self.client.get("/articles/%s/" % self.article.id)
+        self.assertContains(response, "original body")
+
+    def test_should_rebuild_only_once_under_burst(self):
+        calls = []
+
+        def builder():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        threads = [
+            threading.Thread(target=get_or_build, args=('burst-key', 'v1', builder))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_should_wait_for_rebuild_in_other_process(self):
+        # 別プロセスが再構築中 (ロックを保持中) の場合は、その結果を待って使うこと
+        cache = get_article_cache()
+        cache.add('remote-key:lock', 'v1')
+
+        def finish_remote_rebuild():
+            time.sleep(0.05)
+            cache.set('remote-key', ('v1', 'remote value'))
+            cache.delete('remote-key:lock')
+
+        thread = threading.Thread(target=finish_remote_rebuild)
+        thread.start()
+        value = get_or_build('remote-key', 'v1', lambda: 'local value')
+        thread.join()
+        self.assertEqual(value, 'remote value')
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        get_article_cache().clear()
+        self.user = UserModel.objects.create(
+            username="test_user",
+            email="test@example.com",
+            password="top_secret_pass0001",
+        )
+        self.article = Article.objects.create(
+            title="title1",
+            abstract="abstract",
+            body="body",
+            created_by=self.user
+        )
+
+    def _revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_article_detail_should_return_304(self):
+        url = "/articles/%s/" % self.article.id
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        # 記事本体を読み込まずに、更新日時の確認だけで 304 を返すこと
+        with self.assertNumQueries(1):
+            revalidated = self._revalidate(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_article_detail_should_return_200_after_edit(self):
+        url = "/articles/%s/" % self.article.id
+        response = self.client.get(url)
+        self.article.body = "edited"
+        self.article.save()
+        revalidated = self._revalidate(url, response)
+        self.assertContains(revalidated, "edited", status_code=200)
+
+    def test_article_detail_etag_should_depend_on_user(self):
+        url = "/articles/%s/" % self.article.id
+        response = self.client.get(url)
+        self.client.force_login(self.user)
+        self.assertEqual(self._revalidate(url, response).status_code, 200)
+
+    def test_top_should_return_304_until_articles_change(self):
+        response = self.client.get("/")
+        self.assertEqual(self._revalidate("/", response).status_code, 304)
+        Article.objects.create(title="title2", created_by=self.user)
+        self.assertEqual(self._revalidate("/", response).status_code, 200)
+
+    def test_top_should_return_200_after_delete(self):
+        Article.objects.create(title="title2", created_by=self.user)
+        response = self.client.get("/")
+        self.article.delete()
+        self.assertEqual(self._revalidate("/", response).status_code, 200)
+
+    def test_api_list_should_return_304(self):
+        response = self.client.get('/api/articles/')
+        with self.assertNumQueries(1):
+            revalidated = self._revalidate('/api/articles/', response)
+        self.assertEqual(revalidated.status_code, 304)
+        # クエリパラメータが違えば別の表現として扱うこと
+        revalidated = self._revalidate('/api/articles/', response, fields='title')
+        self.assertEqual(revalidated.status_code, 200)
+
+    def test_api_retrieve_should_return_304_until_update(self):
+        url = '/api/articles/%s/' % self.article.id
+        response = self.client.get(url)
+        self.assertEqual(self._revalidate(url, response).status_code, 304)
+        self.client.patch(url, {'title': 'updated'}, content_type='application/json')
+        self.assertEqual(self._revalidate(url, response).status_code, 200)
+
+    def test_top_should_return_304_with_single_query(self):
+        response = self.client.get("/")
+        # 1 ページ分の記事の取得だけで判定し、テンプレートは描画しないこと
+        with self.assertNumQueries(1):
+            revalidated = self._revalidate("/", response)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_collections_should_not_answer_if_modified_since(self):
+        # 古い記事を削除しても更新日時の最大値は変わらないので、一覧には Last-Modified を付けないこと
+        Article.objects.create(title="title2", created_by=self.user)
+        for url in ("/", "/api/articles/"):
+            response = self.client.get(url)
+            self.assertNotIn('Last-Modified', response)
+        self.article.delete()
+        for url in ("/", "/api/articles/"):
+            revalidated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date())
+            self.assertEqual(revalidated.status_code, 200)
+            self.assertNotContains(revalidated, "title1")
+
+    def test_if_modified_since_should_return_304(self):
+        url = '/api/articles/%s/' % self.article.id
+        response = self.client.get(url)
+        revalidated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(revalidated.status_code, 304)
+
 
 class ArticleViewSetTest(APITestCase):
     def setUp(self):
@@ -111,7 +457,74 @@ class ArticleViewSetTest(APITestCase):
         # 記事の一覧を取得する
         response = self.client.get('/api/articles/')
         self.assertEqual(response.status_code, status.HTTP_200_OK) # 記事の全件取得に成功すること
-        self.assertEqual(len(response.data), 2)     # 取得できたデータは２件あること
+        self.assertEqual(len(response.data['results']), 2)     # 取得できたデータは２件あること
+
+    @override_settings(ARTICLE_PAGE_SIZE=1)
+    def test_list_article_with_cursor(self):
+        # カーソルをたどって 1 件ずつ記事を取得する
+        response = self.client.get('/api/articles/')
+        self.assertEqual(response.data['results'][0]['title'], 'title_1')
+        self.assertIsNone(response.data['previous'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['title'], 'title_2')
+        self.assertIsNone(response.data['next'])
+
+    @override_settings(ARTICLE_PAGE_SIZE=1)
+    def test_list_article_with_descending_order(self):
+        # 並び順を逆にしてもカーソルで取得できること
+        response = self.client.get('/api/articles/', {'ordering': '-created_at'})
+        self.assertEqual(response.data['results'][0]['title'], 'title_2')
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['title'], 'title_1')
+
+    def test_list_article_with_invalid_cursor(self):
+        response = self.client.get('/api/articles/', {'cursor': 'broken'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_article_should_not_return_body(self):
+        # 一覧では本文と概要を返さず、SELECT にも含めないこと
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/articles/')
+        self.assertNotIn('body', response.data['results'][0])
+        self.assertNotIn('abstract', response.data['results'][0])
+        self.assertIn('id', response.data['results'][0])
+        self.assertNotIn('"body"', queries[-1]['sql'])
+
+    def test_list_article_with_fields(self):
+        # ?fields= で指定したフィールドだけを返すこと
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/articles/', {'fields': 'id,title'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+        self.assertNotIn('"updated_at"', queries[-1]['sql'])
+
+    def test_retrieve_article_should_return_rendered_body(self):
+        self.article_1.body = "## 見出し\n\n本文"
+        self.article_1.save()
+        response = self.client.get('/api/articles/%d/' % self.article_1.id)
+        self.assertEqual(response.data['body'], "## 見出し\n\n本文")
+        self.assertIn('<h2 id="見出し">', response.data['body_html'])
+        self.assertIn('href="#見出し"', response.data['toc_html'])
+        self.assertEqual(response.data['reading_time'], 1)
+
+    def test_retrieve_article_with_omit(self):
+        # ?omit= で指定したフィールドを除いて返すこと
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/articles/%d/' % self.article_1.pk, {'omit': 'body'})
+        self.assertEqual(response.data['title'], 'title_1')
+        self.assertNotIn('body', response.data)
+        self.assertNotIn('"body"', queries[0]['sql'])
+
+    def test_retrieve_article_should_check_object_permissions(self):
+        # キャッシュから返す場合も、オブジェクト単位の権限を確認すること
+        class DenyObject(BasePermission):
+            def has_object_permission(self, request, view, obj):
+                return False
+
+        self.client.get('/api/articles/%d/' % self.article_1.pk)
+        self.client.force_authenticate(self.user)
+        with mock.patch.object(ArticleViewSet, 'permission_classes', [DenyObject]):
+            response = self.client.get('/api/articles/%d/' % self.article_1.pk)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
     def test_create_article(self):
         # 記事を新規作成する
@@ -145,4 +558,759 @@ class ArticleViewSetTest(APITestCase):
         # 指定した ID の記事を削除する
         response = self.client.delete('/api/articles/1/')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)      # 削除が成功すること
-        self.assertFalse(Article.objects.filter(pk=self.article_1.pk).exists()) # 指定した ID の記事が存在しないこと
\ No newline at end of file
+        self.assertFalse(Article.objects.filter(pk=self.article_1.pk).exists()) # 指定した ID の記事が存在しないこと
+
+class ArticleBulkTest(APITestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+        self.other = UserModel.objects.create(username="other_user", password="top_secret_pass0001")
+        self.client.force_authenticate(self.user)
+
+    def _import(self, body, content_type='application/x-ndjson'):
+        return self.client.post('/api/articles/import/', body.encode(), content_type=content_type)
+
+    def _export(self, file_format):
+        response = self.client.get('/api/articles/export/', {'file_format': file_format})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_import_ndjson_should_report_invalid_rows(self):
+        body = '\n'.join([
+            json.dumps({'title': '一件目', 'abstract': '概要', 'body': '## 見出し\n\n本文'}),
+            '{broken',
+            json.dumps({'title': '', 'body': '本文'}),
+            '',
+            json.dumps({'title': '他の人の記事', 'created_by': self.other.pk}),
+            json.dumps({'title': '存在しない人の記事', 'created_by': 9999}),
+        ])
+        response = self._import(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['failed'], 3)
+        self.assertEqual([error['line'] for error in response.data['errors']], [2, 3, 6])
+        self.assertIn('title', response.data['errors'][1]['errors'])
+        self.assertIn('created_by', response.data['errors'][2]['errors'])
+
+        article = Article.objects.get(title='一件目')
+        self.assertEqual(article.created_by, self.user)
+        self.assertEqual(Article.objects.get(title='他の人の記事').created_by, self.other)
+        # bulk_create でもシグナルの代わりに HTML の変換と検索の索引を行うこと
+        self.assertIn('<h2 id="見出し">', article.body_html)
+        self.assertEqual(self.client.get('/api/articles/search/', {'q': '一件目'}).data['results'][0]['id'], article.pk)
+
+    def test_import_csv(self):
+        body = 'title,abstract,body\r\n"タイトル, その1",概要,"複数行の\n本文"\r\nタイトル2,,\r\nタイトル3,a,b,余分\r\n'
+        response = self._import('\ufeff' + body, content_type='text/csv; charset=utf-8')
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['errors'][0]['line'], 5)
+        self.assertEqual(Article.objects.get(title='タイトル, その1').body, '複数行の\n本文')
+
+    @override_settings(ARTICLE_IMPORT_CHUNK_SIZE=2, ARTICLE_IMPORT_MAX_ERRORS=1)
+    def test_import_should_commit_in_chunks(self):
+        body = '\n'.join(json.dumps({'title': 'title_%d' % n}) for n in range(5)) + '\n[]\n[]'
+        with CaptureQueriesContext(connection) as queries:
+            response = self._import(body)
+        self.assertEqual(response.data['created'], 5)
+        self.assertEqual(response.data['failed'], 2)
+        self.assertEqual(len(response.data['errors']), 1)
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "blog_article"')]
+        self.assertEqual(len(inserts), 3)
+
+    def test_import_should_return_400_when_all_rows_fail(self):
+        response = self._import('[]')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['created'], 0)
+
+    def test_import_should_require_request_body(self):
+        # Content-Length のない (chunked の) リクエストは、0 件の登録として扱わずに 411 を返すこと
+        response = self.client.post(
+            '/api/articles/import/', b'{"title": "a"}', content_type='application/x-ndjson', CONTENT_LENGTH='',
+        )
+        self.assertEqual(response.status_code, status.HTTP_411_LENGTH_REQUIRED)
+        response = self.client.post(
+            '/api/articles/import/', b'', content_type='application/x-ndjson', CONTENT_LENGTH='0',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Article.objects.filter(title='a').exists())
+
+    def test_import_should_reject_other_content_types(self):
+        response = self.client.post('/api/articles/import/', {'title': 'a'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_should_require_authentication(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self._import('{}').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get('/api/articles/export/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(ARTICLE_EXPORT_CHUNK_SIZE=2)
+    def test_export_ndjson_should_stream_all_articles(self):
+        for n in range(5):
+            Article.objects.create(title='title_%d' % n, body='本文 "%d"' % n, created_by=self.user)
+        response = self.client.get('/api/articles/export/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['title_%d' % n for n in range(5)])
+        self.assertEqual(rows[0]['body'], '本文 "0"')
+        self.assertEqual(rows[0]['created_by'], self.user.pk)
+
+    def test_export_csv_should_round_trip(self):
+        Article.objects.create(title='a, b', abstract='概要', body='複数行の\n"本文"', created_by=self.user)
+        exported = self._export('csv')
+        Article.objects.all().delete()
+        response = self._import(exported, content_type='text/csv')
+        self.assertEqual(response.data['created'], 1)
+        article = Article.objects.get()
+        self.assertEqual((article.title, article.body), ('a, b', '複数行の\n"本文"'))
+
+    def test_export_should_reject_unknown_format(self):
+        response = self.client.get('/api/articles/export/', {'file_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ArticleSearchTest(APITestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(
+            username="test_user",
+            email="test@example.com",
+            password="top_secret_pass0001",
+        )
+        self.django = Article.objects.create(
+            title="Django で作るブログ",
+            abstract="Django REST framework の使い方",
+            body="全文検索の索引を作って、記事を高速に検索できるようにする。",
+            created_by=self.user
+        )
+        self.next = Article.objects.create(
+            title="Next.js の入門",
+            abstract="フロントエンドの話",
+            body="バックエンドは Django で、全文検索は使わない。",
+            created_by=self.user
+        )
+        self.other = Article.objects.create(
+            title="日記",
+            abstract="今日の出来事",
+            body="天気が良かった。",
+            created_by=self.user
+        )
+
+    def _titles(self, response):
+        return [article['title'] for article in response.data['results']]
+
+    def test_should_use_fts_index_on_sqlite(self):
+        # SQLite ではマイグレーションで作った FTS5 の索引を使うこと
+        self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_search_should_rank_title_matches_first(self):
+        # タイトルに一致した記事が本文だけに一致した記事より上位になること
+        response = self.client.get('/api/articles/search/', {'q': 'Django'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(self._titles(response), ["Django で作るブログ", "Next.js の入門"])
+        self.assertGreater(response.data['results'][0]['rank'], response.data['results'][1]['rank'])
+
+    def test_search_should_match_japanese(self):
+        # 日本語の語を分かち書きなしで検索でき、一致した部分が <mark> で囲まれること
+        response = self.client.get('/api/articles/search/', {'q': '全文検索 索引'})
+        self.assertEqual(self._titles(response), ["Django で作るブログ"])
+        snippet = response.data['results'][0]['snippet']
+        self.assertIn('<mark>', snippet)
+        self.assertIn('索引', snippet)
+
+    def test_search_should_fall_back_to_like_for_short_terms(self):
+        # trigram の索引で引けない 2 文字以下の語でも検索できること
+        response = self.client.get('/api/articles/search/', {'q': '日記'})
+        self.assertEqual(self._titles(response), ["日記"])
+        self.assertIn('<mark>日記</mark>', response.data['results'][0]['snippet'])
+
+    @override_settings(ARTICLE_PAGE_SIZE=1)
+    def test_search_should_paginate(self):
+        # 検索結果をページ番号で取得できること
+        response = self.client.get('/api/articles/search/', {'q': 'Django'})
+        self.assertEqual(len(response.data['results']), 1)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self._titles(response), ["Next.js の入門"])
+        self.assertIsNone(response.data['next'])
+
+    def test_search_should_require_q(self):
+        response = self.client.get('/api/articles/search/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_index_should_follow_save_and_delete(self):
+        # 記事の保存・削除に合わせて索引が更新されること
+        self.other.body = "全文検索について書いた。"
+        self.other.save()
+        response = self.client.get('/api/articles/search/', {'q': '全文検索'})
+        self.assertEqual(response.data['count'], 3)
+        self.django.delete()
+        response = self.client.get('/api/articles/search/', {'q': '全文検索'})
+        self.assertEqual(self._titles(response), ["日記", "Next.js の入門"])
+
+    def test_list_should_filter_with_q(self):
+        # 一覧 API の ?q= で絞り込み、並び順は ordering に従うこと
+        response = self.client.get('/api/articles/', {'q': 'Django', 'ordering': '-created_at'})
+        self.assertEqual(self._titles(response), ["Next.js の入門", "Django で作るブログ"])
+
+    def test_snippet_should_escape_html(self):
+        # 本文の HTML はエスケープされ、<mark> だけがタグとして残ること
+        self.other.body = "<script>alert('検索結果')</script>"
+        self.other.save()
+        response = self.client.get('/api/articles/search/', {'q': '検索結果'})
+        snippet = response.data['results'][0]['snippet']
+        self.assertNotIn('<script>', snippet)
+        self.assertIn('<mark>検索結果</mark>', snippet)
+
+    def test_like_backend_should_find_same_articles(self):
+        # 索引がないデータベース用の LIKE 検索でも同じ記事が見つかること
+        backend = LikeSearchBackend('default')
+        self.assertEqual(backend.count(['Django']), 2)
+        self.assertEqual(
+            {a.pk for a in backend.search(['全文検索'], 0, 10)}, {self.django.pk, self.next.pk}
+        )
+        self.assertEqual(highlight('abc Django def', ['django']), 'abc <mark>Django</mark> def')
+
+
+class ArticleMigrationTest(TransactionTestCase):
+    def _migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+
+    def test_should_recreate_index_with_existing_articles(self):
+        """ 索引のマイグレーションを戻して適用し直すと、既存の記事が索引に入り検索できることを確認する関数 """
+        user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+        article = Article.objects.create(title="全文検索の索引", abstract="", body="本文", created_by=user)
+        self.addCleanup(call_command, 'migrate', verbosity=0)
+        self._migrate(('blog', '0002_rename_titlr_article_title'))
+        call_command('migrate', verbosity=0)
+        self.assertEqual([a.pk for a in get_search_backend().search(['全文検索'], 0, 10)], [article.pk])
+
+    def test_should_render_existing_articles(self):
+        """ 本文の HTML を追加するマイグレーションで、既存の記事を今の変換と同じ結果にすることを確認する関数 """
+        user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+        body = "## 見出し\n\n日本語の本文と English words。<script>alert(1)</script>"
+        article = Article.objects.create(title="記事", abstract="", body=body, created_by=user)
+        self.addCleanup(call_command, 'migrate', verbosity=0)
+        self._migrate(('blog', '0004_article_indexes'))
+        call_command('migrate', verbosity=0)
+        article.refresh_from_db()
+        rendered = render_markdown(body)
+        self.assertEqual(
+            (article.body_html, article.toc_html, article.word_count, article.reading_time),
+            (rendered.html, rendered.toc_html, rendered.word_count, rendered.reading_time),
+        )
+        self.assertNotIn('<script>', article.body_html)
+        # 今の版のハッシュ値と同じなら、render_articles で作り直さない
+        self.assertEqual(render_queryset(Article.objects.all()), 0)
+
+
+class QueryPlanTest(TestCase):
+    def test_registered_querysets_should_use_indexes(self):
+        # 登録されたクエリの実行計画に、テーブル全体の走査やインデックスを使わない並び替えがないこと
+        registered = get_registered_querysets()
+        self.assertIn('blog.top.first_page', registered)
+        self.assertIn('media.pending', registered)
+        for name, hot in registered.items():
+            with self.subTest(name=name):
+                plan, problems = explain(hot)
+                self.assertEqual(problems, [], '\n' + plan)
+
+    def test_should_detect_table_scan(self):
+        # インデックスのないカラムでの並び替えや絞り込みは問題として検出されること
+        hot = HotQuerySet('unindexed', lambda: Article.objects.filter(title='x').order_by('abstract'))
+        plan, problems = explain(hot)
+        self.assertEqual({kind for kind, line in problems}, {'full_scan', 'filesort'})
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1'], DATABASE_REPLICA_APPS=('blog',))
+class DatabaseRouterTest(TestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def _run(self, func, *args):
+        # 他のテストの書き込みで固定された状態を引き継がないように、新しいコンテキストで実行する
+        return contextvars.Context().run(func, *args)
+
+    def _pinned_during(self, request):
+        # ミドルウェアを通したリクエストの処理中に、読み取りがプライマリに固定されていたかを返す
+        seen = {}
+
+        def view(request):
+            seen['pinned'] = is_pinned_to_primary()
+            seen['read'] = self.router.db_for_read(Article)
+            return HttpResponse()
+
+        response = self._run(ReplicaStickinessMiddleware(view), request)
+        return seen, response
+
+    def test_reads_should_go_to_replica(self):
+        self.assertEqual(self._run(self.router.db_for_read, Article), 'replica_1')
+        # 対象外のアプリ (認証など) はプライマリから読む
+        self.assertEqual(self._run(self.router.db_for_read, UserModel), 'default')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_reads_should_go_to_primary_without_replicas(self):
+        self.assertEqual(self._run(self.router.db_for_read, Article), 'default')
+
+    def test_reads_after_write_should_go_to_primary(self):
+        def write_then_read():
+            self.assertEqual(self.router.db_for_write(Article), 'default')
+            return self.router.db_for_read(Article)
+        self.assertEqual(self._run(write_then_read), 'default')
+
+    def test_should_not_migrate_replica(self):
+        self.assertFalse(self.router.allow_migrate('replica_1', 'blog'))
+        self.assertIsNone(self.router.allow_migrate('default', 'blog'))
+
+    def test_write_request_should_set_sticky_cookie(self):
+        seen, response = self._pinned_during(self.factory.post('/api/articles/'))
+        self.assertTrue(seen['pinned'])
+        self.assertEqual(response.cookies['db_primary']['max-age'], 10)
+
+    def test_read_with_sticky_cookie_should_go_to_primary(self):
+        request = self.factory.get('/articles/1/')
+        request.COOKIES['db_primary'] = '1'
+        seen, response = self._pinned_during(request)
+        self.assertEqual(seen['read'], 'default')
+        self.assertNotIn('db_primary', response.cookies)
+
+    def test_read_without_cookie_should_go_to_replica(self):
+        seen, _ = self._pinned_during(self.factory.get('/articles/1/'))
+        self.assertEqual(seen['read'], 'replica_1')
+
+
+class SQLiteConcurrentSettingsTest(TestCase):
+    def _pragmas(self, **env):
+        """ 指定した環境変数で起動した別のプロセスで、新しい接続の PRAGMA の値を返す """
+        code = (
+            "import json; from django.db import connection; cursor = connection.cursor(); "
+            "print(json.dumps({name: cursor.execute('PRAGMA %s' % name).fetchone()[0] "
+            "for name in ('journal_mode', 'busy_timeout', 'synchronous')}))"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ, DATABASE_PROFILE='sqlite', SQLITE_PATH=os.path.join(directory, 'test.sqlite3'), **env,
+            )
+            output = subprocess.run(
+                [sys.executable, 'manage.py', 'shell', '-c', code],
+                cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+        return json.loads(output.splitlines()[-1])
+
+    def test_new_connection_should_use_wal_and_busy_timeout(self):
+        """ SQLITE_CONCURRENT=1 では、新しい接続が WAL になり busy_timeout が設定されることを確認する関数 """
+        pragmas = self._pragmas(SQLITE_CONCURRENT='1', SQLITE_BUSY_TIMEOUT='7')
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['busy_timeout'], 7000)
+        # synchronous=NORMAL は 1
+        self.assertEqual(pragmas['synchronous'], 1)
+
+    def test_should_keep_defaults_without_flag(self):
+        """ SQLITE_CONCURRENT を指定しなければ、SQLite の既定の設定のままであることを確認する関数 """
+        pragmas = self._pragmas(SQLITE_CONCURRENT='0')
+        self.assertEqual(pragmas['journal_mode'], 'delete')
+
+
+class AsyncViewTest(TestCase):
+    """ ASGI 用の非同期版のビューが、同期版と同じ内容を返すことを確認する """
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+        self.articles = [
+            Article.objects.create(
+                title="title_%d" % i, abstract="abstract_%d" % i, body="body_%d" % i, created_by=self.user
+            )
+            for i in range(3)
+        ]
+
+    def _request(self, path, **extra):
+        request = self.factory.get(path, **extra)
+
+        async def auser():
+            return AnonymousUser()
+        request.auser = auser
+        return request
+
+    async def test_list_should_match_sync_view(self):
+        response = await async_views.article_list(self._request('/api/articles/'))
+        self.assertEqual(response.status_code, 200)
+        expected = await self.async_client.get('/api/articles/')
+        self.assertEqual(json.loads(response.content), expected.json())
+        self.assertEqual(response['ETag'], expected['ETag'])
+
+    @override_settings(ARTICLE_PAGE_SIZE=2)
+    async def test_list_should_follow_cursor(self):
+        response = await async_views.article_list(self._request('/api/articles/'))
+        data = json.loads(response.content)
+        self.assertEqual([a['title'] for a in data['results']], ['title_0', 'title_1'])
+        response = await async_views.article_list(self._request(data['next']))
+        self.assertEqual([a['title'] for a in json.loads(response.content)['results']], ['title_2'])
+
+        response = await async_views.article_list(self._request('/api/articles/?cursor=broken'))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_list_should_search(self):
+        response = await async_views.article_list(self._request('/api/articles/?q=title_1'))
+        self.assertEqual([a['title'] for a in json.loads(response.content)['results']], ['title_1'])
+
+    async def test_retrieve_should_return_article(self):
+        article = self.articles[0]
+        response = await async_views.article_retrieve(
+            self._request('/api/articles/%d/' % article.pk), pk=article.pk
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['title'], 'title_0')
+
+        # ETag が一致すれば本文を返さない
+        response = await async_views.article_retrieve(
+            self._request('/api/articles/%d/' % article.pk, headers={'If-None-Match': response['ETag']}),
+            pk=article.pk,
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_retrieve_with_omit_should_use_sync_view(self):
+        article = self.articles[0]
+        response = await async_views.article_retrieve(
+            self._request('/api/articles/%d/?omit=body' % article.pk), pk=article.pk
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['title'], 'title_0')
+        self.assertNotIn('body', data)
+
+    async def test_retrieve_should_return_404(self):
+        response = await async_views.article_retrieve(self._request('/api/articles/0/'), pk=0)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.content), {'detail': str(NotFound.default_detail)})
+
+    async def test_should_reject_invalid_token_like_sync_view(self):
+        """ 不正なトークンを送ると、一覧・詳細とも同期版と同じく 401 を返すことを確認する関数 """
+        article = self.articles[0]
+        headers = {'Authorization': 'Bearer broken'}
+        for path, view, kwargs in (
+            ('/api/articles/', async_views.article_list, {}),
+            ('/api/articles/%d/' % article.pk, async_views.article_retrieve, {'pk': article.pk}),
+        ):
+            response = await view(self._request(path, headers=headers), **kwargs)
+            self.assertEqual(response.status_code, 401, path)
+            expected = await self.async_client.get(path, headers=headers)
+            self.assertEqual(expected.status_code, 401, path)
+
+    async def test_write_should_use_sync_view(self):
+        article = self.articles[0]
+        request = self.factory.patch(
+            '/api/articles/%d/' % article.pk, {'title': 'updated'}, content_type='application/json'
+        )
+        response = await async_views.article_retrieve(request, pk=article.pk)
+        self.assertEqual(response.status_code, 200)
+        await article.arefresh_from_db()
+        self.assertEqual(article.title, 'updated')
+
+    async def test_html_views_should_render(self):
+        response = await async_views.top(self._request('/'))
+        self.assertContains(response, 'title_0')
+
+        article = self.articles[1]
+        response = await async_views.article_detail(
+            self._request('/articles/%d/' % article.pk), article.pk
+        )
+        self.assertContains(response, 'body_1')
+
+    async def test_middleware_should_pin_async_write(self):
+        seen = {}
+
+        async def view(request):
+            seen['pinned'] = is_pinned_to_primary()
+            return HttpResponse()
+
+        async def request():
+            middleware = ReplicaStickinessMiddleware(view)
+            response = await middleware(self.factory.post('/api/articles/'))
+            # リクエストが終われば固定を解除する
+            seen['pinned_after'] = is_pinned_to_primary()
+            return response
+
+        # setUp の書き込みで固定された状態を引き継がないように、新しいコンテキストで実行する
+        response = await asyncio.create_task(request(), context=contextvars.Context())
+        self.assertTrue(seen['pinned'])
+        self.assertFalse(seen['pinned_after'])
+        self.assertIn('db_primary', response.cookies)
+
+
+class _WebhookStub(http.server.BaseHTTPRequestHandler):
+    """ 再検証の Webhook を受け取るテスト用のサーバー (status_codes の順に応答する) """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.received.put((self.headers.get(SECRET_HEADER), body))
+        status_code = self.server.status_codes.pop(0) if self.server.status_codes else 200
+        self.send_response(status_code)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RevalidationWebhookTest(TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _WebhookStub)
+        self.server.received = queue.Queue()
+        self.server.status_codes = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings = override_settings(
+            REVALIDATION_WEBHOOK_URL='http://127.0.0.1:%d/api/revalidate' % self.server.server_port,
+            REVALIDATION_WEBHOOK_SECRET='secret',
+            REVALIDATION_DEBOUNCE_SECONDS=0.2,
+            REVALIDATION_MAX_DELAY_SECONDS=5,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(dispatcher.flush)
+        self.user = UserModel.objects.create(username="test_user", password="top_secret_pass0001")
+
+    def _received(self):
+        return self.server.received.get(timeout=5)
+
+    def test_changes_should_be_batched_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Article.objects.create(title="1", body="本文", created_by=self.user)
+            second = Article.objects.create(title="2", body="本文", created_by=self.user)
+            first_pk = first.pk
+            first.delete()
+            # コミットされるまでは送らない
+            self.assertTrue(self.server.received.empty())
+
+        secret, body = self._received()
+        self.assertEqual(secret, 'secret')
+        self.assertEqual(body['paths'], sorted(['/', '/articles/%d' % first_pk, '/articles/%d' % second.pk]))
+        self.assertIn('article:%d' % second.pk, body['tags'])
+        self.assertIn('articles', body['tags'])
+        # 間引かれて 1 回だけ送られる
+        time.sleep(0.3)
+        self.assertTrue(self.server.received.empty())
+
+    def test_should_split_large_batches(self):
+        with override_settings(REVALIDATION_MAX_BATCH=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                Article.objects.create(title="1", body="本文", created_by=self.user)
+            dispatcher.flush()
+            sizes = [len(body['paths']) + len(body['tags']) for _, body in (self._received(), self._received())]
+        self.assertEqual(sorted(sizes), [1, 3])
+
+    @override_settings(REVALIDATION_RETRIES=1)
+    def test_should_retry_failed_delivery(self):
+        self.server.status_codes = [500]
+        with self.captureOnCommitCallbacks(execute=True):
+            Article.objects.create(title="1", body="本文", created_by=self.user)
+        dispatcher.flush()
+        first, second = self._received(), self._received()
+        self.assertEqual(first, second)
+
+    def test_bulk_import_should_revalidate_listing_once(self):
+        rows = [{'title': 'title_%d' % n} for n in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            import_articles(rows=[(n, row, None) for n, row in enumerate(rows, 1)], default_user_id=self.user.pk)
+        dispatcher.flush()
+        _, body = self._received()
+        self.assertEqual(body, {'paths': ['/'], 'tags': ['articles']})
+
+    def test_should_do_nothing_without_webhook(self):
+        with override_settings(REVALIDATION_WEBHOOK_URL=''):
+            with self.captureOnCommitCallbacks(execute=True):
+                Article.objects.create(title="1", body="本文", created_by=self.user)
+        dispatcher.flush()
+        self.assertTrue(self.server.received.empty())
+
+
+class RequestBudgetTest(BudgetTestMixin, APITestCase):
+    """
+    主なページと API のクエリの数と時間の予算
+    クエリの数は投稿者や記事を増やしても変わらないこと (N+1 になっていないこと) も確認する
+    時間の予算は遅い環境でも落ちないように緩くしてある
+    """
+
+    def setUp(self):
+        self.users = [UserModel.objects.create(username="user_%d" % i) for i in range(3)]
+        self.article = self._grow(3)[0]
+
+    def _grow(self, count=5):
+        # 記事ごとに別の投稿者にして、投稿者を記事ごとに読むと増えるようにする
+        start = Article.objects.count()
+        articles = []
+        for n in range(start, start + count):
+            user = UserModel.objects.create(username="author_%d" % n)
+            articles.append(Article.objects.create(title="title_%d" % n, body="## 見出し\n\n本文", created_by=user))
+        return articles
+
+    def test_top(self):
+        queries = self.assertConstantQueries(lambda: self.client.get("/"), self._grow)
+        with self.assertWithinBudget(queries=1, ms=500):
+            response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 1)
+
+    def test_article_detail(self):
+        url = "/articles/%d/" % self.article.pk
+        self.assertConstantQueries(lambda: self.client.get(url), self._grow)
+        # 2 回目からは本文の HTML をキャッシュから返す
+        with self.assertWithinBudget(queries=1, ms=500):
+            self.client.get(url)
+
+    def test_article_api(self):
+        self.assertConstantQueries(lambda: self.client.get("/api/articles/"), self._grow)
+        with self.assertWithinBudget(queries=2, ms=500):
+            self.client.get("/api/articles/")
+        url = "/api/articles/%d/" % self.article.pk
+        self.client.get(url)
+        with self.assertWithinBudget(queries=1, ms=500):
+            self.client.get(url)
+
+    def test_should_detect_n_plus_one(self):
+        """ 投稿者を記事ごとに読むと、記事を増やしたときにクエリの数が増えて失敗することを確認する """
+        with self.assertRaisesMessage(AssertionError, 'query count grew'):
+            self.assertConstantQueries(
+                lambda: [article.created_by.username for article in Article.objects.all()], self._grow,
+            )
+        with self.assertRaisesMessage(AssertionError, 'query budget exceeded'):
+            with self.assertWithinBudget(queries=1):
+                list(UserModel.objects.all())
+                list(Article.objects.all())
+
+
+class RequestInstrumentationTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(username="test_user")
+        self.article = Article.objects.create(title="title", body="本文", created_by=self.user)
+
+    def _timings(self, response):
+        return {entry.split(';')[0].strip(): entry for entry in response['Server-Timing'].split(',')}
+
+    def test_should_add_server_timing(self):
+        timings = self._timings(self.client.get("/"))
+        self.assertEqual(set(timings), {'sql', 'template', 'total'})
+        self.assertIn('desc="SQL (1)"', timings['sql'])
+        self.assertIn('desc="Template (1)"', timings['template'])
+        self.assertEqual(set(self._timings(self.client.get("/api/articles/"))), {'sql', 'total'})
+
+    @override_settings(SERVER_TIMING=False)
+    def test_should_not_add_server_timing_when_disabled(self):
+        self.assertNotIn('Server-Timing', self.client.get("/"))
+
+    def test_measure_should_add_nested_metrics_to_outer(self):
+        with measure() as outer:
+            list(Article.objects.all())
+            with measure() as inner:
+                list(UserModel.objects.all())
+        self.assertEqual((outer.queries, inner.queries), (2, 1))
+
+    async def test_should_measure_async_request(self):
+        """ 非同期のリクエストでも、sync_to_async で実行したクエリを数えることを確認する """
+        async def get_response(request):
+            await Article.objects.acount()
+            return HttpResponse()
+
+        middleware = RequestInstrumentationMiddleware(get_response)
+        response = await middleware(AsyncRequestFactory().get('/'))
+        self.assertIn('desc="SQL (1)"', response['Server-Timing'])
+
+    def test_should_write_profile_of_slow_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(
+                REQUEST_PROFILE_SAMPLE_RATE=1, REQUEST_PROFILE_SLOW_MS=0, REQUEST_PROFILE_DIR=directory,
+            ), self.assertLogs('app.instrumentation', 'WARNING'):
+                response = self.client.get("/")
+            self.assertIn('Server-Timing', response)
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            self.assertRegex(files[0], r'-GET-root-\d+ms\.prof$')
+            stats = pstats.Stats(os.path.join(directory, files[0]))
+            self.assertTrue(any(name == 'top' for _, _, name in stats.stats))
+
+    def test_should_not_write_profile_of_fast_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(
+                REQUEST_PROFILE_SAMPLE_RATE=1, REQUEST_PROFILE_SLOW_MS=60_000, REQUEST_PROFILE_DIR=directory,
+            ):
+                self.client.get("/")
+            self.assertEqual(os.listdir(directory), [])
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(username="test_user")
+        self.article = Article.objects.create(title="title", body="本文", created_by=self.user)
+
+    def _value(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_should_record_latency_and_queries_by_url_name(self):
+        before = self._value('http_request_duration_seconds_count', method='GET', view='top', status='200')
+        queries = self._value('db_queries_per_request_sum', view='top')
+        self.client.get("/")
+        self.assertEqual(
+            self._value('http_request_duration_seconds_count', method='GET', view='top', status='200'), before + 1,
+        )
+        self.assertEqual(self._value('db_queries_per_request_sum', view='top'), queries + 1)
+
+        # 一致しない URL はまとめて 1 つのラベルにする
+        before = self._value('http_request_duration_seconds_count', method='GET', view='<unmatched>', status='404')
+        self.client.get("/no-such-page/")
+        self.assertEqual(
+            self._value('http_request_duration_seconds_count', method='GET', view='<unmatched>', status='404'),
+            before + 1,
+        )
+
+    def test_should_count_cache_hits_and_misses(self):
+        hits = self._value('cache_requests_total', cache='article', result='hit')
+        misses = self._value('cache_requests_total', cache='article', result='miss')
+        self.client.get("/articles/%d/" % self.article.pk)
+        self.client.get("/articles/%d/" % self.article.pk)
+        self.assertEqual(self._value('cache_requests_total', cache='article', result='miss'), misses + 1)
+        self.assertEqual(self._value('cache_requests_total', cache='article', result='hit'), hits + 1)
+
+    @override_settings(DEBUG=True)
+    def test_endpoint_should_expose_metrics(self):
+        self.client.get("/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertContains(response, 'http_request_duration_seconds_bucket{le="0.005",method="GET",status="200",view="top"}')
+        self.assertContains(response, 'db_queries_per_request_count{view="top"}')
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_should_require_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_endpoint_should_not_be_public_without_token(self):
+        # トークンを設定していなければ、DEBUG でない環境では返さない
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+    def test_should_not_use_arbitrary_methods_as_labels(self):
+        # クライアントが送ってきた任意のメソッドで、ラベルの種類を増やさないこと
+        before = self._value('http_request_duration_seconds_count', method='other', view='top', status='200')
+        self.client.generic('FOOBAR', "/")
+        self.assertEqual(
+            self._value('http_request_duration_seconds_count', method='other', view='top', status='200'), before + 1,
+        )
+        self.assertEqual(self._value('http_request_duration_seconds_count', method='FOOBAR', view='top', status='200'), 0)
+
+    @override_settings(DEBUG=True)
+    def test_endpoint_should_aggregate_worker_processes(self):
+        """ PROMETHEUS_MULTIPROC_DIR を指定したときは、全てのワーカープロセスの値を合算して返すことを確認する """
+        code = (
+            "from prometheus_client import Counter; "
+            "Counter('cache_requests', '', ('cache', 'result')).labels('article', 'hit').inc(3)"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', code], env=env, check=True)
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+                response = self.client.get("/metrics")
+        self.assertContains(response, 'cache_requests_total{cache="article",result="hit"} 6.0')
@@ -1,10 +1,13 @@
+from django.conf import settings
 from django.urls import path
 
-from blog import views
+from blog import async_views, views
 
+# ASGI で動かすときは、記事詳細を非同期版にする
+article_detail = async_views.article_detail if settings.ASYNC_VIEWS else views.article_detail
 
 urlpatterns =[
     path("new/", views.article_new, name="article_new"),
-    path("<int:article_id>/", views.article_detail, name="article_detail"),
+    path("<int:article_id>/", article_detail, name="article_detail"),
     path("<int:article_id>/edit/", views.article_edit, name="article_edit"),
 ]
\ No newline at end of file
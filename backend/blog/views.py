@@ -1,19 +1,64 @@
-from django.http import HttpResponse, HttpResponseForbidden
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect, get_object_or_404
-from rest_framework import viewsets, filters
+from django.template.loader import render_to_string
+from rest_framework import viewsets, filters, status
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 
+from blog import bulk
+
+from blog.cache import (
+    article_cache_key,
+    get_article_header,
+    get_article_version,
+    get_or_build,
+)
+from blog.conditional import (
+    article_validators,
+    collection_validators,
+    page_validators,
+    patch_html_response,
+)
+from blog.filters import ArticleSearchFilter
 from blog.models import Article
 from blog.forms import ArticleForm
-from blog.serializers import ArticleSerializer
+from blog.pagination import (
+    ArticleCursorPagination,
+    ArticleSearchPagination,
+    InvalidCursor,
+    KeysetPaginator,
+)
+from blog.search import search_articles
+from blog.serializers import (
+    ArticleSearchResultSerializer,
+    ArticleSerializer,
+    ArticleSummarySerializer,
+)
 
 
 def top(request):
-    # ブログ記事を全件取得
-    articles = Article.objects.all()
+    # ブログ記事を新しい順に 1 ページ分だけ取得 (投稿者は JOIN して 1 クエリで取得する)
+    paginator = KeysetPaginator(
+        Article.objects.for_listing(),
+        ordering=('-created_at', '-id'),
+        page_size=settings.ARTICLE_PAGE_SIZE,
+    )
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404("ページが見つかりません。")
+    # 表示する記事が前回から変わっていなければ、テンプレートを描画せずに 304 を返す
+    validators = page_validators(request, page, 'top', request.user.pk)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return patch_html_response(not_modified)
     # テンプレートエンジンに渡す Python オブジェクト
-    context = {"articles": articles}
-    return render(request, "articles/top.html", context)
+    context = {"articles": page, "page": page}
+    response = render(request, "articles/top.html", context)
+    return patch_html_response(validators.apply(response))
 
 
 @login_required
@@ -24,7 +69,7 @@ def article_new(request):
             article = form.save(commit=False)
             article.created_by = request.user
             article.save()
-            return redirect(article_detail, article_id=article.pk)
+            return redirect('article_detail', article_id=article.pk)
     else:
         form = ArticleForm()
 
@@ -34,7 +79,7 @@ def article_new(request):
 @login_required
 def article_edit(request, article_id):
     article = get_object_or_404(Article, pk=article_id)
-    if article.created_by.id != request.user.id:
+    if article.created_by_id != request.user.id:
         return HttpResponseForbidden("この記事の編集はできません。")
     
     if request.method == 'POST':
@@ -48,15 +93,159 @@ def article_edit(request, article_id):
     return render(request, "articles/article_edit.html", {'form': form})
 
 
-def article_detail(request, article_id):
-    # article_id で指定された記事を取得、存在しない場合は 404 ページを返す
+def _build_article_page(article_id):
+    """
+    記事詳細ページのうち、ユーザによらない部分を組み立てる
+    投稿者のユーザー名は記事を更新しなくても変わるので含めない (表示するときに get_article_header で読む)
+    """
     article = get_object_or_404(Article, pk=article_id)
-    return render(request, "articles/article_detail.html", {'article': article})
+    return {
+        'id': article.id,
+        'title': article.title,
+        'created_by_id': article.created_by_id,
+        'created_at': article.created_at,
+        'html': render_to_string("articles/article_body.html", {'article': article}),
+    }
+
+
+def article_detail(request, article_id):
+    # article_id で指定された記事の更新日時と投稿者名を取得、存在しない場合は 404 ページを返す
+    header = get_article_header(article_id)
+    if header is None:
+        raise Http404("記事が見つかりません。")
+    updated_at, username = header
+    # ブラウザが持っている版から更新されていなければ 304 を返す (投稿者名が変わったときも作り直す)
+    validators = article_validators(request, article_id, updated_at, 'html', request.user.pk, username)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return patch_html_response(not_modified)
+
+    # 更新日時が変わっていなければ、キャッシュ済みの描画結果を使う
+    article = get_or_build(
+        article_cache_key(article_id, 'html'),
+        get_article_version(updated_at),
+        lambda: _build_article_page(article_id),
+    )
+    response = render(request, "articles/article_detail.html", {'article': article, 'username': username})
+    return patch_html_response(validators.apply(response))
 
 
 class ArticleViewSet(viewsets.ModelViewSet):
     queryset = Article.objects.all()
     serializer_class = ArticleSerializer
-    filter_backends = (filters.OrderingFilter,)
+    filter_backends = (ArticleSearchFilter, filters.OrderingFilter)
     ordering_fields = ('id', 'created_at',)
-    ordering = ('created_at',)
\ No newline at end of file
+    ordering = ('created_at',)
+    pagination_class = ArticleCursorPagination
+
+    def get_serializer_class(self):
+        # 一覧では本文を含まない軽量なシリアライザを使う
+        if self.action == 'list':
+            return ArticleSummarySerializer
+        if self.action == 'search':
+            return ArticleSearchResultSerializer
+        return ArticleSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method != 'GET':
+            return queryset
+        if self.action == 'retrieve':
+            if not self._is_projected():
+                # 全フィールドの表現はキャッシュから返すので、権限の確認と ETag に必要なカラムだけを読む
+                return queryset.only('id', 'created_by', 'updated_at')
+            # 絞り込んだ表現は読み込んだカラムから作る (更新日時は ETag に使う)
+            columns = self.get_serializer().get_model_columns() | {'id', 'updated_at'}
+            return queryset.only(*columns)
+        # レスポンスに含めるフィールドの分だけ SELECT する (並び替えとページングのキーは常に必要)
+        serializer = self.get_serializer_class()(context=self.get_serializer_context())
+        columns = serializer.get_model_columns() | {'id', 'created_at'}
+        return queryset.only(*columns)
+
+    def _is_projected(self):
+        """ ?fields= / ?omit= で、レスポンスに含めるフィールドを絞り込んでいるかどうか """
+        return set(self.get_serializer().fields) != set(self.get_serializer_class().Meta.fields)
+
+    def list(self, request, *args, **kwargs):
+        # 一覧が前回から変わっていなければ、記事を読み込まずに 304 を返す
+        validators = collection_validators(
+            request, self.filter_queryset(self.get_queryset()), 'api-list'
+        )
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
+        return validators.apply(super().list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        # 権限の確認 (check_object_permissions) が行われるように、記事は get_object() で取得する
+        article = self.get_object()
+        validators = article_validators(request, article.pk, article.updated_at, 'api')
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
+        if self._is_projected():
+            # 絞り込んだ表現は、必要なカラムだけを読んだ記事からそのまま作る (キャッシュしない)
+            return validators.apply(Response(self.get_serializer(article).data))
+
+        # 全フィールドの表現だけをキャッシュする (本文などのカラムはキャッシュがないときだけ読む)
+        data = get_or_build(
+            article_cache_key(article.pk, 'api'),
+            get_article_version(article.updated_at),
+            lambda: dict(ArticleSerializer(Article.objects.get(pk=article.pk)).data),
+        )
+        return validators.apply(Response(data))
+
+    @action(detail=False, methods=['post'], url_path='import', permission_classes=[IsAuthenticated])
+    def bulk_import(self, request):
+        """
+        NDJSON (application/x-ndjson) か CSV (text/csv) の本文を 1 行 1 記事として一括登録する
+        created_by を指定しない行はリクエストしたユーザーの記事になる
+        正しい行だけを登録し、誤りのある行は行番号とエラーを返す (1 件も登録できなければ 400)
+        """
+        content_type = request.content_type.split(';')[0].strip()
+        formats = {value: name for name, value in bulk.CONTENT_TYPES.items()}
+        if content_type not in formats:
+            return Response(
+                {'error': 'Content-Type must be one of: %s' % ', '.join(formats)},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+        # Content-Length のない (chunked の) リクエストは、本文を読めずに 0 件として扱われてしまうので受け付けない
+        if request.stream is None:
+            if not request.META.get('CONTENT_LENGTH'):
+                return Response(
+                    {'error': 'Content-Length is required'}, status=status.HTTP_411_LENGTH_REQUIRED,
+                )
+            return Response({'error': 'request body is empty'}, status=status.HTTP_400_BAD_REQUEST)
+        # 本文を request.data で一度に読み込まず、1 行ずつ読みながら登録する
+        rows = bulk.READERS[formats[content_type]](request.stream)
+        report = bulk.import_articles(rows, default_user_id=int(request.user.pk))
+        if report.failed and not report.created:
+            return Response(report.as_dict(), status=status.HTTP_400_BAD_REQUEST)
+        return Response(report.as_dict())
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def export(self, request):
+        """ 全記事を ?file_format=ndjson|csv (既定は ndjson) で、少しずつ読みながら返す """
+        file_format = request.query_params.get('file_format', 'ndjson')
+        if file_format not in bulk.EXPORTERS:
+            return Response(
+                {'error': 'file_format must be one of: %s' % ', '.join(bulk.EXPORTERS)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        response = StreamingHttpResponse(
+            bulk.EXPORTERS[file_format](),
+            content_type='%s; charset=utf-8' % bulk.CONTENT_TYPES[file_format],
+        )
+        response['Content-Disposition'] = 'attachment; filename="articles.%s"' % file_format
+        return response
+
+    @action(detail=False)
+    def search(self, request):
+        """ ?q= に一致する記事を関連度の高い順に、一致した部分のスニペットを付けて返す """
+        q = request.query_params.get('q', '')
+        if not q.strip():
+            return Response({'error': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+        paginator = ArticleSearchPagination()
+        page = paginator.paginate_queryset(search_articles(q), request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
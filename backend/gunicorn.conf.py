@@ -0,0 +1,21 @@
+"""
+gunicorn の設定 (作業ディレクトリのこのファイルを gunicorn が読み込む)
+
+PROMETHEUS_MULTIPROC_DIR を指定したときは、ワーカープロセスごとのメトリクスのファイルをそこに置くので、
+起動時に前回のファイルを消し、ワーカーが終了したらそのプロセスの値を片付ける (app.metrics)
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
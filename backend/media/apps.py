@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MediaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'media'
+
+    def ready(self):
+        # シグナルハンドラを登録する
+        from media import signals  # noqa: F401
+        # 実行計画を確認するクエリを登録する
+        from media import query_plans  # noqa: F401
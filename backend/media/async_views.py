@@ -0,0 +1,94 @@
+"""
+ASGI で動かすときに使う、画像 API の非同期版 (ASYNC_VIEWS = True のときに URL に登録する)
+
+アップロードは Pillow での変換とオブジェクトストレージへの送信で長くブロックするので、
+同期版の ImageUploadView をスレッドプールで実行し、その間もイベントループで他のリクエストを処理できるようにする
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
+
+from .models import Image as ImageModel
+from .serializers import ImageSerializer
+from .views import ImageBatchUploadView, ImageDetailView, ImageRenditionView, ImageUploadView
+
+_sync_upload = ImageUploadView.as_view()
+_sync_batch_upload = ImageBatchUploadView.as_view()
+_sync_rendition = ImageRenditionView.as_view()
+_sync_detail = ImageDetailView.as_view()
+
+
+def _view_in_thread(view, request, **kwargs):
+    try:
+        return view(request, **kwargs).render()
+    finally:
+        # スレッドプールのスレッドはリクエストごとに変わるので、そのスレッドで開いた接続を片付けておく
+        close_old_connections()
+
+
+@csrf_exempt
+async def image_upload(request):
+    """ 画像のアップロード (POST /api/image/) の非同期版 """
+    # thread_sensitive=False にして、複数のアップロードを別々のスレッドで同時に処理する
+    return await sync_to_async(_view_in_thread, thread_sensitive=False)(_sync_upload, request)
+
+
+@csrf_exempt
+async def image_batch_upload(request):
+    """ 画像のまとめてアップロード (POST /api/image/batch/) の非同期版 """
+    return await sync_to_async(_view_in_thread, thread_sensitive=False)(_sync_batch_upload, request)
+
+
+async def image_rendition(request, pk, width, height, fmt):
+    """ 縮小画像 (GET /api/image/<pk>/<幅>x<高さ>.<形式>) の非同期版 (作るときは変換の間スレッドで待つ) """
+    return await sync_to_async(_view_in_thread, thread_sensitive=False)(
+        _sync_rendition, request, pk=pk, width=width, height=height, fmt=fmt,
+    )
+
+
+def _needs_sync_checks(view, request):
+    # Authorization ヘッダがある (不正なトークンは 401 にする) か、AllowAny 以外の権限があるときは、
+    # 同期版のビューで DRF の認証・権限・スロットリングの確認を行う (blog.async_views と同じ条件)
+    return 'HTTP_AUTHORIZATION' in request.META or not all(
+        isinstance(permission, AllowAny) for permission in view.get_permissions()
+    )
+
+
+async def _get_image(pk):
+    return await ImageModel.objects.prefetch_related('renditions').filter(pk=pk).afirst()
+
+
+async def image_detail(request, pk):
+    """
+    画像の処理状況 (GET /api/image/<pk>/) の非同期版
+    ?wait= で待つ間もスレッドを占有しない
+    認証・権限の確認が必要なリクエストは、同期版の ImageDetailView をスレッドで実行する
+    """
+    if _needs_sync_checks(ImageDetailView(), request):
+        return await sync_to_async(_view_in_thread, thread_sensitive=False)(_sync_detail, request, pk=pk)
+    image = await _get_image(pk)
+    if image is None:
+        return HttpResponse(
+            JSONRenderer().render({'detail': str(NotFound.default_detail)}),
+            status=404, content_type='application/json',
+        )
+    try:
+        wait = min(float(request.GET.get('wait', 0)), ImageDetailView.max_wait)
+    except ValueError:
+        wait = 0
+    deadline = time.monotonic() + wait
+    while image.status in (ImageModel.STATUS_PENDING, ImageModel.STATUS_PROCESSING) \
+            and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+        image = await _get_image(pk)
+
+    return HttpResponse(
+        JSONRenderer().render(ImageSerializer(image).data), content_type='application/json'
+    )
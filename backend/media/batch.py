@@ -0,0 +1,240 @@
+"""
+1 回のリクエストで複数の画像をまとめてアップロードする仕組み (POST /api/image/batch/)
+
+- 重複した画像の確認は全ファイル分を 1 クエリで行い、同じリクエスト内の同じ内容のファイルも 1 回だけ処理する
+  (async モードでは最初の 1 つだけをキューに積み、残りの行にはワーカーが処理の結果を写す)
+- ファイルごとの変換とオブジェクトストレージへの保存は、IMAGE_BATCH_WORKERS 個のスレッドで並列に行う
+  (ワーカーはデータベースに触れないので、接続を増やさない)
+- Image と ImageRendition の行は、最後に bulk_create でまとめて作る
+- 一部のファイルが失敗しても他のファイルは登録し、ファイルごとの結果を返す
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+
+from app.revalidation import publish_change
+from .models import Image as ImageModel, ImageRendition
+from .pipeline import IMAGE_EXTENSIONS, ImageTooLarge, process_image
+from .serializers import ImageTitleSerializer
+from .signals import image_revalidation_targets
+from .tasks import enqueue_image, rendition_uploads
+from .utils import get_content_hash, get_minio_bucket_name, get_minio_client, upload_buffer, upload_many
+
+_executor = None
+
+
+def get_batch_executor():
+    # プロセス全体で同時に処理するファイルの数を IMAGE_BATCH_WORKERS に抑える
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_BATCH_WORKERS,
+            thread_name_prefix='image-batch',
+        )
+    return _executor
+
+
+class BatchUploadError(Exception):
+    """ 1 つのファイルの処理の失敗 (status はそのファイルの結果に入れる HTTP ステータス) """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class BatchItem:
+    """ まとめてアップロードされた 1 つのファイルと、その処理結果 """
+    index: int
+    file: object
+    title: str
+    content_hash: str = ''
+    status: int = None
+    error: str = ''
+    # 保存前の Image と、作る ImageRendition の値 (ImageRendition の image 以外のフィールド)
+    image: ImageModel = None
+    renditions: list = field(default_factory=list)
+
+    def fail(self, status, message):
+        self.status, self.error = status, message
+
+    def as_dict(self, serialized=None):
+        result = {'index': self.index, 'filename': self.file.name, 'status': self.status}
+        if self.error:
+            result['error'] = self.error
+        else:
+            result['image'] = serialized
+        return result
+
+
+def _store_processed(item):
+    """ 縮小画像まで作って保存する (IMAGE_PROCESSING_MODE = 'sync') """
+    try:
+        processed = process_image(item.file)
+    except ImageTooLarge as e:
+        raise BatchUploadError(413, 'image is too large: ' + str(e))
+    except UnidentifiedImageError as e:
+        raise BatchUploadError(400, 'invalid image file: ' + str(e))
+    except Exception as e:
+        raise BatchUploadError(500, 'image processing failed: ' + str(e))
+
+    original_key = item.content_hash + processed.original.extension
+    uploads = rendition_uploads(item.content_hash, processed)
+    uploads['original'] = (processed.original.buffer, original_key, processed.original.content_type)
+    try:
+        urls = upload_many(get_minio_client(), get_minio_bucket_name(), uploads)
+    except Exception as e:
+        raise BatchUploadError(500, 'MinIO upload failed: ' + str(e))
+
+    image = ImageModel(
+        title=item.title,
+        thumbnail_url=urls['thumbnail'],
+        display_url=urls['display'],
+        original_url=urls['original'],
+        original_key=original_key,
+        content_hash=item.content_hash,
+    )
+    renditions = []
+    for rendition in processed.srcset:
+        key = '%s_%dw%s' % (item.content_hash, rendition.width, rendition.extension)
+        renditions.append({
+            'width': rendition.width,
+            'height': rendition.height,
+            'format': rendition.format.lower(),
+            'url': urls[key],
+            'key': key,
+            'bytes': rendition.byte_size,
+        })
+    return image, renditions
+
+
+def _store_original(item):
+    """ オリジナル画像だけを保存する (IMAGE_PROCESSING_MODE = 'async'。縮小画像はキューで作る) """
+    try:
+        img_format = Image.open(item.file).format
+    except Exception as e:
+        raise BatchUploadError(400, 'invalid image file: ' + str(e))
+    item.file.seek(0)
+
+    original_key = item.content_hash + IMAGE_EXTENSIONS.get(img_format, '')
+    try:
+        original_url = upload_buffer(
+            get_minio_client(), get_minio_bucket_name(), item.file, original_key,
+            Image.MIME.get(img_format, 'application/octet-stream'),
+        )
+    except Exception as e:
+        raise BatchUploadError(500, 'MinIO upload failed: ' + str(e))
+    image = ImageModel(
+        title=item.title,
+        original_url=original_url,
+        original_key=original_key,
+        content_hash=item.content_hash,
+        status=ImageModel.STATUS_PENDING,
+    )
+    return image, []
+
+
+def _copy(item, source, status):
+    """ 同じ内容の画像の URL と縮小画像を使って、item の Image を用意する """
+    item.image = ImageModel(
+        title=item.title,
+        thumbnail_url=source.thumbnail_url,
+        display_url=source.display_url,
+        original_url=source.original_url,
+        original_key=source.original_key,
+        content_hash=item.content_hash,
+        status=source.status,
+    )
+    item.status = status
+
+
+def upload_batch(files, titles):
+    """
+    複数のファイルをアップロードして、ファイルの順に BatchItem のリストを返す
+    titles はファイルごとのタイトル (1 つだけなら全ファイルに使う)
+    タイトルは 1 枚ずつのアップロードと同じ ImageTitleSerializer で検証する
+    """
+    items = []
+    for index, file in enumerate(files):
+        title = titles[index] if len(titles) == len(files) else titles[0]
+        serializer = ImageTitleSerializer(data={'title': title})
+        if serializer.is_valid():
+            title = serializer.validated_data['title']
+        item = BatchItem(index, file, title)
+        if serializer.errors:
+            item.fail(400, 'title: %s' % serializer.errors['title'][0])
+        elif file.size > settings.IMAGE_UPLOAD_MAX_BYTES:
+            item.fail(413, 'image file is too large')
+        else:
+            item.content_hash = get_content_hash(file)
+        items.append(item)
+    pending = [item for item in items if item.status is None]
+
+    # アップロード済みの画像と同じ内容のファイルは、デコードも保存もせずに既存の画像を使う
+    existing = {}
+    for image in ImageModel.objects.filter(
+        content_hash__in={item.content_hash for item in pending}, status=ImageModel.STATUS_READY,
+    ).prefetch_related('renditions').order_by('id'):
+        existing.setdefault(image.content_hash, image)
+    leaders, followers = {}, []
+    for item in pending:
+        source = existing.get(item.content_hash)
+        if source is not None:
+            _copy(item, source, 201)
+            item.renditions = [
+                {'width': r.width, 'height': r.height, 'format': r.format, 'url': r.url, 'key': r.key, 'bytes': r.bytes}
+                for r in source.renditions.all()
+            ]
+        elif item.content_hash in leaders:
+            followers.append(item)
+        else:
+            leaders[item.content_hash] = item
+
+    # 同じ内容のファイルは最初の 1 つだけを処理する
+    store = _store_original if settings.IMAGE_PROCESSING_MODE == 'async' else _store_processed
+    accepted = 202 if settings.IMAGE_PROCESSING_MODE == 'async' else 201
+    executor = get_batch_executor()
+    futures = {content_hash: executor.submit(store, item) for content_hash, item in leaders.items()}
+    for content_hash, future in futures.items():
+        item = leaders[content_hash]
+        try:
+            item.image, item.renditions = future.result()
+            item.status = accepted
+        except BatchUploadError as e:
+            item.fail(e.status, str(e))
+    for item in followers:
+        leader = leaders[item.content_hash]
+        if leader.error:
+            item.fail(leader.status, leader.error)
+        else:
+            _copy(item, leader.image, leader.status)
+            item.renditions = leader.renditions
+
+    saved = [item for item in items if item.image is not None]
+    if saved:
+        _save(saved)
+    return items
+
+
+def _save(items):
+    """ Image と ImageRendition の行をまとめて作り、Next.js に再検証を依頼する """
+    with transaction.atomic():
+        images = ImageModel.objects.bulk_create([item.image for item in items])
+        ImageRendition.objects.bulk_create([
+            ImageRendition(image=image, **values)
+            for item, image in zip(items, images)
+            for values in item.renditions
+        ])
+        tags = set()
+        enqueued = set()
+        for image in images:
+            # 同じ内容のファイルは最初の 1 つだけをキューに積む (残りはその処理が終わったときに埋まる)
+            if image.status == ImageModel.STATUS_PENDING and image.content_hash not in enqueued:
+                enqueue_image(image.id)
+                enqueued.add(image.content_hash)
+            tags.update(image_revalidation_targets(image.id)[1])
+        # bulk_create では post_save が送られないので、ここでまとめて依頼する
+        publish_change((), tags)
@@ -0,0 +1,231 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from io import BytesIO
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+from botocore.exceptions import ClientError
+
+
+class LocalObjectStorage:
+    """
+    MinIO (S3) の代わりに使う、プロセス内のメモリにオブジェクトを保存するストレージ
+    boto3 の S3 クライアントのうち、このアプリケーションで使うメソッドだけを実装している
+    外部のサービスなしで開発やテストを行うためのもの
+    latency を指定すると、各操作でその秒数だけ待つ (ネットワーク越しのストレージを模したベンチマーク用)
+    署名付き URL へのブラウザからのアップロードは request で模す
+    """
+
+    def __init__(self, latency=0):
+        self._objects = {}
+        self._multipart = {}
+        self._lock = threading.Lock()
+        # 署名付き URL の署名に使う鍵 (インスタンスごとに変わる)
+        self._secret = os.urandom(16)
+        self.latency = latency
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _error(self, code, message, operation):
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def _not_found(self, operation, key):
+        return self._error('NoSuchKey', 'Not Found: %s' % key, operation)
+
+    def put_object(self, Bucket, Key, Body=b'', ContentType='binary/octet-stream', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self._wait()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self._lock:
+            self._objects[(Bucket, Key)] = {'Body': data, 'ContentType': ContentType, 'ETag': etag}
+        return {'ETag': etag}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        extra = ExtraArgs or {}
+        self.put_object(Bucket, Key, Fileobj, ContentType=extra.get('ContentType', 'binary/octet-stream'))
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._wait()
+        with self._lock:
+            obj = self._objects.get((Bucket, Key))
+        if obj is None:
+            raise self._not_found('HeadObject', Key)
+        return {'ContentLength': len(obj['Body']), 'ContentType': obj['ContentType'], 'ETag': obj['ETag']}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._wait()
+        with self._lock:
+            obj = self._objects.get((Bucket, Key))
+        if obj is None:
+            raise self._not_found('GetObject', Key)
+        body = obj['Body']
+        if Range:
+            # 'bytes=<開始>-<終了>' の形式だけに対応する
+            start, end = Range.split('=', 1)[1].split('-')
+            body = body[int(start):int(end) + 1 if end else None]
+        return {
+            'Body': BytesIO(body),
+            'ContentLength': len(body),
+            'ContentType': obj['ContentType'],
+            'ETag': obj['ETag'],
+        }
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self.get_object(Bucket, Key)['Body'].read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        return {}
+
+    # マルチパートアップロード
+
+    def create_multipart_upload(self, Bucket, Key, ContentType='binary/octet-stream', **kwargs):
+        self._wait()
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._multipart[upload_id] = {'Bucket': Bucket, 'Key': Key, 'ContentType': ContentType, 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _get_upload(self, Bucket, Key, UploadId, operation):
+        upload = self._multipart.get(UploadId)
+        if upload is None or (upload['Bucket'], upload['Key']) != (Bucket, Key):
+            raise self._error('NoSuchUpload', 'The specified upload does not exist.', operation)
+        return upload
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body=b'', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self._wait()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self._lock:
+            self._get_upload(Bucket, Key, UploadId, 'UploadPart')['Parts'][int(PartNumber)] = (etag, data)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._wait()
+        with self._lock:
+            upload = self._get_upload(Bucket, Key, UploadId, 'CompleteMultipartUpload')
+            chunks = []
+            for part in MultipartUpload['Parts']:
+                stored = upload['Parts'].get(int(part['PartNumber']))
+                if stored is None or stored[0] != part['ETag']:
+                    raise self._error(
+                        'InvalidPart', 'Part %s was not uploaded.' % part['PartNumber'],
+                        'CompleteMultipartUpload',
+                    )
+                chunks.append(stored[1])
+            del self._multipart[UploadId]
+        data = b''.join(chunks)
+        etag = '"%s-%d"' % (hashlib.md5(data).hexdigest(), len(chunks))
+        with self._lock:
+            self._objects[(Bucket, Key)] = {'Body': data, 'ContentType': upload['ContentType'], 'ETag': etag}
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self._lock:
+            self._get_upload(Bucket, Key, UploadId, 'AbortMultipartUpload')
+            del self._multipart[UploadId]
+        return {}
+
+    # 署名付き URL
+
+    def _sign(self, *values):
+        message = '\0'.join(str(value) for value in values).encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def _bucket_url(self, bucket):
+        from django.conf import settings
+        return '%s%s/' % (settings.LOCAL_OBJECT_STORAGE_URL, bucket)
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, HttpMethod=None):
+        """ put_object と upload_part の署名付き URL (PUT で送る) を作る """
+        if ClientMethod not in ('put_object', 'upload_part'):
+            raise ValueError('unsupported method: %s' % ClientMethod)
+        params = dict(Params or {})
+        query = {'X-Amz-Expires': int(time.time() + ExpiresIn)}
+        if ClientMethod == 'upload_part':
+            query.update(partNumber=params['PartNumber'], uploadId=params['UploadId'])
+        if params.get('ContentType'):
+            query['X-Amz-SignedHeaders'] = 'content-type'
+        # URL から読み戻した値と同じになるように、文字列にしてから署名する
+        query = {name: str(value) for name, value in query.items()}
+        query['X-Amz-Signature'] = self._sign(
+            'PUT', params['Bucket'], params['Key'], *sorted(query.items()), params.get('ContentType', '')
+        )
+        return self._bucket_url(params['Bucket']) + quote(params['Key']) + '?' + urlencode(query)
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        """ ブラウザのフォームから POST でアップロードするための URL とフィールドを作る """
+        fields = dict(Fields or {}, key=Key)
+        conditions = [{'bucket': Bucket}, *({name: value} for name, value in fields.items()), *(Conditions or [])]
+        policy = base64.b64encode(json.dumps({
+            'expiration': int(time.time() + ExpiresIn),
+            'conditions': conditions,
+        }).encode()).decode()
+        fields.update({'policy': policy, 'x-amz-signature': self._sign('POST', policy)})
+        return {'url': self._bucket_url(Bucket), 'fields': fields}
+
+    def request(self, method, url, body=b'', headers=None, fields=None):
+        """
+        署名付き URL に対するブラウザのリクエストを模す
+        PUT は URL の署名と有効期限を、POST はポリシーの署名と条件を確認してから保存し、レスポンスのヘッダーを返す
+        """
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        parts = urlsplit(url)
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        if method == 'POST':
+            return self._presigned_post(bucket, body, dict(fields or {}))
+
+        query = dict(parse_qsl(parts.query))
+        signature = query.pop('X-Amz-Signature', '')
+        content_type = headers.get('content-type', '') if 'X-Amz-SignedHeaders' in query else ''
+        expected = self._sign('PUT', bucket, key, *sorted(query.items()), content_type)
+        if not hmac.compare_digest(signature, expected):
+            raise self._error('SignatureDoesNotMatch', 'The request signature does not match.', 'PutObject')
+        if int(query['X-Amz-Expires']) < time.time():
+            raise self._error('AccessDenied', 'Request has expired', 'PutObject')
+        if 'uploadId' in query:
+            return self.upload_part(bucket, key, query['uploadId'], int(query['partNumber']), body)
+        return self.put_object(bucket, key, body, ContentType=headers.get('content-type', 'binary/octet-stream'))
+
+    def _presigned_post(self, bucket, body, fields):
+        policy = fields.get('policy', '')
+        if not hmac.compare_digest(fields.pop('x-amz-signature', ''), self._sign('POST', policy)):
+            raise self._error('SignatureDoesNotMatch', 'The request signature does not match.', 'PostObject')
+        document = json.loads(base64.b64decode(policy))
+        if document['expiration'] < time.time():
+            raise self._error('AccessDenied', 'Invalid according to Policy: Policy expired.', 'PostObject')
+        values = dict(fields, bucket=bucket)
+        for condition in document['conditions']:
+            if isinstance(condition, dict):
+                ok = all(values.get(name) == value for name, value in condition.items())
+            elif condition[0] == 'content-length-range':
+                ok = condition[1] <= len(body) <= condition[2]
+            elif condition[0] == 'eq':
+                ok = values.get(condition[1].lstrip('$')) == condition[2]
+            else:
+                ok = str(values.get(condition[1].lstrip('$'), '')).startswith(condition[2])
+            if not ok:
+                raise self._error(
+                    'AccessDenied', 'Invalid according to Policy: Policy Condition failed: %s' % condition,
+                    'PostObject',
+                )
+        return self.put_object(
+            bucket, fields['key'], body, ContentType=fields.get('Content-Type', 'binary/octet-stream')
+        )
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self._multipart.clear()
+
+
+# プロセス内で 1 つだけ作って共有する
+local_storage = LocalObjectStorage()
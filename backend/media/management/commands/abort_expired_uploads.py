@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from media.uploads import abort_expired_sessions
+
+
+class Command(BaseCommand):
+    help = (
+        '有効期限が切れても完了しなかった直接アップロードのセッションを中止し、'
+        '途中まで送られたマルチパートアップロードとオブジェクトを削除する (cron などで定期的に実行する)'
+    )
+
+    def handle(self, *args, **options):
+        aborted = abort_expired_sessions()
+        self.stdout.write('aborted %d expired upload session(s)' % aborted)
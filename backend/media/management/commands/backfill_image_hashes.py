@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from media.models import Image
+from media.utils import backfill_content_hashes
+
+
+class Command(BaseCommand):
+    help = 'content_hash が空の画像について、保存済みのオリジナル画像からハッシュ値を計算する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        updated = backfill_content_hashes(Image, batch_size=options['batch_size'])
+        remaining = Image.objects.filter(content_hash='').count()
+        self.stdout.write('updated %d image(s), %d remaining' % (updated, remaining))
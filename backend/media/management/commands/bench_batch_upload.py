@@ -0,0 +1,93 @@
+import json
+import time
+from io import BytesIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment
+from PIL import Image
+
+from media.local_storage import local_storage
+from media.utils import storage_stats
+
+
+def _photos(count, size, seed):
+    """ 圧縮しにくい (写真に近い) JPEG を count 枚作る (seed を変えると内容が変わり、重複の検出に当たらない) """
+    photos = []
+    for n in range(count):
+        img = Image.effect_noise(size, 30).convert('RGB')
+        img.paste((seed * 37 % 256, n % 256, n // 256), (0, 0, 8, 8))
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=85)
+        photos.append(('photo%d.jpg' % n, buffer.getvalue()))
+    return photos
+
+
+def _files(photos):
+    return [SimpleUploadedFile(name, content, content_type='image/jpeg') for name, content in photos]
+
+
+class Command(BaseCommand):
+    help = (
+        '記事のギャラリーの画像を、1 枚ずつ POST /api/image/ で送る場合と、'
+        'POST /api/image/batch/ でまとめて送る場合で、全体にかかる時間を比較する '
+        '(保存先はローカルのスタブ、作成した行は最後にロールバックする)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=50)
+        parser.add_argument('--width', type=int, default=1600)
+        parser.add_argument('--height', type=int, default=1067)
+        parser.add_argument('--latency', type=float, default=0.02,
+                            help='ローカルのスタブで 1 回の操作ごとに待つ秒数 (ネットワークの往復を模す)')
+
+    def measure(self, upload):
+        storage_stats.reset()
+        started = time.perf_counter()
+        statuses = upload()
+        elapsed = time.perf_counter() - started
+        stats = storage_stats.as_dict()
+        return {
+            'seconds': round(elapsed, 2),
+            'images_per_second': round(self.images / elapsed, 1),
+            'statuses': sorted(set(statuses)),
+            'uploads': stats['uploads'],
+            'max_in_flight': stats['max_in_flight'],
+        }
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        self.images = options['images']
+        size = (options['width'], options['height'])
+        single_photos = _photos(self.images, size, seed=1)
+        batch_photos = _photos(self.images, size, seed=2)
+        client = Client()
+
+        def single():
+            return [
+                client.post('/api/image/', {'title': name, 'image': file}).status_code
+                for name, file in zip((n for n, _ in single_photos), _files(single_photos))
+            ]
+
+        def batch():
+            response = client.post('/api/image/batch/', {'image': _files(batch_photos), 'title': [name for name, _ in batch_photos]})
+            return [result['status'] for result in response.json()['results']]
+
+        previous_latency = local_storage.latency
+        local_storage.latency = options['latency']
+        report = {
+            'images': self.images,
+            'image_size': '%dx%d' % size,
+            'storage_latency_seconds': options['latency'],
+        }
+        try:
+            with override_settings(OBJECT_STORAGE_BACKEND='local'), transaction.atomic():
+                report['one_request_per_image'] = self.measure(single)
+                report['batch_request'] = self.measure(batch)
+                transaction.set_rollback(True)
+        finally:
+            local_storage.latency = previous_latency
+            local_storage.clear()
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
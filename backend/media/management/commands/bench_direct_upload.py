@@ -0,0 +1,102 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment
+
+from media.local_storage import local_storage
+from media.management.commands.bench_batch_upload import _files, _photos
+
+
+class Command(BaseCommand):
+    help = (
+        '画像を POST /api/image/ で Django 経由で送る場合と、署名付き URL でオブジェクトストレージに直接送る場合で、'
+        'Django のプロセスが使う時間と受け取るバイト数を比較する '
+        '(保存先はローカルのスタブ、縮小画像はどちらもキューで作る、作成した行は最後にロールバックする)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=20)
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--latency', type=float, default=0.02,
+                            help='ローカルのスタブで 1 回の操作ごとに待つ秒数 (ネットワークの往復を模す)')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        size = (options['width'], options['height'])
+        proxied_photos = _photos(options['images'], size, seed=1)
+        direct_photos = _photos(options['images'], size, seed=2)
+        client = Client()
+
+        def proxied():
+            django_seconds = 0
+            received = 0
+            statuses = []
+            for (name, content), file in zip(proxied_photos, _files(proxied_photos)):
+                started = time.perf_counter()
+                response = client.post('/api/image/', {'title': name, 'image': file})
+                django_seconds += time.perf_counter() - started
+                received += len(content)
+                statuses.append(response.status_code)
+            return django_seconds, 0, received, statuses
+
+        def direct():
+            django_seconds = 0
+            storage_seconds = 0
+            received = 0
+            statuses = []
+            for name, content in direct_photos:
+                body = json.dumps({
+                    'title': name, 'filename': name, 'content_type': 'image/jpeg', 'size': len(content),
+                })
+                started = time.perf_counter()
+                session = client.post('/api/image/uploads/', body, content_type='application/json').json()
+                django_seconds += time.perf_counter() - started
+                received += len(body)
+
+                # ブラウザからストレージへの送信 (Django は関わらない)
+                started = time.perf_counter()
+                upload = session['upload']
+                local_storage.request('PUT', upload['url'], content, upload['headers'])
+                storage_seconds += time.perf_counter() - started
+
+                body = json.dumps({'parts': []})
+                started = time.perf_counter()
+                response = client.post(session['complete_url'], body, content_type='application/json')
+                django_seconds += time.perf_counter() - started
+                received += len(body)
+                statuses.append(response.status_code)
+            return django_seconds, storage_seconds, received, statuses
+
+        def measure(upload):
+            django_seconds, storage_seconds, received, statuses = upload()
+            return {
+                'django_seconds': round(django_seconds, 2),
+                'django_ms_per_image': round(django_seconds * 1000 / options['images'], 1),
+                'storage_seconds': round(storage_seconds, 2),
+                'bytes_through_django': received,
+                'statuses': sorted(set(statuses)),
+            }
+
+        previous_latency = local_storage.latency
+        local_storage.latency = options['latency']
+        report = {
+            'images': options['images'],
+            'image_size': '%dx%d' % size,
+            'average_bytes': sum(len(content) for _, content in direct_photos) // options['images'],
+            'storage_latency_seconds': options['latency'],
+        }
+        try:
+            with override_settings(
+                OBJECT_STORAGE_BACKEND='local', IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='database',
+            ), transaction.atomic():
+                report['through_django'] = measure(proxied)
+                report['direct_to_storage'] = measure(direct)
+                transaction.set_rollback(True)
+        finally:
+            local_storage.latency = previous_latency
+            local_storage.clear()
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
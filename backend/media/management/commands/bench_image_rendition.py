@@ -0,0 +1,85 @@
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment
+
+from media import transform
+from media.local_storage import local_storage
+from media.management.commands.bench_batch_upload import _files, _photos
+from media.models import Image as ImageModel, ImageRendition
+
+
+class Command(BaseCommand):
+    help = (
+        'GET /api/image/<id>/<幅>x<高さ>.<形式> について、初めての要求 (縮小画像を作る) と 2 回目以降 (リダイレクトだけ) の'
+        '時間と、同じ縮小画像への同時の要求で変換が何回行われるかを計る (保存先はローカルのスタブ、作成したデータは最後に削除する)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=5)
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--size', default='640x640.webp')
+        parser.add_argument('--latency', type=float, default=0.02,
+                            help='ローカルのスタブで 1 回の操作ごとに待つ秒数 (ネットワークの往復を模す)')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        client = Client()
+        previous_latency = local_storage.latency
+        local_storage.latency = options['latency']
+        created = []
+        try:
+            with override_settings(OBJECT_STORAGE_BACKEND='local', IMAGE_PROCESSING_MODE='async',
+                                   IMAGE_QUEUE_BACKEND='database'):
+                photos = _photos(options['images'], (options['width'], options['height']), seed=3)
+                for file in _files(photos):
+                    created.append(client.post('/api/image/', {'title': 'bench', 'image': file}).json()['id'])
+
+                def get(pk):
+                    started = time.perf_counter()
+                    response = client.get('/api/image/%d/%s' % (pk, options['size']))
+                    close_old_connections()
+                    return response.status_code, time.perf_counter() - started
+
+                cold = [get(pk) for pk in created[:-1]]
+                warm = [get(pk) for pk in created[:-1]]
+
+                # 最後の画像に、まだない縮小画像への要求を同時に送る
+                with mock.patch('media.transform.generate_rendition', wraps=transform.generate_rendition) as generate:
+                    with ThreadPoolExecutor(options['concurrency']) as executor:
+                        concurrent = list(executor.map(get, [created[-1]] * options['concurrency']))
+        finally:
+            local_storage.latency = previous_latency
+            local_storage.clear()
+            ImageRendition.objects.filter(image_id__in=created).delete()
+            ImageModel.objects.filter(pk__in=created).delete()
+
+        def summary(results):
+            seconds = [elapsed for _, elapsed in results]
+            return {
+                'statuses': sorted({code for code, _ in results}),
+                'median_ms': round(statistics.median(seconds) * 1000, 1),
+                'max_ms': round(max(seconds) * 1000, 1),
+            }
+
+        report = {
+            'image_size': '%dx%d' % (options['width'], options['height']),
+            'rendition': options['size'],
+            'storage_latency_seconds': options['latency'],
+            'first_request': summary(cold),
+            'cached_redirect': summary(warm),
+            'concurrent_cold_requests': {
+                **summary(concurrent),
+                'requests': options['concurrency'],
+                'generations': generate.call_count,
+            },
+        }
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
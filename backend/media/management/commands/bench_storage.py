@@ -0,0 +1,80 @@
+import json
+import os
+import statistics
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+
+from media.local_storage import LocalObjectStorage
+from media.utils import _create_minio_client, get_minio_bucket_name, get_pool_stats, upload_many
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 2),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        '画像 1 回分 (オリジナル・表示用・サムネイル) のアップロードにかかる時間を、'
+        '「毎回クライアントを作って直列に送る」場合と「共有クライアントで並列に送る」場合で比較する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--latency', type=float, default=0.02,
+                            help='ローカルのスタブで 1 回の操作ごとに待つ秒数 (ネットワークの往復を模す)')
+        parser.add_argument('--sizes', default='2000000,200000,30000',
+                            help='アップロードする 3 つのファイルのバイト数')
+        parser.add_argument('--endpoint', default=None,
+                            help='指定すると、スタブの代わりにこの MinIO (S3 互換) に実際にアップロードする')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        payloads = [os.urandom(size) for size in sizes]
+        if options['endpoint']:
+            os.environ['MINIO_ENDPOINT'] = options['endpoint']
+            stub = None
+        else:
+            os.environ.setdefault('MINIO_ENDPOINT', 'localhost:9000')
+            stub = LocalObjectStorage(latency=options['latency'])
+        bucket = get_minio_bucket_name()
+
+        def items(prefix):
+            return {
+                str(i): (BytesIO(payload), '%s-%d.bin' % (prefix, i), 'application/octet-stream')
+                for i, payload in enumerate(payloads)
+            }
+
+        # 従来の方法: リクエストごとにクライアントを作り、直列にアップロードする
+        baseline = []
+        for n in range(options['iterations']):
+            started = time.perf_counter()
+            client = _create_minio_client()
+            target = stub or client
+            for buffer, key, content_type in items('baseline-%d' % n).values():
+                target.upload_fileobj(buffer, bucket, key, ExtraArgs={'ContentType': content_type})
+            baseline.append(time.perf_counter() - started)
+
+        # 新しい方法: 共有クライアントを使い、並列にアップロードする
+        shared = _create_minio_client()
+        pooled = []
+        for n in range(options['iterations']):
+            started = time.perf_counter()
+            upload_many(stub or shared, bucket, items('pooled-%d' % n))
+            pooled.append(time.perf_counter() - started)
+
+        report = {
+            'target': options['endpoint'] or 'local-stub (latency=%ss)' % options['latency'],
+            'iterations': options['iterations'],
+            'bytes_per_request': sum(sizes),
+            'per_request_client_serial': _summary(baseline),
+            'shared_client_concurrent': _summary(pooled),
+            'pool_stats': get_pool_stats(),
+        }
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
@@ -0,0 +1,88 @@
+import json
+import multiprocessing
+import resource
+import tempfile
+import tracemalloc
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from media.pipeline import process_image
+from media.utils import keep_aspect_image_resize
+
+
+class NullStorage:
+    """ 受け取ったデータをチャンクごとに読み捨てるストレージ (アップロード先のメモリを計測に含めないため) """
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        Fileobj.seek(0)
+        while Fileobj.read(1024 * 1024):
+            pass
+
+
+def _legacy(path, storage):
+    # 以前の ImageUploadView と同じ処理: オリジナルと 2 つの縮小画像をそれぞれ BytesIO にエンコードする
+    with open(path, 'rb') as img_file:
+        buffers = []
+        original_img = Image.open(img_file)
+        buffers.append(BytesIO())
+        original_img.save(buffers[-1], format='JPEG')
+        for long_side in (1000, 300):
+            img_file.seek(0)
+            resized = keep_aspect_image_resize(img_file, long_side)
+            buffers.append(BytesIO())
+            resized.save(buffers[-1], format='JPEG')
+        for buffer in buffers:
+            storage.upload_fileobj(buffer, 'bench', 'key')
+
+
+def _streaming(path, storage):
+    # 現在の処理: オリジナルはそのまま送り、縮小画像は一時ファイルに逃がせるバッファに書き出す
+    with open(path, 'rb') as img_file:
+        processed = process_image(img_file)
+        storage.upload_fileobj(processed.original.buffer, 'bench', 'key')
+        for rendition in list(processed.renditions.values()) + processed.srcset:
+            storage.upload_fileobj(rendition.buffer, 'bench', 'key')
+
+
+VARIANTS = {'legacy': _legacy, 'streaming': _streaming}
+
+
+def _measure(variant, path, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    VARIANTS[variant](path, NullStorage())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'python_heap_peak_mb': round(peak / 1024 / 1024, 2),
+        'max_rss_growth_mb': round((after - before) / 1024, 2),
+    })
+
+
+class Command(BaseCommand):
+    help = '画像 1 枚をアップロードするときのピークメモリを、以前の処理と現在の処理で比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--width', type=int, default=6000)
+        parser.add_argument('--height', type=int, default=4000)
+
+    def handle(self, *args, **options):
+        size = (options['width'], options['height'])
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as source:
+            # カメラの写真に近い、圧縮しにくい画像を用意する
+            Image.effect_noise(size, 40).convert('RGB').save(source, format='JPEG', quality=90)
+            source.flush()
+
+            report = {'image': '%dx%d JPEG' % size}
+            # 計測が互いに影響しないように、それぞれ別のプロセスで実行する
+            context = multiprocessing.get_context('fork')
+            for variant in VARIANTS:
+                queue = context.Queue()
+                process = context.Process(target=_measure, args=(variant, source.name, queue))
+                process.start()
+                report[variant] = queue.get()
+                process.join()
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
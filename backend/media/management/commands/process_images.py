@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from media.tasks import process_pending_images
+
+
+class Command(BaseCommand):
+    help = 'pending 状態の画像から縮小画像を作成するワーカー (IMAGE_QUEUE_BACKEND = "database" 用)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='pending の画像を 1 回処理したら終了する')
+        parser.add_argument('--interval', type=float, default=1.0, help='キューを確認する間隔 (秒)')
+        parser.add_argument('--batch-size', type=int, default=10, help='1 回に処理する画像の最大数')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending_images(limit=options['batch_size'])
+            if processed:
+                self.stdout.write('processed %d image(s)' % processed)
+            if options['once']:
+                break
+            if not processed:
+                time.sleep(options['interval'])
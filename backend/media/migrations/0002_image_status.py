@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='error',
+            field=models.TextField(blank=True, verbose_name='エラー内容'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='original_key',
+            field=models.CharField(blank=True, max_length=256, verbose_name='オリジナル画像のオブジェクトキー'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='status',
+            field=models.CharField(choices=[('pending', '処理待ち'), ('processing', '処理中'), ('ready', '完了'), ('failed', '失敗')], db_index=True, default='ready', max_length=16, verbose_name='処理状況'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='display_url',
+            field=models.CharField(blank=True, max_length=256, verbose_name='表示用画像の URL'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='thumbnail_url',
+            field=models.CharField(blank=True, max_length=256, verbose_name='サムネイル画像の URL'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:18
+
+from django.db import migrations, models
+
+
+def backfill_image_hashes(apps, schema_editor):
+    # 既存の画像について、保存済みのオリジナル画像からハッシュ値を計算する
+    # ストレージに接続できない環境では空のまま残るので、後から backfill_image_hashes コマンドで埋める
+    from media.utils import backfill_content_hashes
+
+    try:
+        backfill_content_hashes(apps.get_model('media', 'Image'))
+    except Exception:
+        pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0002_image_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='画像の SHA-256'),
+        ),
+        migrations.RunPython(backfill_image_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0003_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('width', models.PositiveIntegerField(verbose_name='幅')),
+                ('height', models.PositiveIntegerField(verbose_name='高さ')),
+                ('format', models.CharField(max_length=8, verbose_name='形式')),
+                ('url', models.CharField(max_length=256, verbose_name='URL')),
+                ('key', models.CharField(max_length=256, verbose_name='オブジェクトキー')),
+                ('bytes', models.PositiveIntegerField(default=0, verbose_name='バイト数')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='media.image')),
+            ],
+            options={
+                'ordering': ('format', 'width'),
+                'constraints': [models.UniqueConstraint(fields=('image', 'width', 'format'), name='unique_image_rendition')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0004_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='status',
+            field=models.CharField(choices=[('pending', '処理待ち'), ('processing', '処理中'), ('ready', '完了'), ('failed', '失敗')], default='ready', max_length=16, verbose_name='処理状況'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['status', 'uploaded_at', 'id'], name='media_image_queue_idx'),
+        ),
+    ]
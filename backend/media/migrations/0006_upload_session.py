@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:14
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0005_image_queue_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='トークン')),
+                ('title', models.CharField(max_length=128, verbose_name='画像タイトル')),
+                ('filename', models.CharField(max_length=256, verbose_name='ファイル名')),
+                ('content_type', models.CharField(max_length=64, verbose_name='Content-Type')),
+                ('size', models.PositiveBigIntegerField(verbose_name='バイト数')),
+                ('key', models.CharField(max_length=256, verbose_name='オブジェクトキー')),
+                ('upload_id', models.CharField(blank=True, max_length=256, verbose_name='マルチパートアップロードの ID')),
+                ('part_size', models.PositiveBigIntegerField(default=0, verbose_name='パートのバイト数')),
+                ('status', models.CharField(choices=[('pending', 'アップロード待ち'), ('completed', '完了'), ('aborted', '中止')], default='pending', max_length=16, verbose_name='状態')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('expires_at', models.DateTimeField(verbose_name='署名付き URL の有効期限')),
+                ('image', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='media.image', verbose_name='画像')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0007_image_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='処理開始日時'),
+        ),
+    ]
@@ -1,12 +1,103 @@
+import uuid
+
 from django.db import models
 
 # Create your models here.
 class Image(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, '処理待ち'),
+        (STATUS_PROCESSING, '処理中'),
+        (STATUS_READY, '完了'),
+        (STATUS_FAILED, '失敗'),
+    )
+
     title = models.CharField('画像タイトル', max_length=128)
-    thumbnail_url = models.CharField('サムネイル画像の URL', max_length=256)
-    display_url = models.CharField('表示用画像の URL', max_length=256)
+    thumbnail_url = models.CharField('サムネイル画像の URL', max_length=256, blank=True)
+    display_url = models.CharField('表示用画像の URL', max_length=256, blank=True)
     original_url = models.CharField('オリジナル画像の URL', max_length=256)
+    original_key = models.CharField('オリジナル画像のオブジェクトキー', max_length=256, blank=True)
+    content_hash = models.CharField('画像の SHA-256', max_length=64, blank=True, db_index=True)
+    # EXIF の向きを反映したオリジナル画像の大きさ (縮小画像をその場で作るときに分かる)
+    width = models.PositiveIntegerField('幅', null=True, blank=True)
+    height = models.PositiveIntegerField('高さ', null=True, blank=True)
+    status = models.CharField(
+        '処理状況', max_length=16, choices=STATUS_CHOICES, default=STATUS_READY
+    )
+    error = models.TextField('エラー内容', blank=True)
+    # ワーカーが processing にした日時 (IMAGE_PROCESSING_TIMEOUT を過ぎても processing のままなら pending に戻す)
+    claimed_at = models.DateTimeField('処理開始日時', null=True, blank=True)
     uploaded_at = models.DateTimeField('アップロード日時', auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # database キューのワーカーが pending の画像を古い順に取り出す
+            models.Index(fields=['status', 'uploaded_at', 'id'], name='media_image_queue_idx'),
+        ]
+
+    def __str__(self):
+        return self.title
+
+class ImageRendition(models.Model):
+    """ srcset / <picture> 用に作成した、幅と形式ごとの縮小画像 """
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='renditions')
+    width = models.PositiveIntegerField('幅')
+    height = models.PositiveIntegerField('高さ')
+    format = models.CharField('形式', max_length=8)
+    url = models.CharField('URL', max_length=256)
+    key = models.CharField('オブジェクトキー', max_length=256)
+    bytes = models.PositiveIntegerField('バイト数', default=0)
+
+    class Meta:
+        ordering = ('format', 'width')
+        constraints = [
+            models.UniqueConstraint(fields=('image', 'width', 'format'), name='unique_image_rendition'),
+        ]
+
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return '%s (%dw %s)' % (self.image, self.width, self.format)
+
+
+class UploadSession(models.Model):
+    """
+    ブラウザからオブジェクトストレージに直接アップロードするためのセッション
+    署名付き URL を発行したときに作り、アップロードの完了を確認したら Image を作る
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_COMPLETED = 'completed'
+    STATUS_ABORTED = 'aborted'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'アップロード待ち'),
+        (STATUS_COMPLETED, '完了'),
+        (STATUS_ABORTED, '中止'),
+    )
+
+    # URL に使う推測できない ID (連番の id は外に出さない)
+    token = models.UUIDField('トークン', unique=True, default=uuid.uuid4, editable=False)
+    title = models.CharField('画像タイトル', max_length=128)
+    filename = models.CharField('ファイル名', max_length=256)
+    content_type = models.CharField('Content-Type', max_length=64)
+    size = models.PositiveBigIntegerField('バイト数')
+    key = models.CharField('オブジェクトキー', max_length=256)
+    # マルチパートアップロードの ID とパートのバイト数 (マルチパートでなければ空と 0)
+    upload_id = models.CharField('マルチパートアップロードの ID', max_length=256, blank=True)
+    part_size = models.PositiveBigIntegerField('パートのバイト数', default=0)
+    status = models.CharField(
+        '状態', max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    image = models.OneToOneField(
+        Image, verbose_name='画像', on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='upload_session',
+    )
+    created_at = models.DateTimeField('作成日時', auto_now_add=True)
+    expires_at = models.DateTimeField('署名付き URL の有効期限')
+
+    def __str__(self):
+        return '%s (%s)' % (self.filename, self.status)
+
+    @property
+    def is_multipart(self):
+        return bool(self.upload_id)
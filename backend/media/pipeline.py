@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from PIL import Image, ImageOps, features
+
+from app.metrics import image_stage
+from .utils import keep_aspect_size
+
+# 画像の形式ごとの拡張子
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp', 'AVIF': '.avif'}
+
+# 縮小画像の形式ごとの、Pillow に渡す保存オプション (progressive JPEG など)
+ENCODE_OPTIONS = {
+    'JPEG': {'progressive': True, 'optimize': True},
+    'WEBP': {'method': 4},
+    'AVIF': {'speed': 8},
+}
+
+# EXIF の Orientation タグ
+ORIENTATION_TAG = 0x0112
+
+# 画像のエンコードは GIL を解放するので、スレッドで並列に実行できる
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_PROCESSING_WORKERS,
+            thread_name_prefix='image-encode',
+        )
+    return _executor
+
+
+class EncodedImage:
+    """ エンコード済みの画像データ """
+
+    def __init__(self, buffer, size, content_type='image/jpeg', extension='.jpg', format='JPEG'):
+        self.buffer = buffer
+        self.size = size
+        self.content_type = content_type
+        self.extension = extension
+        self.format = format
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def byte_size(self):
+        position = self.buffer.tell()
+        self.buffer.seek(0, 2)
+        size = self.buffer.tell()
+        self.buffer.seek(position)
+        return size
+
+
+class ImageTooLarge(Exception):
+    """ 画素数が IMAGE_MAX_PIXELS を超える画像がアップロードされたときに送出する例外 """
+
+
+def new_spooled_buffer():
+    """ 一定の大きさまではメモリに、それを超えると一時ファイルに書き出すバッファを作る """
+    return SpooledTemporaryFile(max_size=settings.IMAGE_SPOOL_MAX_MEMORY)
+
+
+def get_srcset_formats():
+    """ IMAGE_SRCSET_FORMATS のうち、この環境の Pillow でエンコードできる形式を返す """
+    return [
+        fmt.upper() for fmt in settings.IMAGE_SRCSET_FORMATS
+        if fmt.upper() == 'JPEG' or features.check(fmt.lower())
+    ]
+
+
+class ProcessedImage:
+    """
+    オリジナル画像と、設定された各サイズの縮小画像をまとめたもの
+    renditions は IMAGE_RENDITIONS の名前ごとの JPEG、srcset は IMAGE_SRCSET_WIDTHS の幅と形式ごとの画像
+    """
+
+    def __init__(self, original, renditions, srcset=()):
+        self.original = original
+        self.renditions = renditions
+        self.srcset = list(srcset)
+
+
+def decode_image(img, max_long_side=None):
+    """
+    開いた画像を 1 回だけデコードする
+    max_long_side を指定した JPEG は、draft モードでその大きさ以上の範囲で縮小しながらデコードする
+    """
+    with image_stage('decode'):
+        if max_long_side and img.format == 'JPEG':
+            img.draft('RGB', keep_aspect_size(img.width, img.height, max_long_side))
+        img.load()
+    return img
+
+
+def encode_image(img, format, quality):
+    """
+    画像を指定した形式でエンコードしてバッファに書き出す
+    EXIF や ICC プロファイルなどのメタデータは引き継がない
+    """
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = new_spooled_buffer()
+    with image_stage('encode_' + format.lower()):
+        img.save(buffer, format=format, quality=quality, **ENCODE_OPTIONS.get(format, {}))
+    buffer.seek(0)
+    return EncodedImage(
+        buffer, img.size,
+        content_type=Image.MIME[format],
+        extension=IMAGE_EXTENSIONS[format],
+        format=format,
+    )
+
+
+def encode_jpeg(img, quality):
+    """ 画像を JPEG にエンコードしてバッファに書き出す """
+    return encode_image(img, 'JPEG', quality)
+
+
+def _targets(size, renditions, widths):
+    """
+    作成する縮小画像のサイズを大きい順に並べて返す
+    要素は ((幅, 高さ), 名前付きの縮小画像の名前のリスト, srcset 用かどうか)
+    """
+    targets = {}
+    for name, spec in renditions.items():
+        long_side = min(spec['long_side'], max(size))
+        target = keep_aspect_size(size[0], size[1], long_side)
+        targets.setdefault(target, ([], False))[0].append(name)
+    # 元の画像より大きい幅は作らない (全て大きすぎる場合は元の幅で 1 つだけ作る)
+    usable = [width for width in widths if width <= size[0]] or [size[0]]
+    for width in usable:
+        target = (width, max(1, round(size[1] * width / size[0])))
+        names, _ = targets.get(target, ([], False))
+        targets[target] = (names, True)
+    return sorted(
+        ((target, names, srcset) for target, (names, srcset) in targets.items()),
+        key=lambda item: item[0][0] * item[0][1],
+        reverse=True,
+    )
+
+
+def _passthrough(img_file, img_format, size):
+    # アップロードされたファイルをコピーせずにそのまま使う (再エンコードしない)
+    img_file.seek(0)
+    return EncodedImage(
+        img_file, size,
+        content_type=Image.MIME[img_format],
+        extension=IMAGE_EXTENSIONS[img_format],
+        format=img_format,
+    )
+
+
+@image_stage('process')
+def process_image(img_file, renditions=None, original_quality=None, srcset_widths=None):
+    """
+    アップロードされた画像から、オリジナル画像と縮小画像を作成する
+
+    - IMAGE_PASSTHROUGH_FORMATS の形式のオリジナル画像は、アップロードされたファイルをそのまま使う
+    - 画像のデコードは 1 回だけ行う (JPEG は最大の縮小画像に必要な大きさまで縮小デコードする)
+    - 縮小画像は大きいものから順に、1 つ前に作ったひと回り大きい画像から作る
+    - srcset 用の縮小画像は、幅ごとに IMAGE_SRCSET_FORMATS の各形式 (WebP / AVIF / JPEG) で作る
+    - EXIF の向きは画素に反映してから、メタデータを含めずにエンコードする
+    - エンコードはスレッドプールで並列に実行し、結果は一時ファイルに逃がせるバッファに書き出す
+    """
+    renditions = renditions or settings.IMAGE_RENDITIONS
+    original_quality = original_quality or settings.IMAGE_ORIGINAL_QUALITY
+    widths = settings.IMAGE_SRCSET_WIDTHS if srcset_widths is None else srcset_widths
+    formats = get_srcset_formats()
+    executor = get_executor()
+
+    img = Image.open(img_file)
+    if img.width * img.height > settings.IMAGE_MAX_PIXELS:
+        raise ImageTooLarge('%dx%d' % img.size)
+    # srcset は幅で指定するので、回転後に縦長になっても足りるように短辺を基準に長辺へ換算する
+    largest = max(
+        [spec['long_side'] for spec in renditions.values()]
+        + [width * max(img.size) // min(img.size) for width in widths]
+        or [None]
+    )
+
+    original_future = None
+    if img.format in settings.IMAGE_PASSTHROUGH_FORMATS:
+        img_format, original_size = img.format, img.size
+        # オリジナルを再エンコードしないので、JPEG はフル解像度でデコードする必要がない
+        decode_image(img, max_long_side=largest)
+        original = _passthrough(img_file, img_format, original_size)
+    else:
+        original = None
+        original_future = executor.submit(encode_jpeg, decode_image(img), original_quality)
+
+    source = img
+    if img.getexif().get(ORIENTATION_TAG, 1) != 1:
+        source = ImageOps.exif_transpose(img)
+    if source.mode not in ('RGB', 'L'):
+        source = source.convert('RGB')
+
+    named, srcset = {}, []
+    for size, names, in_srcset in _targets(source.size, renditions, widths):
+        with image_stage('resize'):
+            resized = source.resize(size, reducing_gap=3.0)
+        for name in names:
+            named[name] = executor.submit(encode_jpeg, resized, renditions[name]['quality'])
+        if in_srcset:
+            for fmt in formats:
+                srcset.append(executor.submit(
+                    encode_image, resized, fmt, settings.IMAGE_FORMAT_QUALITY[fmt.lower()]
+                ))
+        source = resized
+
+    if original_future is not None:
+        original = original_future.result()
+    return ProcessedImage(
+        original,
+        {name: future.result() for name, future in named.items()},
+        [future.result() for future in srcset],
+    )
@@ -0,0 +1,21 @@
+from app.query_plans import register_queryset
+from media.models import Image
+
+# 実行計画を確認するときに使う、適当な値 (実行計画は値によらない)
+SAMPLE_HASH = '0' * 64
+
+
+@register_queryset('media.duplicate')
+def duplicate():
+    # アップロード時の重複の確認 (同じハッシュ値の処理済み画像のうち最も古いもの)
+    return Image.objects.filter(
+        content_hash=SAMPLE_HASH, status=Image.STATUS_READY
+    ).order_by('id')[:1]
+
+
+@register_queryset('media.pending')
+def pending():
+    # database キューのワーカーが処理する pending の画像 (古い順)
+    return Image.objects.filter(
+        status=Image.STATUS_PENDING
+    ).order_by('uploaded_at', 'id').values_list('id', flat=True)[:10]
@@ -1,8 +1,66 @@
+from django.conf import settings
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
-from .models import Image
+from .models import Image, ImageRendition
+
+
+class ImageRenditionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImageRendition
+        fields = ('width', 'height', 'format', 'url', 'bytes')
 
 
 class ImageSerializer(serializers.ModelSerializer):
+    renditions = ImageRenditionSerializer(many=True, read_only=True)
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = Image
-        fields = ('title', 'thumbnail_url', 'display_url', 'original_url', 'uploaded_at')
\ No newline at end of file
+        fields = (
+            'id', 'title', 'status', 'error', 'thumbnail_url', 'display_url', 'original_url',
+            'renditions', 'srcset', 'uploaded_at',
+        )
+
+    def to_representation(self, instance):
+        # renditions と srcset の両方で使うので、先読みしていなければここで 1 回だけ読む
+        if 'renditions' not in getattr(instance, '_prefetched_objects_cache', {}):
+            prefetch_related_objects([instance], 'renditions')
+        return super().to_representation(instance)
+
+    def get_srcset(self, obj):
+        """ 形式ごとの srcset 属性の値 (<picture> の <source> にそのまま使える) """
+        srcset = {}
+        for rendition in sorted(obj.renditions.all(), key=lambda r: r.width):
+            srcset.setdefault(rendition.format, []).append('%s %dw' % (rendition.url, rendition.width))
+        return {fmt: ', '.join(candidates) for fmt, candidates in srcset.items()}
+
+
+class ImageTitleSerializer(serializers.Serializer):
+    """ 画像のアップロード (POST /api/image/ と /api/image/batch/) で指定するタイトル (空は不可) """
+    title = serializers.CharField(max_length=Image._meta.get_field('title').max_length)
+
+
+class UploadSessionCreateSerializer(serializers.Serializer):
+    """ 直接アップロードの開始 (POST /api/image/uploads/) のリクエスト """
+    title = serializers.CharField(max_length=128)
+    filename = serializers.CharField(max_length=256)
+    content_type = serializers.CharField()
+    size = serializers.IntegerField(min_value=1)
+    # マルチパートにならない大きさのときの送り方 ('put' か、HTML のフォームから送る 'post')
+    method = serializers.ChoiceField(choices=('put', 'post'), default='put')
+
+    def validate_content_type(self, value):
+        if value not in settings.IMAGE_DIRECT_UPLOAD_CONTENT_TYPES:
+            raise serializers.ValidationError('unsupported content type: %s' % value)
+        return value
+
+
+class UploadPartSerializer(serializers.Serializer):
+    """ マルチパートアップロードの 1 パート (S3 のパート番号は 1 から 10000 まで) """
+    part_number = serializers.IntegerField(min_value=1, max_value=10000)
+    etag = serializers.CharField(max_length=256)
+
+
+class UploadSessionCompleteSerializer(serializers.Serializer):
+    """ 直接アップロードの完了 (POST /api/image/uploads/<token>/complete/) のリクエスト """
+    parts = UploadPartSerializer(many=True, allow_empty=False)
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from app.revalidation import publish_change
+from media.models import Image
+
+
+def image_revalidation_targets(image_id):
+    """ 画像が変わったときに Next.js で作り直すタグ (画像を使うページは fetch にこのタグを付ける) """
+    return (), ('images', 'image:%d' % image_id)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def revalidate_image(sender, instance, **kwargs):
+    paths, tags = image_revalidation_targets(instance.pk)
+    publish_change(paths, tags)
@@ -0,0 +1,209 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import Image as ImageModel, ImageRendition
+from .pipeline import new_spooled_buffer, process_image
+from .utils import get_content_hash, get_minio_bucket_name, get_minio_client, upload_many
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-queue')
+    return _executor
+
+
+def claim_image(image_id):
+    """
+    pending の画像を processing に変更して、処理を始めた日時を返す (他のワーカーが先に取得していたら None)
+    同じ内容の画像が先に処理待ち・処理中なら取得しない (その画像の処理が終わったら copy_to_duplicates で埋まる)
+    """
+    claimed_at = timezone.now()
+    earlier = ImageModel.objects.filter(
+        content_hash=OuterRef('content_hash'),
+        status__in=(ImageModel.STATUS_PENDING, ImageModel.STATUS_PROCESSING),
+        pk__lt=OuterRef('pk'),
+    ).exclude(content_hash='')
+    claimed = ImageModel.objects.filter(
+        ~Exists(earlier), pk=image_id, status=ImageModel.STATUS_PENDING
+    ).update(status=ImageModel.STATUS_PROCESSING, claimed_at=claimed_at)
+    return claimed_at if claimed == 1 else None
+
+
+def _finish_claim(image_id, claimed_at, status):
+    """
+    自分が取得したままの画像を status に変更する
+    処理が遅れている間に pending に戻されて、他のワーカーが取得し直していたら False
+    """
+    return ImageModel.objects.filter(
+        pk=image_id, status=ImageModel.STATUS_PROCESSING, claimed_at=claimed_at
+    ).update(status=status) == 1
+
+
+def reclaim_stale_images():
+    """
+    IMAGE_PROCESSING_TIMEOUT を過ぎても processing のままの画像を pending に戻し、戻した数を返す
+    (処理中にワーカーが止まったりデプロイで再起動したりすると、processing のまま残るため)
+    """
+    deadline = timezone.now() - timedelta(seconds=settings.IMAGE_PROCESSING_TIMEOUT)
+    reclaimed = ImageModel.objects.filter(
+        Q(claimed_at__lt=deadline) | Q(claimed_at__isnull=True), status=ImageModel.STATUS_PROCESSING,
+    ).update(status=ImageModel.STATUS_PENDING, claimed_at=None)
+    if reclaimed:
+        logger.warning('reclaimed %d image(s) stuck in processing', reclaimed)
+    return reclaimed
+
+
+def rendition_uploads(base_key, processed):
+    """
+    縮小画像を upload_many に渡す形にまとめる
+    名前付きの縮小画像は '<base>_<名前><拡張子>'、srcset 用は '<base>_<幅>w<拡張子>' のキーで保存する
+    """
+    uploads = {
+        name: (rendition.buffer, '%s_%s%s' % (base_key, name, rendition.extension), rendition.content_type)
+        for name, rendition in processed.renditions.items()
+    }
+    for rendition in processed.srcset:
+        key = '%s_%dw%s' % (base_key, rendition.width, rendition.extension)
+        uploads[key] = (rendition.buffer, key, rendition.content_type)
+    return uploads
+
+
+def save_renditions(image, base_key, processed, urls):
+    """ アップロードした srcset 用の縮小画像を ImageRendition としてまとめて保存する """
+    renditions = []
+    for rendition in processed.srcset:
+        key = '%s_%dw%s' % (base_key, rendition.width, rendition.extension)
+        renditions.append(ImageRendition(
+            image=image,
+            width=rendition.width,
+            height=rendition.height,
+            format=rendition.format.lower(),
+            url=urls[key],
+            key=key,
+            bytes=rendition.byte_size,
+        ))
+    ImageRendition.objects.bulk_create(renditions)
+
+
+def _pending_duplicates(image):
+    """ image と同じ内容で処理待ちの画像 (まとめてアップロードされた同じファイルなど) """
+    if not image.content_hash:
+        return ImageModel.objects.none()
+    return ImageModel.objects.filter(
+        content_hash=image.content_hash, status=ImageModel.STATUS_PENDING
+    ).exclude(pk=image.pk)
+
+
+def copy_to_duplicates(image):
+    """
+    処理を終えた image の URL と縮小画像を、同じ内容で処理待ちの画像に写して ready にする (写した数を返す)
+    同じ内容の画像は 1 回だけダウンロード・変換・アップロードする
+    """
+    duplicate_ids = list(_pending_duplicates(image).select_for_update().values_list('pk', flat=True))
+    if not duplicate_ids:
+        return 0
+    ImageModel.objects.filter(pk__in=duplicate_ids).update(
+        display_url=image.display_url, thumbnail_url=image.thumbnail_url, status=ImageModel.STATUS_READY,
+    )
+    renditions = list(image.renditions.all())
+    ImageRendition.objects.bulk_create([
+        ImageRendition(
+            image_id=duplicate_id, width=r.width, height=r.height, format=r.format, url=r.url, key=r.key, bytes=r.bytes,
+        )
+        for duplicate_id in duplicate_ids
+        for r in renditions
+    ])
+    return len(duplicate_ids)
+
+
+def process_pending_image(image_id):
+    """ 保存済みのオリジナル画像から縮小画像を作成して、Image の URL を埋める """
+    claimed_at = claim_image(image_id)
+    if claimed_at is None:
+        return False
+    image = ImageModel.objects.get(pk=image_id)
+    s3 = get_minio_client()
+    bucket = get_minio_bucket_name()
+    try:
+        original = new_spooled_buffer()
+        s3.download_fileobj(bucket, image.original_key, original)
+        # ブラウザから直接アップロードされた画像は、ここで初めて内容を読むのでハッシュ値もここで計算する
+        if not image.content_hash:
+            image.content_hash = get_content_hash(original)
+        original.seek(0)
+        processed = process_image(original)
+        base_key = image.original_key.rsplit('.', 1)[0]
+        urls = upload_many(s3, bucket, rendition_uploads(base_key, processed))
+    except Exception as e:
+        logger.exception('image processing failed: id=%s', image_id)
+        with transaction.atomic():
+            if _finish_claim(image_id, claimed_at, ImageModel.STATUS_FAILED):
+                image.status = ImageModel.STATUS_FAILED
+                image.error = str(e)
+                image.save(update_fields=['status', 'error'])
+                # 同じ内容の画像も同じ理由で失敗する
+                _pending_duplicates(image).update(status=ImageModel.STATUS_FAILED, error=image.error)
+        return False
+
+    with transaction.atomic():
+        if not _finish_claim(image_id, claimed_at, ImageModel.STATUS_READY):
+            logger.warning('image was reclaimed by another worker: id=%s', image_id)
+            return False
+        image.display_url = urls['display']
+        image.thumbnail_url = urls['thumbnail']
+        image.status = ImageModel.STATUS_READY
+        image.save(update_fields=['display_url', 'thumbnail_url', 'status', 'content_hash'])
+        save_renditions(image, base_key, processed, urls)
+        copy_to_duplicates(image)
+    return True
+
+
+def process_pending_images(limit=None):
+    """
+    pending の画像を古いものから順に処理する (database キュー用)
+    先に、処理中に止まったワーカーが残した processing の画像を pending に戻す
+    """
+    reclaim_stale_images()
+    image_ids = ImageModel.objects.filter(
+        status=ImageModel.STATUS_PENDING
+    ).order_by('uploaded_at', 'id').values_list('id', flat=True)
+    if limit:
+        image_ids = image_ids[:limit]
+    return sum(1 for image_id in list(image_ids) if process_pending_image(image_id))
+
+
+def _run_in_thread(image_id):
+    try:
+        process_pending_image(image_id)
+    finally:
+        close_old_connections()
+
+
+def enqueue_image(image_id):
+    """
+    縮小画像の作成をキューに積む
+    Image の行がコミットされてからワーカーに渡るように、トランザクションのコミット後に登録する
+    thread キューはプロセスのメモリ上にあるので、再起動すると処理前の画像は pending のまま残る
+    (再起動しても失われないのは database キューだけ)
+    """
+    backend = settings.IMAGE_QUEUE_BACKEND
+    if backend == 'database':
+        # process_images コマンドのワーカーが pending の行を拾うので、ここでは何もしない
+        return
+    if backend == 'immediate':
+        transaction.on_commit(lambda: process_pending_image(image_id))
+    elif backend == 'thread':
+        transaction.on_commit(lambda: _get_executor().submit(_run_in_thread, image_id))
+    else:
+        raise ValueError('unknown IMAGE_QUEUE_BACKEND: %s' % backend)
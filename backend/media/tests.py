@@ -1,13 +1,37 @@
-from io import BytesIO
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 from PIL import Image
+from prometheus_client import REGISTRY
 
 from django.core.files.uploadedfile import SimpleUploadedFile
-from rest_framework.test import APIClient, APITestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
-from media.models import Image as ImageModel
+from app.testing import BudgetTestMixin
+from media import async_views
+from media.local_storage import LocalObjectStorage, local_storage
+from media.models import Image as ImageModel, UploadSession
+from media.pipeline import ImageTooLarge, decode_image, get_srcset_formats, process_image
+from media.tasks import claim_image, process_pending_image, process_pending_images
+from media.transform import fit_size, get_rendition
+from media.utils import (
+    backfill_content_hashes, get_minio_bucket_name, get_minio_client, get_pool_stats, reset_minio_client,
+    storage_stats, upload_many,
+)
 from media.views import ImageUploadView
 
 
+@override_settings(OBJECT_STORAGE_BACKEND='local')
 class TestImageUploadView(APITestCase):
     def _create_test_image(self, mode='RGB', size=(2000, 1000)):
         """ バッファ上にテスト用の画像を生成する関数 """
@@ -39,6 +63,17 @@ class TestImageUploadView(APITestCase):
         self.assertIn('display_url', response.data)
         self.assertIn('thumbnail_url', response.data)
 
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=10)
+    def test_should_return_413(self):
+        """ 上限を超える大きさのファイルは 413 になることを確認する関数 """
+        test_img_file = SimpleUploadedFile(name="test.jpg", content=self._create_test_image())
+        response = self.client.post(
+            '/api/image/',
+            {'title': 'Test Image', 'image': test_img_file},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 413)
+
     def test_should_return_400(self):
         """ アップロード時に title を指定しないとエラーになることを確認する関数 """
         # テスト用の画像ファイルを作成
@@ -56,4 +91,927 @@ class TestImageUploadView(APITestCase):
         # 1. Status Code 400 が返ってくること
         self.assertEqual(response.status_code, 400)
         # 2. 所望のエラーメッセージが返ってくること
-        self.assertEqual(response.data['error'], 'title and image file are required')
\ No newline at end of file
+        self.assertEqual(response.data['error'], 'title and image file are required')
+
+
+class TestImagePipeline(SimpleTestCase):
+    def _create_test_image(self, mode='RGB', size=(2000, 1000), format='jpeg'):
+        """ バッファ上にテスト用の画像を生成する関数 """
+        img = Image.new(mode, size=size)
+        byte_img = BytesIO()
+        img.save(byte_img, format)
+        byte_img.seek(0)
+        return byte_img
+
+    def test_should_create_configured_renditions(self):
+        """ 設定どおりのサイズの縮小画像が作られることを確認する関数 """
+        processed = process_image(self._create_test_image())
+        self.assertEqual(processed.renditions['display'].size, (1000, 500))
+        self.assertEqual(processed.renditions['thumbnail'].size, (300, 150))
+        self.assertEqual(Image.open(processed.renditions['display'].buffer).format, 'JPEG')
+
+    @override_settings(IMAGE_RENDITIONS={'small': {'long_side': 100, 'quality': 70}})
+    def test_should_follow_settings(self):
+        """ 縮小画像のサイズが設定から読み込まれることを確認する関数 """
+        processed = process_image(self._create_test_image())
+        self.assertEqual(list(processed.renditions), ['small'])
+        self.assertEqual(processed.renditions['small'].size, (100, 50))
+
+    def test_should_keep_original_jpeg_bytes(self):
+        """ JPEG のオリジナル画像は再エンコードせずにそのまま使うことを確認する関数 """
+        test_img = self._create_test_image()
+        processed = process_image(test_img)
+        self.assertEqual(processed.original.buffer.getvalue(), test_img.getvalue())
+        self.assertEqual(processed.original.size, (2000, 1000))
+
+    def test_should_decode_large_jpeg_in_draft_mode(self):
+        """ 大きな JPEG は必要な大きさまで縮小しながらデコードすることを確認する関数 """
+        img = decode_image(Image.open(self._create_test_image(size=(4000, 3000))), 1000)
+        self.assertLess(img.width, 4000)
+        self.assertGreaterEqual(img.width, 1000)
+
+    def test_should_keep_original_png(self):
+        """ 変換不要な形式 (PNG) のオリジナル画像はそのまま使うことを確認する関数 """
+        test_img = self._create_test_image(mode='RGBA', format='png')
+        processed = process_image(test_img)
+        self.assertIs(processed.original.buffer, test_img)
+        self.assertEqual(processed.original.content_type, 'image/png')
+        self.assertEqual(processed.original.extension, '.png')
+        self.assertEqual(processed.original.format, 'PNG')
+        self.assertEqual(processed.renditions['thumbnail'].size, (300, 150))
+
+    def test_should_convert_gif_to_jpeg(self):
+        """ それ以外の形式 (GIF) のオリジナル画像は JPEG に変換することを確認する関数 """
+        processed = process_image(self._create_test_image(mode='P', format='gif'))
+        self.assertEqual(Image.open(processed.original.buffer).format, 'JPEG')
+        self.assertEqual(processed.original.extension, '.jpg')
+        self.assertEqual(processed.renditions['thumbnail'].size, (300, 150))
+
+    @override_settings(IMAGE_SPOOL_MAX_MEMORY=1024)
+    def test_should_spool_large_renditions_to_disk(self):
+        """ 上限を超えた縮小画像はメモリではなく一時ファイルに書き出すことを確認する関数 """
+        img = Image.effect_noise((2000, 1000), 64).convert('RGB')
+        byte_img = BytesIO()
+        img.save(byte_img, 'jpeg')
+        byte_img.seek(0)
+        processed = process_image(byte_img)
+        self.assertTrue(processed.renditions['display'].buffer._rolled)
+
+    @override_settings(IMAGE_MAX_PIXELS=1000)
+    def test_should_reject_too_many_pixels(self):
+        """ 画素数が上限を超える画像は処理しないことを確認する関数 """
+        with self.assertRaises(ImageTooLarge):
+            process_image(self._create_test_image())
+
+    def test_should_not_upscale_small_image(self):
+        """ 縮小画像のサイズより小さい画像は拡大しないことを確認する関数 """
+        processed = process_image(self._create_test_image(size=(200, 100)))
+        self.assertEqual(processed.renditions['display'].size, (200, 100))
+        self.assertEqual(processed.renditions['thumbnail'].size, (200, 100))
+
+
+@override_settings(
+    OBJECT_STORAGE_BACKEND='local',
+    IMAGE_SRCSET_WIDTHS=(320, 640, 1600),
+    IMAGE_SRCSET_FORMATS=('webp', 'jpeg'),
+)
+class TestImageSrcset(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+
+    def _create_test_image(self, size=(2000, 1000), exif=None):
+        """ バッファ上にテスト用の画像を生成する関数 """
+        img = Image.new('RGB', size=size)
+        byte_img = BytesIO()
+        img.save(byte_img, 'jpeg', exif=exif or Image.Exif())
+        byte_img.seek(0)
+        return byte_img
+
+    def test_should_create_widths_in_each_format(self):
+        """ 設定された幅と形式の組み合わせごとに縮小画像が作られることを確認する関数 """
+        processed = process_image(self._create_test_image())
+        self.assertEqual(
+            sorted((r.width, r.format) for r in processed.srcset),
+            [(320, 'JPEG'), (320, 'WEBP'), (640, 'JPEG'), (640, 'WEBP'), (1600, 'JPEG'), (1600, 'WEBP')],
+        )
+        for rendition in processed.srcset:
+            self.assertEqual(Image.open(rendition.buffer).format, rendition.format)
+            self.assertEqual(rendition.height, rendition.width // 2)
+
+    def test_should_not_upscale(self):
+        """ 元の画像より大きい幅の縮小画像は作らないことを確認する関数 """
+        processed = process_image(self._create_test_image(size=(800, 400)))
+        self.assertEqual(sorted({r.width for r in processed.srcset}), [320, 640])
+
+    def test_should_encode_progressive_jpeg_without_metadata(self):
+        """ JPEG は progressive で、EXIF を含めずにエンコードすることを確認する関数 """
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera Maker'
+        processed = process_image(self._create_test_image(exif=exif))
+        jpeg = Image.open(processed.renditions['display'].buffer)
+        self.assertTrue(jpeg.info.get('progressive'))
+        self.assertNotIn('exif', jpeg.info)
+
+    def test_should_apply_exif_orientation(self):
+        """ EXIF の向きを反映した縦長の縮小画像が作られることを確認する関数 """
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        processed = process_image(self._create_test_image(exif=exif))
+        self.assertEqual(processed.renditions['display'].size, (500, 1000))
+        self.assertEqual(max(r.width for r in processed.srcset), 640)
+
+    @override_settings(IMAGE_SRCSET_FORMATS=('avif', 'webp', 'jpeg'))
+    def test_should_skip_unsupported_formats(self):
+        """ Pillow が対応していない形式は作らないことを確認する関数 """
+        with mock.patch('media.pipeline.features.check', return_value=False):
+            self.assertEqual(get_srcset_formats(), ['JPEG'])
+
+    def test_upload_should_expose_renditions(self):
+        """ アップロードした画像の全ての縮小画像と srcset が API で得られることを確認する関数 """
+        response = self.client.post(
+            '/api/image/',
+            {'title': 'Test Image', 'image': SimpleUploadedFile(name="test.jpg", content=self._create_test_image().getvalue())},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['renditions']), 6)
+        webp = [r for r in response.data['renditions'] if r['format'] == 'webp']
+        self.assertEqual([r['width'] for r in webp], [320, 640, 1600])
+        key = webp[0]['url'].rsplit('/', 1)[1]
+        self.assertTrue(key.endswith('_320w.webp'))
+        self.assertEqual(local_storage.head_object(Bucket='blog-bucket', Key=key)['ContentType'], 'image/webp')
+        self.assertEqual(
+            response.data['srcset']['webp'],
+            ', '.join('%s %dw' % (r['url'], r['width']) for r in webp),
+        )
+
+
+@override_settings(
+    OBJECT_STORAGE_BACKEND='local',
+    IMAGE_PROCESSING_MODE='async',
+    IMAGE_QUEUE_BACKEND='database',
+)
+class TestAsyncImageUpload(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+
+    def _upload(self, format='jpeg'):
+        img = Image.new('RGB', size=(2000, 1000))
+        byte_img = BytesIO()
+        img.save(byte_img, format)
+        test_img_file = SimpleUploadedFile(name="test." + format, content=byte_img.getvalue())
+        return self.client.post(
+            '/api/image/',
+            {'title': 'Test Image', 'image': test_img_file},
+            format='multipart'
+        )
+
+    def test_should_return_202_and_pending(self):
+        """ 非同期モードでは、縮小画像を作らずに 202 を返すことを確認する関数 """
+        response = self._upload()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(response.data['display_url'], '')
+        self.assertEqual(response['Location'], '/api/image/%d/' % response.data['id'])
+
+    def test_worker_should_fill_urls(self):
+        """ ワーカーが処理した後は、状態確認 API で縮小画像の URL が得られることを確認する関数 """
+        response = self._upload(format='png')
+        self.assertEqual(process_pending_images(), 1)
+
+        status = self.client.get(response['Location'])
+        self.assertEqual(status.data['status'], 'ready')
+        image = ImageModel.objects.get(pk=response.data['id'])
+        key = image.display_url.rsplit('/', 1)[1]
+        display = Image.open(local_storage.get_object(Bucket='blog-bucket', Key=key)['Body'])
+        self.assertEqual(display.size, (1000, 500))
+        self.assertTrue(status.data['renditions'])
+
+    def test_worker_should_mark_failed(self):
+        """ オリジナル画像を処理できなかった場合は failed になることを確認する関数 """
+        response = self._upload()
+        local_storage.clear()
+        with self.assertLogs('media.tasks', level='ERROR'):
+            process_pending_images()
+        status = self.client.get(response['Location'])
+        self.assertEqual(status.data['status'], 'failed')
+        self.assertNotEqual(status.data['error'], '')
+
+    @override_settings(IMAGE_QUEUE_BACKEND='immediate')
+    def test_immediate_queue_should_process_after_commit(self):
+        """ immediate キューではコミット直後に処理されることを確認する関数 """
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._upload()
+        status = self.client.get(response['Location'], {'wait': 1})
+        self.assertEqual(status.data['status'], 'ready')
+
+    def test_worker_should_reclaim_stuck_image(self):
+        """ ワーカーが止まって processing のまま残った画像は、タイムアウト後に処理し直されることを確認する関数 """
+        response = self._upload()
+        image_id = response.data['id']
+        self.assertIsNotNone(claim_image(image_id))
+        # タイムアウト前は他のワーカーの処理中として扱う
+        self.assertEqual(process_pending_images(), 0)
+        self.assertEqual(ImageModel.objects.get(pk=image_id).status, 'processing')
+
+        ImageModel.objects.filter(pk=image_id).update(claimed_at=timezone.now() - timedelta(seconds=601))
+        with self.assertLogs('media.tasks', level='WARNING'):
+            self.assertEqual(process_pending_images(), 1)
+        status = self.client.get(response['Location'])
+        self.assertEqual(status.data['status'], 'ready')
+
+    def test_reclaimed_image_should_not_be_finished_by_stale_worker(self):
+        """ pending に戻された後に、遅れていたワーカーが結果を書き込まないことを確認する関数 """
+        response = self._upload()
+        image_id = response.data['id']
+        stale_claim = claim_image(image_id)
+        ImageModel.objects.filter(pk=image_id).update(claimed_at=stale_claim - timedelta(seconds=601))
+        # 遅れていたワーカーは、自分が取得したときの日時と一致しないので結果を捨てる
+        with mock.patch('media.tasks.claim_image', return_value=stale_claim), \
+                self.assertLogs('media.tasks', level='WARNING'):
+            self.assertFalse(process_pending_image(image_id))
+        self.assertEqual(ImageModel.objects.get(pk=image_id).status, 'processing')
+        self.assertFalse(ImageModel.objects.get(pk=image_id).renditions.exists())
+
+    def test_should_reject_non_image(self):
+        """ 画像でないファイルは 400 になることを確認する関数 """
+        response = self.client.post(
+            '/api/image/',
+            {'title': 'Test', 'image': SimpleUploadedFile(name="test.txt", content=b'hello')},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TestMinioClient(SimpleTestCase):
+    def setUp(self):
+        reset_minio_client()
+        storage_stats.reset()
+
+    def tearDown(self):
+        reset_minio_client()
+
+    @override_settings(OBJECT_STORAGE_BACKEND='minio')
+    def test_should_share_client(self):
+        """ クライアントがプロセス内で 1 つだけ作られることを確認する関数 """
+        clients = [get_minio_client() for _ in range(5)]
+        self.assertTrue(all(client is clients[0] for client in clients))
+        self.assertEqual(get_pool_stats()['clients_created'], 1)
+        self.assertEqual(clients[0].meta.config.max_pool_connections, 20)
+
+    @override_settings(OBJECT_STORAGE_BACKEND='local')
+    def test_should_upload_concurrently(self):
+        """ 複数の画像が並列にアップロードされることを確認する関数 """
+        stub = LocalObjectStorage(latency=0.1)
+        items = {
+            name: (BytesIO(b'x' * 10), name + '.jpg', 'image/jpeg')
+            for name in ('original', 'display', 'thumbnail')
+        }
+        started = time.perf_counter()
+        urls = upload_many(stub, 'blog-bucket', items)
+        elapsed = time.perf_counter() - started
+
+        self.assertLess(elapsed, 0.25)
+        self.assertEqual(urls['display'], 'http://localhost:9000/blog-bucket/display.jpg')
+        stats = get_pool_stats()
+        self.assertEqual(stats['uploads'], 3)
+        self.assertEqual(stats['upload_bytes'], 30)
+        self.assertEqual(stats['max_in_flight'], 3)
+
+
+@override_settings(OBJECT_STORAGE_BACKEND='local')
+class TestImageDeduplication(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+        img = Image.new('RGB', size=(2000, 1000))
+        byte_img = BytesIO()
+        img.save(byte_img, 'jpeg')
+        self.content = byte_img.getvalue()
+
+    def _upload(self, title='Test Image'):
+        return self.client.post(
+            '/api/image/',
+            {'title': title, 'image': SimpleUploadedFile(name="test.jpg", content=self.content)},
+            format='multipart'
+        )
+
+    def test_should_use_content_hash_as_key(self):
+        """ 画像の内容のハッシュ値がモデルとオブジェクトキーに使われることを確認する関数 """
+        response = self._upload()
+        content_hash = hashlib.sha256(self.content).hexdigest()
+        image = ImageModel.objects.get(pk=response.data['id'])
+        self.assertEqual(image.content_hash, content_hash)
+        self.assertTrue(image.original_url.endswith('/%s.jpg' % content_hash))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_should_hash_file_spooled_to_disk(self):
+        """ 一時ファイルに書き出されたアップロードでもハッシュ値が計算されることを確認する関数 """
+        response = self._upload()
+        image = ImageModel.objects.get(pk=response.data['id'])
+        self.assertEqual(image.content_hash, hashlib.sha256(self.content).hexdigest())
+
+    def test_duplicate_should_skip_processing(self):
+        """ 同じ画像を再度アップロードしたときは、処理も保存もせずに既存の URL を返すことを確認する関数 """
+        first = self._upload()
+        with mock.patch('media.views.process_image') as process, \
+                mock.patch('media.views.upload_many') as upload:
+            second = self._upload(title='Another Title')
+        process.assert_not_called()
+        upload.assert_not_called()
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.data['title'], 'Another Title')
+        self.assertNotEqual(second.data['id'], first.data['id'])
+        self.assertEqual(second.data['display_url'], first.data['display_url'])
+        self.assertEqual(second.data['thumbnail_url'], first.data['thumbnail_url'])
+        self.assertEqual(second.data['srcset'], first.data['srcset'])
+
+    def test_should_backfill_existing_images(self):
+        """ ハッシュ値のない既存の画像について、保存済みの画像からハッシュ値を埋められることを確認する関数 """
+        local_storage.put_object(Bucket='blog-bucket', Key='legacy.jpg', Body=self.content)
+        image = ImageModel.objects.create(
+            title='legacy', original_url='http://localhost:9000/blog-bucket/legacy.jpg'
+        )
+        missing = ImageModel.objects.create(
+            title='missing', original_url='http://localhost:9000/blog-bucket/missing.jpg'
+        )
+        self.assertEqual(backfill_content_hashes(ImageModel), 1)
+        image.refresh_from_db()
+        missing.refresh_from_db()
+        self.assertEqual(image.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(missing.content_hash, '')
+
+
+@override_settings(OBJECT_STORAGE_BACKEND='local')
+class TestAsyncImageViews(APITransactionTestCase):
+    """
+    ASGI 用の非同期版の画像 API を確認する
+    アップロードは別のスレッド (別の接続) で処理されるので、トランザクションで囲まないテストにする
+    """
+
+    def setUp(self):
+        local_storage.clear()
+        self.factory = AsyncRequestFactory()
+
+    def _create_test_image(self):
+        byte_img = BytesIO()
+        Image.new('RGB', size=(800, 600)).save(byte_img, 'jpeg')
+        return byte_img.getvalue()
+
+    async def test_upload_should_return_201(self):
+        request = self.factory.post('/api/image/', {
+            'title': 'Async Image',
+            'image': SimpleUploadedFile('test.jpg', self._create_test_image(), content_type='image/jpeg'),
+        })
+        response = await async_views.image_upload(request)
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.content)
+        self.assertEqual(data['title'], 'Async Image')
+
+        response = await async_views.image_detail(self.factory.get('/api/image/'), pk=data['id'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['display_url'], data['display_url'])
+
+    async def test_upload_should_validate(self):
+        response = await async_views.image_upload(self.factory.post('/api/image/', {'title': 'No File'}))
+        self.assertEqual(response.status_code, 400)
+
+    async def test_batch_upload_should_return_results(self):
+        request = self.factory.post('/api/image/batch/', {
+            'image': [
+                SimpleUploadedFile('test.jpg', self._create_test_image(), content_type='image/jpeg'),
+                SimpleUploadedFile('notes.txt', b'hello'),
+            ],
+            'title': 'test',
+        })
+        response = await async_views.image_batch_upload(request)
+        self.assertEqual(response.status_code, 207)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], [201, 400])
+        self.assertEqual(results[0]['image']['title'], 'test')
+
+    async def test_rendition_should_redirect(self):
+        request = self.factory.post('/api/image/', {
+            'title': 'Async Image',
+            'image': SimpleUploadedFile('test.jpg', self._create_test_image(), content_type='image/jpeg'),
+        })
+        data = json.loads((await async_views.image_upload(request)).content)
+        response = await async_views.image_rendition(
+            self.factory.get('/'), pk=data['id'], width=160, height=160, fmt='jpeg',
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('_160w.jpg'))
+
+    async def test_detail_should_return_404(self):
+        response = await async_views.image_detail(self.factory.get('/api/image/0/'), pk=0)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_detail_should_wait_until_ready(self):
+        image = await ImageModel.objects.acreate(title='pending', status=ImageModel.STATUS_PENDING)
+
+        async def finish():
+            await asyncio.sleep(0.1)
+            image.status = ImageModel.STATUS_READY
+            await image.asave(update_fields=['status'])
+
+        response, _ = await asyncio.gather(
+            async_views.image_detail(self.factory.get('/api/image/?wait=5'), pk=image.pk),
+            finish(),
+        )
+        self.assertEqual(json.loads(response.content)['status'], 'ready')
+
+
+    async def test_detail_should_reject_invalid_token_like_sync_view(self):
+        """ 不正なトークンを送ると、同期版と同じく 401 を返すことを確認する関数 """
+        image = await ImageModel.objects.acreate(title='ready')
+        headers = {'Authorization': 'Bearer broken'}
+        response = await async_views.image_detail(
+            self.factory.get('/api/image/%d/' % image.pk, headers=headers), pk=image.pk,
+        )
+        self.assertEqual(response.status_code, 401)
+        expected = await self.async_client.get('/api/image/%d/' % image.pk, headers=headers)
+        self.assertEqual(expected.status_code, 401)
+
+
+class TestImageRevalidation(APITestCase):
+    @override_settings(REVALIDATION_WEBHOOK_URL='http://frontend/api/revalidate')
+    def test_should_publish_image_tags_after_commit(self):
+        with mock.patch('app.revalidation.dispatcher.publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                image = ImageModel.objects.create(title='image')
+                publish.assert_not_called()
+        publish.assert_called_once_with((), ('images', 'image:%d' % image.pk))
+
+
+@override_settings(OBJECT_STORAGE_BACKEND='local')
+class TestImageBatchUpload(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+
+    def _file(self, color=0, name='test.jpg', size=(800, 600)):
+        byte_img = BytesIO()
+        Image.new('RGB', size=size, color=(color * 40, 0, 0)).save(byte_img, 'jpeg')
+        return SimpleUploadedFile(name=name, content=byte_img.getvalue(), content_type='image/jpeg')
+
+    def _upload(self, files, titles=('photo',)):
+        return self.client.post(
+            '/api/image/batch/', {'image': files, 'title': list(titles)}, format='multipart'
+        )
+
+    def test_should_create_all_images_with_one_insert(self):
+        """ 全てのファイルが成功したら 201 を返し、Image をまとめて 1 回の INSERT で作ることを確認する関数 """
+        with CaptureQueriesContext(connection) as queries:
+            response = self._upload([self._file(n, 'photo%d.jpg' % n) for n in range(3)], ['a', 'b', 'c'])
+        self.assertEqual(response.status_code, 201)
+        results = response.data['results']
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual([r['image']['title'] for r in results], ['a', 'b', 'c'])
+        self.assertEqual(len({r['image']['display_url'] for r in results}), 3)
+        self.assertTrue(all(r['image']['renditions'] for r in results))
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "media_image"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ImageModel.objects.count(), 3)
+
+    def test_should_use_shared_title(self):
+        """ タイトルが 1 つなら全ファイルに使うことを確認する関数 """
+        response = self._upload([self._file(1), self._file(2)], ['gallery'])
+        self.assertEqual([r['image']['title'] for r in response.data['results']], ['gallery', 'gallery'])
+
+    def test_should_validate_titles_like_single_upload(self):
+        """ タイトルは 1 枚ずつのアップロードと同じく必須で、空や長すぎるタイトルのファイルは失敗することを確認する関数 """
+        self.assertEqual(self._upload([self._file(1)], []).status_code, 400)
+        response = self._upload([self._file(1), self._file(2), self._file(3)], ['ok', '', 'x' * 129])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([r['status'] for r in response.data['results']], [201, 400, 400])
+        self.assertTrue(all(r['error'].startswith('title: ') for r in response.data['results'][1:]))
+        self.assertEqual(ImageModel.objects.count(), 1)
+
+    def test_partial_failure_should_return_207(self):
+        """ 一部のファイルが失敗したら、他のファイルは登録して 207 とファイルごとの結果を返すことを確認する関数 """
+        response = self._upload([
+            self._file(1),
+            SimpleUploadedFile(name='notes.txt', content=b'hello'),
+            self._file(2),
+        ])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([r['status'] for r in response.data['results']], [201, 400, 201])
+        self.assertIn('invalid image file', response.data['results'][1]['error'])
+        self.assertNotIn('image', response.data['results'][1])
+        self.assertEqual(ImageModel.objects.count(), 2)
+
+    @override_settings(IMAGE_MAX_PIXELS=1000)
+    def test_should_report_too_large_image(self):
+        response = self._upload([self._file(1)])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['results'][0]['status'], 413)
+        self.assertFalse(ImageModel.objects.exists())
+
+    def test_should_process_same_content_once(self):
+        """ アップロード済みの画像や同じリクエスト内の同じ画像は、1 回だけ処理することを確認する関数 """
+        existing = self._upload([self._file(1)]).data['results'][0]['image']
+        with mock.patch('media.batch.process_image', wraps=process_image) as process:
+            response = self._upload([self._file(1), self._file(2), self._file(2)])
+        self.assertEqual(process.call_count, 1)
+        results = [r['image'] for r in response.data['results']]
+        self.assertEqual(results[0]['display_url'], existing['display_url'])
+        self.assertEqual(results[0]['srcset'], existing['srcset'])
+        self.assertEqual(results[1]['srcset'], results[2]['srcset'])
+        self.assertNotEqual(results[1]['id'], results[2]['id'])
+
+    @override_settings(IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='database')
+    def test_async_mode_should_return_202(self):
+        response = self._upload([self._file(1), self._file(2)])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual({r['image']['status'] for r in response.data['results']}, {'pending'})
+        self.assertEqual(process_pending_images(), 2)
+
+    @override_settings(IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='database')
+    def test_async_mode_should_process_same_content_once(self):
+        """ async モードでも同じ内容のファイルは 1 回だけ処理し、全ての行が ready になることを確認する関数 """
+        response = self._upload([self._file(1), self._file(1), self._file(1)])
+        self.assertEqual(response.status_code, 202)
+        with mock.patch('media.tasks.process_image', wraps=process_image) as process:
+            self.assertEqual(process_pending_images(), 1)
+        self.assertEqual(process.call_count, 1)
+        images = ImageModel.objects.prefetch_related('renditions').order_by('id')
+        self.assertEqual([image.status for image in images], [ImageModel.STATUS_READY] * 3)
+        self.assertEqual(len({image.display_url for image in images}), 1)
+        self.assertEqual(len({tuple(r.url for r in image.renditions.all()) for image in images}), 1)
+        self.assertTrue(images[0].renditions.exists())
+
+    @override_settings(IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='database')
+    def test_async_mode_should_fail_same_content_together(self):
+        self._upload([self._file(1), self._file(1)])
+        # 先の画像が処理待ちの間は、同じ内容の画像を取得しない
+        follower = ImageModel.objects.order_by('id').last()
+        self.assertIsNone(claim_image(follower.id))
+        with mock.patch('media.tasks.process_image', side_effect=ValueError('broken')):
+            self.assertEqual(process_pending_images(), 0)
+        self.assertEqual(
+            list(ImageModel.objects.values_list('status', 'error')), [(ImageModel.STATUS_FAILED, 'broken')] * 2,
+        )
+
+    @override_settings(IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='immediate')
+    def test_async_mode_should_enqueue_same_content_once(self):
+        with mock.patch('media.batch.enqueue_image') as enqueue:
+            self._upload([self._file(1), self._file(2), self._file(1)])
+        self.assertEqual(enqueue.call_count, 2)
+
+    @override_settings(IMAGE_BATCH_MAX_FILES=2)
+    def test_should_validate_request(self):
+        self.assertEqual(self._upload([]).status_code, 400)
+        self.assertEqual(self._upload([self._file(n) for n in range(3)]).status_code, 400)
+        self.assertEqual(self._upload([self._file(1), self._file(2)], ['a', 'b', 'c']).status_code, 400)
+
+    @override_settings(REVALIDATION_WEBHOOK_URL='http://frontend/api/revalidate')
+    def test_should_publish_image_tags_once(self):
+        with mock.patch('app.revalidation.dispatcher.publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self._upload([self._file(1), self._file(2)])
+        ids = [r['image']['id'] for r in response.data['results']]
+        publish.assert_called_once()
+        self.assertEqual(set(publish.call_args[0][1]), {'images', *('image:%d' % pk for pk in ids)})
+
+
+@override_settings(OBJECT_STORAGE_BACKEND='local', IMAGE_QUEUE_BACKEND='database')
+class TestDirectUpload(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+        reset_minio_client()
+        self.content = self._image()
+
+    def _image(self, size=(800, 600)):
+        byte_img = BytesIO()
+        Image.new('RGB', size=size, color=(200, 100, 0)).save(byte_img, 'jpeg')
+        return byte_img.getvalue()
+
+    def _create(self, content=None, **data):
+        content = self.content if content is None else content
+        data = {'title': 'Direct', 'filename': 'photo.jpg', 'content_type': 'image/jpeg', 'size': len(content), **data}
+        return self.client.post('/api/image/uploads/', data, format='json')
+
+    def _stored(self, key):
+        return any(stored == key for _, stored in local_storage._objects)
+
+    def _complete(self, session, parts=None):
+        return self.client.post(session['complete_url'], {'parts': parts or []}, format='json')
+
+    def test_put_upload_should_create_pending_image(self):
+        """ 署名付き URL に PUT した画像から、pending の Image を作って縮小画像をキューで作ることを確認する関数 """
+        response = self._create()
+        self.assertEqual(response.status_code, 201)
+        upload = response.data['upload']
+        self.assertEqual(upload['method'], 'PUT')
+        self.assertTrue(response.data['key'].endswith('.jpg'))
+        local_storage.request('PUT', upload['url'], self.content, upload['headers'])
+
+        response = self._complete(response.data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(response['Location'], '/api/image/%d/' % response.data['id'])
+        self.assertEqual(process_pending_images(), 1)
+        image = ImageModel.objects.get()
+        self.assertEqual(image.status, ImageModel.STATUS_READY)
+        self.assertEqual(image.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertTrue(image.renditions.exists())
+
+    def test_post_upload_should_check_policy(self):
+        """ フォームからの POST は、ポリシーで宣言した大きさと Content-Type しか受け付けないことを確認する関数 """
+        response = self._create(method='post')
+        upload = response.data['upload']
+        self.assertEqual(upload['method'], 'POST')
+        with self.assertRaises(Exception):
+            local_storage.request('POST', upload['url'], self.content + b'extra', fields=upload['fields'])
+        with self.assertRaises(Exception):
+            local_storage.request(
+                'POST', upload['url'], self.content, fields={**upload['fields'], 'Content-Type': 'text/html'},
+            )
+        local_storage.request('POST', upload['url'], self.content, fields=upload['fields'])
+        self.assertEqual(self._complete(response.data).status_code, 202)
+
+    @override_settings(IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD=4096, MINIO_MULTIPART_CHUNKSIZE=4096)
+    def test_multipart_upload(self):
+        """ 大きな画像はパートごとの URL を返し、ETag を揃えて完了できることを確認する関数 """
+        content = self._image((1600, 1200))
+        response = self._create(content)
+        upload = response.data['upload']
+        self.assertEqual(upload['method'], 'multipart')
+        self.assertEqual(len(upload['parts']), -(-len(content) // 4096))
+        parts = []
+        for part in upload['parts']:
+            offset = (part['part_number'] - 1) * upload['part_size']
+            result = local_storage.request('PUT', part['url'], content[offset:offset + upload['part_size']])
+            parts.append({'part_number': part['part_number'], 'etag': result['ETag']})
+
+        self.assertEqual(self._complete(response.data, [{'part_number': 1}]).status_code, 400)
+        response = self._complete(response.data, parts)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(process_pending_images(), 1)
+        self.assertEqual(ImageModel.objects.get().content_hash, hashlib.sha256(content).hexdigest())
+
+    def test_should_reject_unexpected_object(self):
+        """ 宣言と違う大きさのオブジェクトや画像でないオブジェクトは、削除して 400 を返すことを確認する関数 """
+        response = self._create()
+        self.assertEqual(self._complete(response.data).status_code, 400)
+
+        local_storage.request('PUT', response.data['upload']['url'], self.content[:-1], {'Content-Type': 'image/jpeg'})
+        self.assertEqual(self._complete(response.data).status_code, 400)
+        self.assertFalse(self._stored(response.data['key']))
+
+        not_image = b'x' * len(self.content)
+        response = self._create(not_image)
+        local_storage.request('PUT', response.data['upload']['url'], not_image, {'Content-Type': 'image/jpeg'})
+        response = self._complete(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('not a supported image', response.data['error'])
+        self.assertFalse(ImageModel.objects.exists())
+
+    def test_should_reject_tampered_or_expired_url(self):
+        upload = self._create().data['upload']
+        with self.assertRaises(Exception):
+            local_storage.request('PUT', upload['url'], self.content, {'Content-Type': 'text/html'})
+        with self.assertRaises(Exception):
+            local_storage.request('PUT', upload['url'].replace('uploads/', 'other/'), self.content, upload['headers'])
+        with override_settings(IMAGE_DIRECT_UPLOAD_EXPIRES=-10):
+            upload = self._create().data['upload']
+        with mock.patch('media.local_storage.time.time', return_value=time.time() + 60):
+            with self.assertRaises(Exception):
+                local_storage.request('PUT', upload['url'], self.content, upload['headers'])
+
+    def test_complete_should_be_idempotent(self):
+        """ 同じセッションの完了を何度送っても、Image は 1 つだけ作ることを確認する関数 """
+        response = self._create()
+        local_storage.request('PUT', response.data['upload']['url'], self.content, response.data['upload']['headers'])
+        first = self._complete(response.data)
+        second = self._complete(response.data)
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(ImageModel.objects.count(), 1)
+
+    def test_abort_should_delete_object(self):
+        response = self._create()
+        local_storage.request('PUT', response.data['upload']['url'], self.content, response.data['upload']['headers'])
+        detail = '/api/image/uploads/%s/' % response.data['token']
+        self.assertEqual(self.client.delete(detail).status_code, 204)
+        self.assertFalse(self._stored(response.data['key']))
+        self.assertEqual(UploadSession.objects.get().status, UploadSession.STATUS_ABORTED)
+        self.assertEqual(self._complete(response.data).status_code, 409)
+        self.assertEqual(self.client.delete(detail).status_code, 409)
+
+    @override_settings(IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD=4096, MINIO_MULTIPART_CHUNKSIZE=4096)
+    def test_complete_should_validate_part_numbers(self):
+        """ 整数でないパート番号や範囲外のパート番号は、ストレージに渡さずに 400 を返すことを確認する関数 """
+        response = self._create(self._image((1600, 1200)))
+        for part_number in ('abc', 0, 10001, None):
+            complete = self._complete(response.data, [{'part_number': part_number, 'etag': '"x"'}])
+            self.assertEqual(complete.status_code, 400)
+            self.assertIn('part_number', complete.data['parts'][0])
+
+    def test_complete_should_reject_expired_session(self):
+        """ 有効期限が切れたセッションは、オブジェクトがあっても完了できないことを確認する関数 """
+        response = self._create()
+        local_storage.request('PUT', response.data['upload']['url'], self.content, response.data['upload']['headers'])
+        UploadSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self._complete(response.data).status_code, 410)
+        self.assertFalse(ImageModel.objects.exists())
+
+    def test_should_abort_expired_sessions(self):
+        """ 期限切れのセッションを中止して、途中までのパートとオブジェクトを削除することを確認する関数 """
+        single = self._create().data
+        local_storage.request('PUT', single['upload']['url'], self.content, single['upload']['headers'])
+        with override_settings(IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD=4096, MINIO_MULTIPART_CHUNKSIZE=4096):
+            multipart = self._create(self._image((1600, 1200))).data
+        part = multipart['upload']['parts'][0]
+        local_storage.request('PUT', part['url'], b'x' * multipart['upload']['part_size'])
+        active = self._create().data
+        UploadSession.objects.exclude(token=active['token']).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        stdout = StringIO()
+        call_command('abort_expired_uploads', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'aborted 2 expired upload session(s)')
+        self.assertFalse(self._stored(single['key']))
+        self.assertEqual(local_storage._multipart, {})
+        self.assertEqual(
+            dict(UploadSession.objects.values_list('key', 'status')),
+            {single['key']: 'aborted', multipart['key']: 'aborted', active['key']: 'pending'},
+        )
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=100)
+    def test_should_validate_request(self):
+        self.assertEqual(self._create(content_type='text/html').status_code, 400)
+        self.assertEqual(self._create(size=0).status_code, 400)
+        self.assertEqual(self._create().status_code, 413)
+        self.assertFalse(UploadSession.objects.exists())
+
+
+@override_settings(
+    OBJECT_STORAGE_BACKEND='local',
+    IMAGE_SRCSET_WIDTHS=(640,),
+    IMAGE_TRANSFORM_SIZES=((160, 160), (320, 320), (640, 640), (1600, 1600)),
+    IMAGE_TRANSFORM_FORMATS=('webp', 'jpeg'),
+)
+class TestImageRendition(APITestCase):
+    def setUp(self):
+        local_storage.clear()
+
+    def _upload(self, size=(800, 600), orientation=None):
+        img = Image.new('RGB', size=size, color=(0, 120, 200))
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        byte_img = BytesIO()
+        img.save(byte_img, 'jpeg', exif=exif)
+        response = self.client.post('/api/image/', {
+            'title': 'Rendition',
+            'image': SimpleUploadedFile('test.jpg', byte_img.getvalue(), content_type='image/jpeg'),
+        }, format='multipart')
+        return ImageModel.objects.get(pk=response.data['id'])
+
+    def test_should_generate_once_and_redirect(self):
+        """ 初めての要求で縮小画像を作って保存し、2 回目からは保存したものにリダイレクトすることを確認する関数 """
+        image = self._upload()
+        with mock.patch.object(local_storage, 'download_fileobj', wraps=local_storage.download_fileobj) as download:
+            first = self.client.get('/api/image/%d/320x320.webp' % image.pk)
+            second = self.client.get('/api/image/%d/320x320.webp' % image.pk)
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertTrue(first['Location'].endswith('_320w.webp'))
+        self.assertIn('max-age=', first['Cache-Control'])
+        self.assertEqual(download.call_count, 1)
+
+        rendition = image.renditions.get(width=320, format='webp')
+        self.assertEqual((rendition.height, rendition.url), (240, first['Location']))
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (800, 600))
+        stored = Image.open(BytesIO(local_storage.get_object(Bucket=get_minio_bucket_name(), Key=rendition.key)['Body'].read()))
+        self.assertEqual((stored.format, stored.size), ('WEBP', (320, 240)))
+
+    def test_should_derive_key_of_legacy_image(self):
+        """ original_key を保存する前の画像は、オリジナル画像の URL からキーを求めて縮小画像を作ることを確認する関数 """
+        image = self._upload()
+        ImageModel.objects.filter(pk=image.pk).update(original_key='')
+        response = self.client.get('/api/image/%d/320x320.jpeg' % image.pk)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(image.original_key.rsplit('.', 1)[0] + '_320w.jpg'))
+
+        ImageModel.objects.filter(pk=image.pk).update(original_url='')
+        self.assertEqual(self.client.get('/api/image/%d/160x160.jpeg' % image.pk).status_code, 404)
+
+    def test_should_reuse_srcset_rendition(self):
+        """ アップロード時に作った同じ幅と形式の縮小画像があれば、新しく作らないことを確認する関数 """
+        image = self._upload()
+        srcset = image.renditions.get(width=640, format='jpeg')
+        with mock.patch('media.transform.encode_image') as encode:
+            response = self.client.get('/api/image/%d/640x640.jpg' % image.pk)
+        self.assertEqual(response['Location'], srcset.url)
+        encode.assert_not_called()
+        self.assertEqual(image.renditions.filter(width=640, format='jpeg').count(), 1)
+
+    def test_should_not_upscale_and_should_respect_orientation(self):
+        image = self._upload(orientation=6)
+        response = self.client.get('/api/image/%d/320x320.jpeg' % image.pk)
+        self.assertTrue(response['Location'].endswith('_240w.jpg'))
+        response = self.client.get('/api/image/%d/1600x1600.jpeg' % image.pk)
+        self.assertTrue(response['Location'].endswith('_600w.jpg'))
+        self.assertEqual(image.renditions.get(width=600, format='jpeg').height, 800)
+
+    def test_should_reject_sizes_and_formats_outside_allow_list(self):
+        image = self._upload()
+        self.assertEqual(self.client.get('/api/image/%d/333x333.jpeg' % image.pk).status_code, 404)
+        self.assertEqual(self.client.get('/api/image/%d/320x320.gif' % image.pk).status_code, 404)
+        self.assertEqual(self.client.get('/api/image/0/320x320.jpeg').status_code, 404)
+        self.assertFalse(image.renditions.filter(width=333).exists())
+
+    def test_fit_size(self):
+        self.assertEqual(fit_size(800, 600, 320, 320), (320, 240))
+        self.assertEqual(fit_size(600, 800, 320, 320), (240, 320))
+        self.assertEqual(fit_size(2400, 1600, 1200, 630), (945, 630))
+        self.assertEqual(fit_size(100, 50, 320, 320), (100, 50))
+
+
+class TestRenditionSingleFlight(SimpleTestCase):
+    def test_concurrent_requests_should_generate_once(self):
+        """ 同じ縮小画像への同時の要求は、1 回だけ作ってその結果を共有することを確認する関数 """
+        started = threading.Event()
+        release = threading.Event()
+        rendition = object()
+
+        def slow_generate(image, box, fmt):
+            started.set()
+            release.wait(5)
+            return rendition
+
+        image = ImageModel(pk=1)
+        with mock.patch('media.transform.generate_rendition', side_effect=slow_generate) as generate:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(get_rendition(image, (320, 320), 'webp')))
+                for _ in range(5)
+            ]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(results, [rendition] * 5)
+
+
+@override_settings(OBJECT_STORAGE_BACKEND='local')
+class TestImageUploadBudget(BudgetTestMixin, APITestCase):
+    """ 画像のアップロードのクエリの数・時間・ストレージの呼び出しの予算 """
+
+    def setUp(self):
+        local_storage.clear()
+
+    def _upload(self, color):
+        byte_img = BytesIO()
+        Image.new('RGB', size=(1200, 800), color=(color, 0, 0)).save(byte_img, 'jpeg')
+        return self.client.post('/api/image/', {
+            'title': 'Budget',
+            'image': SimpleUploadedFile('test.jpg', byte_img.getvalue(), content_type='image/jpeg'),
+        }, format='multipart')
+
+    def test_sync_upload(self):
+        # 重複の確認・Image と ImageRendition の INSERT (とセーブポイント)・レスポンス用の ImageRendition の読み込み
+        with self.assertWithinBudget(queries=6, ms=5000, storage_calls=1) as metrics:
+            response = self._upload(10)
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('storage;dur=', response['Server-Timing'])
+        self.assertEqual(metrics.counts['storage'], 1)
+
+    def test_duplicate_upload(self):
+        self._upload(20)
+        # 既存の画像の ImageRendition を読んで複製するので、1 つ多い
+        with self.assertWithinBudget(queries=7, ms=1000, storage_calls=0):
+            response = self._upload(20)
+        self.assertEqual(response.status_code, 201)
+
+    def test_should_record_pipeline_and_storage_metrics(self):
+        def value(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        stages = ('process', 'decode', 'resize', 'encode_jpeg')
+        before = {stage: value('image_processing_stage_duration_seconds_count', stage=stage) for stage in stages}
+        uploaded = value('storage_upload_bytes_total')
+        uploads = value('storage_operation_duration_seconds_count', operation='upload')
+        response = self._upload(40)
+        self.assertEqual(response.status_code, 201)
+        for stage in stages:
+            self.assertGreater(value('image_processing_stage_duration_seconds_count', stage=stage), before[stage], stage)
+        # オリジナル・表示用・サムネイル・srcset 用の縮小画像
+        self.assertEqual(
+            value('storage_operation_duration_seconds_count', operation='upload') - uploads,
+            3 + len(response.data['renditions']),
+        )
+        self.assertGreater(value('storage_upload_bytes_total'), uploaded)
+
+    @override_settings(IMAGE_PROCESSING_MODE='async', IMAGE_QUEUE_BACKEND='database')
+    def test_async_upload(self):
+        with self.assertWithinBudget(queries=5, ms=1000, storage_calls=1):
+            response = self._upload(30)
+        self.assertEqual(response.status_code, 202)
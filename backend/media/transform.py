@@ -0,0 +1,137 @@
+"""
+初めて要求されたときに作る縮小画像 (GET /api/image/<id>/<幅>x<高さ>.<形式>)
+
+- 大きさは IMAGE_TRANSFORM_SIZES の枠、形式は IMAGE_TRANSFORM_FORMATS に限る (任意の大きさで作らせない)
+- アスペクト比を保ったまま枠に収まるように縮小し (拡大はしない)、ImageRendition として保存する
+  幅と形式が同じなら同じ画像になるので、アップロード時に作った srcset 用の縮小画像もそのまま使う
+- 同じ縮小画像への同時のリクエストは、プロセス内では 1 つだけが作り、他はその結果を待つ
+  (別のプロセスと同時に作った場合は、ユニーク制約で先に保存された行を使う)
+"""
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from PIL import Image, ImageOps, features
+
+from app.instrumentation import timed
+from app.metrics import image_stage
+
+from .models import Image as ImageModel, ImageRendition
+from .pipeline import ORIENTATION_TAG, ImageTooLarge, decode_image, encode_image, new_spooled_buffer
+from .utils import get_minio_bucket_name, get_minio_client, upload_buffer
+
+# URL の拡張子の別名
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+# 幅と高さが入れ替わる EXIF の向き
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_transform_formats():
+    """ IMAGE_TRANSFORM_FORMATS のうち、この環境の Pillow でエンコードできる形式を返す """
+    return [fmt for fmt in settings.IMAGE_TRANSFORM_FORMATS if fmt == 'jpeg' or features.check(fmt)]
+
+
+def is_allowed(width, height, fmt):
+    return (width, height) in settings.IMAGE_TRANSFORM_SIZES and fmt in get_transform_formats()
+
+
+def fit_size(width, height, box_width, box_height):
+    """
+    アスペクト比を保ったまま (box_width, box_height) の枠に収まる大きさを返す (元より大きくはしない)
+    高さは srcset 用の縮小画像と同じく幅から計算するので、幅が同じなら同じ大きさになる
+    """
+    scale = min(box_width / width, box_height / height, 1)
+    target_width = max(1, round(width * scale))
+    return target_width, max(1, round(height * target_width / width))
+
+
+def find_rendition(image, box, fmt):
+    """ 作成済みの縮小画像を返す (オリジナル画像の大きさがまだ分からなければ None) """
+    if not image.width or not image.height:
+        return None
+    width, _ = fit_size(image.width, image.height, *box)
+    return ImageRendition.objects.filter(image=image, width=width, format=fmt).first()
+
+
+@image_stage('rendition')
+def generate_rendition(image, box, fmt):
+    """ オリジナル画像から縮小画像を作って保存し、ImageRendition を返す """
+    s3 = get_minio_client()
+    bucket = get_minio_bucket_name()
+    original = new_spooled_buffer()
+    with timed('storage'):
+        s3.download_fileobj(bucket, image.original_key, original)
+    original.seek(0)
+    img = Image.open(original)
+    if img.width * img.height > settings.IMAGE_MAX_PIXELS:
+        raise ImageTooLarge('%dx%d' % img.size)
+
+    orientation = img.getexif().get(ORIENTATION_TAG, 1)
+    size = img.size[::-1] if orientation in TRANSPOSED_ORIENTATIONS else img.size
+    if (image.width, image.height) != size:
+        # 画像の内容は変わらないので、post_save (Next.js への再検証の依頼) を送らずに更新する
+        ImageModel.objects.filter(pk=image.pk).update(width=size[0], height=size[1])
+        image.width, image.height = size
+        # 大きさが分かったので、同じ幅の縮小画像があればそれを使う
+        existing = find_rendition(image, box, fmt)
+        if existing is not None:
+            return existing
+
+    target = fit_size(*size, *box)
+    decode_image(img, max_long_side=max(target))
+    source = ImageOps.exif_transpose(img) if orientation != 1 else img
+    if source.mode not in ('RGB', 'L'):
+        source = source.convert('RGB')
+    if source.size != target:
+        with image_stage('resize'):
+            source = source.resize(target, reducing_gap=3.0)
+    encoded = encode_image(source, fmt.upper(), settings.IMAGE_FORMAT_QUALITY[fmt])
+
+    base_key = image.original_key.rsplit('.', 1)[0]
+    key = '%s_%dw%s' % (base_key, encoded.width, encoded.extension)
+    url = upload_buffer(s3, bucket, encoded.buffer, key, encoded.content_type)
+    try:
+        with transaction.atomic():
+            return ImageRendition.objects.create(
+                image=image, width=encoded.width, height=encoded.height, format=fmt,
+                url=url, key=key, bytes=encoded.byte_size,
+            )
+    except IntegrityError:
+        # 別のプロセスが同じ縮小画像を先に保存した (オブジェクトは同じキーに上書きされている)
+        return ImageRendition.objects.get(image=image, width=encoded.width, format=fmt)
+
+
+def get_rendition(image, box, fmt):
+    """
+    縮小画像を返す (なければ作る)
+    同じ縮小画像を作っているリクエストがあれば、新しく作らずにその結果を待つ
+    """
+    rendition = find_rendition(image, box, fmt)
+    if rendition is not None:
+        return rendition
+
+    flight = (image.pk, box, fmt)
+    with _inflight_lock:
+        future = _inflight.get(flight)
+        leader = future is None
+        if leader:
+            future = _inflight[flight] = Future()
+    if not leader:
+        return future.result(timeout=settings.IMAGE_TRANSFORM_WAIT_TIMEOUT)
+
+    try:
+        rendition = generate_rendition(image, box, fmt)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(rendition)
+        return rendition
+    finally:
+        with _inflight_lock:
+            del _inflight[flight]
@@ -0,0 +1,36 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadMixin:
+    """
+    アップロードされたファイルを受け取りながら SHA-256 を計算し、ファイルの content_hash 属性にセットする
+    ファイルを読み直さずに済むように、データを保存するハンドラ自身が受け取ったチャンクで計算する
+    """
+
+    def new_file(self, *args, **kwargs):
+        # MemoryFileUploadHandler は new_file の中で StopFutureHandlers を送出するので、先に準備しておく
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        passed = super().receive_data_chunk(raw_data, start)
+        # None が返ったときは、このハンドラがチャンクを保存している
+        if passed is None:
+            self.hasher.update(raw_data)
+        return passed
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.hasher.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
@@ -0,0 +1,218 @@
+"""
+ブラウザからオブジェクトストレージに画像を直接アップロードする仕組み (Django は画像のバイト列を中継しない)
+
+1. POST /api/image/uploads/ で UploadSession を作り、署名付き URL を返す
+   - IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD 以下なら PUT (既定) か、フォームから送る POST の URL
+   - それを超えるならマルチパートアップロードを開始して、パートごとの PUT の URL
+2. ブラウザがその URL に画像を送る
+3. POST /api/image/uploads/<token>/complete/ で、保存されたオブジェクトの大きさと形式を確かめてから
+   pending の Image を作り、縮小画像の作成をキューに積む (ワーカーは保存されたオブジェクトから縮小画像を作る)
+
+有効期限 (IMAGE_DIRECT_UPLOAD_EXPIRES) を過ぎたセッションは完了できない (410)
+完了しないまま期限が切れたセッションは、abort_expired_uploads コマンドで中止してオブジェクトを削除する
+"""
+import logging
+import math
+from datetime import timedelta
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from .models import Image as ImageModel, UploadSession
+from .pipeline import IMAGE_EXTENSIONS
+from .tasks import enqueue_image
+from .utils import get_minio_bucket_name, get_minio_bucket_url, get_minio_client, get_presign_client
+
+logger = logging.getLogger(__name__)
+
+# 形式を確かめるために読む、オブジェクトの先頭のバイト数
+SNIFF_BYTES = 64 * 1024
+
+
+class UploadRejected(Exception):
+    """ アップロードを受け付けられない (status はレスポンスの HTTP ステータス) """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _extension(content_type):
+    for img_format, extension in IMAGE_EXTENSIONS.items():
+        if Image.MIME.get(img_format) == content_type:
+            return extension
+    return ''
+
+
+def create_session(title, filename, content_type, size, method='put'):
+    """ UploadSession を作り、(セッション, ブラウザに渡すアップロードの方法) を返す """
+    session = UploadSession(
+        title=title,
+        filename=filename,
+        content_type=content_type,
+        size=size,
+        expires_at=timezone.now() + timedelta(seconds=settings.IMAGE_DIRECT_UPLOAD_EXPIRES),
+    )
+    session.key = 'uploads/%s%s' % (session.token.hex, _extension(content_type))
+    if size > settings.IMAGE_DIRECT_UPLOAD_MULTIPART_THRESHOLD:
+        # マルチパートアップロードの開始はストレージへの通信が必要なので、サーバー側のクライアントで行う
+        session.upload_id = get_minio_client().create_multipart_upload(
+            Bucket=get_minio_bucket_name(), Key=session.key, ContentType=content_type,
+        )['UploadId']
+        session.part_size = settings.MINIO_MULTIPART_CHUNKSIZE
+    session.save()
+    return session, upload_instructions(session, method)
+
+
+def upload_instructions(session, method='put'):
+    """ 署名付き URL と、ブラウザがそれに送るときの方法 """
+    client = get_presign_client()
+    bucket = get_minio_bucket_name()
+    expires_in = max(1, int((session.expires_at - timezone.now()).total_seconds()))
+    if session.is_multipart:
+        parts = math.ceil(session.size / session.part_size)
+        return {
+            'method': 'multipart',
+            'part_size': session.part_size,
+            'parts': [
+                {
+                    'part_number': number,
+                    'url': client.generate_presigned_url('upload_part', Params={
+                        'Bucket': bucket, 'Key': session.key,
+                        'UploadId': session.upload_id, 'PartNumber': number,
+                    }, ExpiresIn=expires_in),
+                }
+                for number in range(1, parts + 1)
+            ],
+        }
+    if method == 'post':
+        post = client.generate_presigned_post(
+            Bucket=bucket, Key=session.key,
+            Fields={'Content-Type': session.content_type},
+            Conditions=[
+                {'Content-Type': session.content_type},
+                ['content-length-range', session.size, session.size],
+            ],
+            ExpiresIn=expires_in,
+        )
+        return {'method': 'POST', 'url': post['url'], 'fields': post['fields']}
+    return {
+        'method': 'PUT',
+        'url': client.generate_presigned_url('put_object', Params={
+            'Bucket': bucket, 'Key': session.key, 'ContentType': session.content_type,
+        }, ExpiresIn=expires_in),
+        'headers': {'Content-Type': session.content_type},
+    }
+
+
+def _discard(s3, bucket, session, message):
+    # 受け付けられないオブジェクトは残さない
+    s3.delete_object(Bucket=bucket, Key=session.key)
+    return UploadRejected(400, message)
+
+
+def verify_object(session):
+    """ 保存されたオブジェクトが、宣言どおりの大きさの画像であることを確かめる """
+    s3 = get_minio_client()
+    bucket = get_minio_bucket_name()
+    try:
+        head = s3.head_object(Bucket=bucket, Key=session.key)
+    except ClientError:
+        raise UploadRejected(400, 'the object has not been uploaded')
+    if head['ContentLength'] != session.size:
+        raise _discard(s3, bucket, session, 'the uploaded size (%d) does not match the declared size (%d)' % (
+            head['ContentLength'], session.size,
+        ))
+    # 全体を読まずに、先頭だけで画像の形式を確かめる (デコードはワーカーで行う)
+    head_bytes = s3.get_object(Bucket=bucket, Key=session.key, Range='bytes=0-%d' % (SNIFF_BYTES - 1))['Body']
+    try:
+        img_format = Image.open(BytesIO(head_bytes.read())).format
+    except Exception:
+        img_format = None
+    if img_format not in IMAGE_EXTENSIONS:
+        raise _discard(s3, bucket, session, 'the uploaded object is not a supported image')
+
+
+def complete_session(session, parts=()):
+    """
+    アップロードを完了して pending の Image を作り、縮小画像の作成をキューに積む
+    完了済みのセッションなら、作成済みの Image をそのまま返す
+    """
+    if session.status == UploadSession.STATUS_COMPLETED:
+        return session.image
+    if session.status == UploadSession.STATUS_ABORTED:
+        raise UploadRejected(409, 'the upload session has been aborted')
+    if timezone.now() > session.expires_at:
+        # 期限切れのセッションは abort_expired_sessions で中止して、オブジェクトを削除する
+        raise UploadRejected(410, 'the upload session has expired')
+
+    if session.is_multipart:
+        try:
+            get_minio_client().complete_multipart_upload(
+                Bucket=get_minio_bucket_name(), Key=session.key, UploadId=session.upload_id,
+                MultipartUpload={'Parts': [
+                    {'PartNumber': part['part_number'], 'ETag': part['etag']} for part in parts
+                ]},
+            )
+        except ClientError as e:
+            raise UploadRejected(400, 'failed to complete the multipart upload: %s' % e)
+    verify_object(session)
+
+    with transaction.atomic():
+        # 同じセッションの完了が同時に届いても、Image は 1 つだけ作る
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.status == UploadSession.STATUS_COMPLETED:
+            return session.image
+        if session.status == UploadSession.STATUS_ABORTED:
+            raise UploadRejected(409, 'the upload session has been aborted')
+        image = ImageModel.objects.create(
+            title=session.title,
+            original_url=get_minio_bucket_url() + session.key,
+            original_key=session.key,
+            status=ImageModel.STATUS_PENDING,
+        )
+        session.image = image
+        session.status = UploadSession.STATUS_COMPLETED
+        session.save(update_fields=['image', 'status'])
+        enqueue_image(image.id)
+    return image
+
+
+def abort_session(session):
+    """ アップロードを中止して、途中まで送られたパートやオブジェクトを削除する """
+    if session.status != UploadSession.STATUS_PENDING:
+        raise UploadRejected(409, 'the upload session is already %s' % session.status)
+    s3 = get_minio_client()
+    bucket = get_minio_bucket_name()
+    if session.is_multipart:
+        try:
+            s3.abort_multipart_upload(Bucket=bucket, Key=session.key, UploadId=session.upload_id)
+        except ClientError:
+            pass
+    s3.delete_object(Bucket=bucket, Key=session.key)
+    session.status = UploadSession.STATUS_ABORTED
+    session.save(update_fields=['status'])
+
+
+def abort_expired_sessions(now=None):
+    """
+    有効期限が切れても完了しなかったセッションを中止して、途中まで送られたパートやオブジェクトを削除する
+    中止したセッションの数を返す (ストレージの操作に失敗したセッションは、次の実行で再び対象になる)
+    """
+    now = now or timezone.now()
+    expired = UploadSession.objects.filter(
+        status=UploadSession.STATUS_PENDING, expires_at__lt=now,
+    ).order_by('pk')
+    aborted = 0
+    for session in expired.iterator():
+        try:
+            abort_session(session)
+        except ClientError:
+            logger.exception('failed to abort the upload session: token=%s', session.token)
+            continue
+        aborted += 1
+    return aborted
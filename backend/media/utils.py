@@ -1,40 +1,320 @@
+import hashlib
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from django.conf import settings
 from PIL import Image
 
+from app.instrumentation import record, timed
+from app.metrics import observe_storage
 
-def keep_aspect_image_resize(img_file, long_side):
-    img = Image.open(img_file)
-    if img.height < img.width:
+
+def keep_aspect_size(width, height, long_side):
+    """ アスペクト比を保ったまま、長辺が long_side になるサイズを計算する """
+    if height < width:
         resize_w = long_side
-        resize_h = round(img.height * resize_w / img.width)
+        resize_h = max(1, round(height * resize_w / width))
     else:
         resize_h = long_side
-        resize_w = round(img.width * resize_h / img.height)
-    return img.resize((resize_w, resize_h))
+        resize_w = max(1, round(width * resize_h / height))
+    return resize_w, resize_h
+
+
+def keep_aspect_image_resize(img_file, long_side):
+    # デコード済みの画像が渡された場合は、ファイルを開き直さずにそのまま使う
+    img = img_file if isinstance(img_file, Image.Image) else Image.open(img_file)
+    return img.resize(keep_aspect_size(img.width, img.height, long_side))
+
+
+def get_content_hash(fileobj):
+    """
+    ファイルの内容の SHA-256 を返す
+    アップロードハンドラで計算済みのときはその値を使い、なければチャンクごとに読んで計算する
+    """
+    content_hash = getattr(fileobj, 'content_hash', None)
+    if content_hash:
+        return content_hash
+    seekable = getattr(fileobj, 'seekable', lambda: False)()
+    hasher = hashlib.sha256()
+    if seekable:
+        fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        hasher.update(chunk)
+    if seekable:
+        fileobj.seek(0)
+    return hasher.hexdigest()
 
 
 def get_minio_bucket_name():
-    return os.getenv('MINIO_BUCKET_NAME')
+    return os.getenv('MINIO_BUCKET_NAME', 'blog-bucket')
 
 
 def get_minio_bucket_url():
+    if settings.OBJECT_STORAGE_BACKEND == 'local':
+        return f"{settings.LOCAL_OBJECT_STORAGE_URL}{get_minio_bucket_name()}/"
     endpoint = os.getenv('MINIO_ENDPOINT')
-    bucket = os.getenv('MINIO_BUCKET_NAME')
+    bucket = get_minio_bucket_name()
     use_ssl = os.getenv('MINIO_USE_SSL', 'False').lower() == 'true'
     return f"http{'s' if use_ssl else ''}://{endpoint}/{bucket}/"
 
 
-def get_minio_client():
+class StorageStats:
+    """ オブジェクトストレージへのアップロードの統計 (プロセス単位) """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.clients_created = 0
+            self.uploads = 0
+            self.upload_bytes = 0
+            self.upload_seconds = 0.0
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+    def client_created(self):
+        with self._lock:
+            self.clients_created += 1
+
+    def upload_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def upload_finished(self, size, seconds):
+        with self._lock:
+            self.in_flight -= 1
+            self.uploads += 1
+            self.upload_bytes += size
+            self.upload_seconds += seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'clients_created': self.clients_created,
+                'uploads': self.uploads,
+                'upload_bytes': self.upload_bytes,
+                'upload_seconds': round(self.upload_seconds, 6),
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+            }
+
+
+storage_stats = StorageStats()
+
+_client = None
+_presign_client = None
+_client_lock = threading.Lock()
+_upload_executor = None
+
+
+def _create_minio_client():
     endpoint = os.getenv('MINIO_ENDPOINT')
     access_key = os.getenv('MINIO_ACCESS_KEY')
     secret_key = os.getenv('MINIO_SECRET_KEY')
     use_ssl = os.getenv('MINIO_USE_SSL', 'False').lower() == 'true'
 
-    return boto3.client(
+    client = boto3.client(
         's3',
         endpoint_url=f"http{'s' if use_ssl else ''}://{endpoint}",
         aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
\ No newline at end of file
+        aws_secret_access_key=secret_key,
+        config=Config(
+            max_pool_connections=settings.MINIO_MAX_POOL_CONNECTIONS,
+            connect_timeout=settings.MINIO_CONNECT_TIMEOUT,
+            read_timeout=settings.MINIO_READ_TIMEOUT,
+            retries={'max_attempts': 3, 'mode': 'standard'},
+            tcp_keepalive=True,
+        ),
+    )
+    # リクエストの処理時間の内訳に、ストレージの API の呼び出しにかかった時間を入れる
+    client.meta.events.register('before-call.s3', _before_storage_call)
+    client.meta.events.register('after-call.s3', _after_storage_call)
+    storage_stats.client_created()
+    return client
+
+
+def _before_storage_call(context, **kwargs):
+    context['storage_started'] = time.perf_counter()
+
+
+def _after_storage_call(context, model, **kwargs):
+    started = context.pop('storage_started', None)
+    if started is not None:
+        seconds = time.perf_counter() - started
+        record('storage', seconds)
+        observe_storage(model.name, seconds)
+
+
+def get_minio_client():
+    """
+    プロセス内で共有する S3 (MinIO) クライアントを返す
+    boto3 のクライアントはスレッドセーフなので、1 つ作って使い回し、コネクションプールを再利用する
+    """
+    # 開発・テスト用に、MinIO の代わりにプロセス内のメモリを使うこともできる
+    if settings.OBJECT_STORAGE_BACKEND == 'local':
+        from .local_storage import local_storage
+        return local_storage
+
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_minio_client()
+    return _client
+
+
+def get_presign_client():
+    """
+    ブラウザに渡す署名付き URL を作るための S3 クライアントを返す
+    署名にはホスト名が含まれるので、ブラウザから見た MinIO の接続先 (MINIO_PUBLIC_ENDPOINT) で作る
+    """
+    if settings.OBJECT_STORAGE_BACKEND == 'local':
+        from .local_storage import local_storage
+        return local_storage
+
+    global _presign_client
+    if _presign_client is None:
+        with _client_lock:
+            if _presign_client is None:
+                endpoint = os.getenv('MINIO_PUBLIC_ENDPOINT') or os.getenv('MINIO_ENDPOINT')
+                use_ssl = os.getenv('MINIO_USE_SSL', 'False').lower() == 'true'
+                # 署名を作るだけで通信はしないので、コネクションプールの設定は不要
+                _presign_client = boto3.client(
+                    's3',
+                    endpoint_url=f"http{'s' if use_ssl else ''}://{endpoint}",
+                    aws_access_key_id=os.getenv('MINIO_ACCESS_KEY'),
+                    aws_secret_access_key=os.getenv('MINIO_SECRET_KEY'),
+                    config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}),
+                )
+    return _presign_client
+
+
+def reset_minio_client():
+    """ 共有しているクライアントを破棄する (接続先の環境変数を変えたときなどに使う) """
+    global _client, _presign_client
+    with _client_lock:
+        _client = None
+        _presign_client = None
+
+
+def get_transfer_config():
+    """ 画像のサイズに合わせたアップロードの設定 (大きなファイルだけをマルチパートで並列に送る) """
+    return TransferConfig(
+        multipart_threshold=settings.MINIO_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.MINIO_MULTIPART_CHUNKSIZE,
+        max_concurrency=settings.MINIO_MULTIPART_CONCURRENCY,
+        use_threads=True,
+    )
+
+
+def get_pool_stats():
+    """ アップロードの統計と、S3 クライアントのコネクションプールの状態を返す """
+    stats = storage_stats.as_dict()
+    stats['max_pool_connections'] = settings.MINIO_MAX_POOL_CONNECTIONS
+    pools = []
+    if _client is not None:
+        # botocore は公開 API でプールの状態を出していないので、取れる場合だけ取る
+        try:
+            manager = _client._endpoint.http_session._manager
+            for key in manager.pools.keys():
+                pool = manager.pools[key]
+                pools.append({
+                    'host': pool.host,
+                    'num_connections': pool.num_connections,
+                    'num_requests': pool.num_requests,
+                    'idle_connections': pool.pool.qsize() if pool.pool else 0,
+                })
+        except AttributeError:
+            pass
+    stats['pools'] = pools
+    return stats
+
+
+def upload_buffer(s3, bucket, buffer, key, content_type):
+    """ バッファの内容をオブジェクトストレージに保存して、アクセス用の URL を返す """
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(0)
+    storage_stats.upload_started()
+    started = time.perf_counter()
+    try:
+        with timed('storage'):
+            s3.upload_fileobj(
+                buffer, bucket, key,
+                ExtraArgs={'ContentType': content_type},
+                Config=get_transfer_config(),
+            )
+    finally:
+        seconds = time.perf_counter() - started
+        storage_stats.upload_finished(size, seconds)
+        observe_storage('upload', seconds, size)
+    return get_minio_bucket_url() + key
+
+
+def _get_upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        with _client_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=settings.MINIO_UPLOAD_CONCURRENCY,
+                    thread_name_prefix='minio-upload',
+                )
+    return _upload_executor
+
+
+def upload_many(s3, bucket, items):
+    """
+    複数のバッファを並列にアップロードして、名前ごとの URL を返す
+    items は {名前: (バッファ, オブジェクトキー, Content-Type)} の辞書
+    1 つでも失敗したら、その例外をそのまま送出する
+    """
+    executor = _get_upload_executor()
+    # 並列に送るので、リクエストの処理時間の内訳には全体を待った時間を入れる
+    with timed('storage'):
+        futures = {
+            name: executor.submit(upload_buffer, s3, bucket, buffer, key, content_type)
+            for name, (buffer, key, content_type) in items.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def get_original_key(image):
+    """ オリジナル画像のオブジェクトキー (キーを保存する前にアップロードされた画像は、URL の末尾から求める) """
+    return image.original_key or image.original_url.rsplit('/', 1)[-1]
+
+
+def backfill_content_hashes(image_model, batch_size=100):
+    """
+    content_hash が空の Image について、保存済みのオリジナル画像からハッシュ値を計算して埋める
+    マイグレーションからも呼ぶので、モデルクラスは引数で受け取る
+    ストレージから取得できなかった画像は空のまま残し、処理できた件数を返す
+    """
+    s3 = get_minio_client()
+    bucket = get_minio_bucket_name()
+    updated = 0
+    last_id = 0
+    while True:
+        images = list(
+            image_model.objects.filter(content_hash='', id__gt=last_id).order_by('id')[:batch_size]
+        )
+        if not images:
+            return updated
+        for image in images:
+            last_id = image.id
+            key = get_original_key(image)
+            try:
+                body = s3.get_object(Bucket=bucket, Key=key)['Body']
+                image.content_hash = get_content_hash(body)
+            except Exception:
+                continue
+            image.save(update_fields=['content_hash'])
+            updated += 1
@@ -1,82 +1,357 @@
-import uuid
-from PIL import Image
-from io import BytesIO
+import time
 
+from django.conf import settings
+from django.db import transaction
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.urls import reverse
+from PIL import Image
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from .models import Image as ImageModel
-from .serializers import ImageSerializer
-from .utils import get_minio_client, get_minio_bucket_url, get_minio_bucket_name, keep_aspect_image_resize
+from .batch import upload_batch
+from .models import Image as ImageModel, ImageRendition, UploadSession
+from .pipeline import IMAGE_EXTENSIONS, ImageTooLarge, process_image
+from .serializers import (
+    ImageSerializer,
+    ImageTitleSerializer,
+    UploadSessionCompleteSerializer,
+    UploadSessionCreateSerializer,
+)
+from .tasks import enqueue_image, rendition_uploads, save_renditions
+from .transform import FORMAT_ALIASES, get_rendition, is_allowed
+from .uploads import UploadRejected, abort_session, complete_session, create_session
+from .utils import (
+    get_content_hash,
+    get_minio_bucket_name,
+    get_minio_client,
+    get_original_key,
+    upload_buffer,
+    upload_many,
+)
 
 
 class ImageUploadView(APIView):
     def post(self, request):
-        # リクエストから画像のタイトルとファイルを取り出す
-        title = request.data.get('title')
+        # リクエストから画像のタイトルとファイルを取り出す (タイトルはまとめてアップロードと同じ規則で検証する)
+        serializer = ImageTitleSerializer(data=request.data)
         img_file = request.FILES.get('image')
-        if (not title) or (not img_file):
+        if not serializer.is_valid() or not img_file:
             return Response(
-                {'error': 'title and image file are required'},
+                {'error': 'title and image file are required', **serializer.errors},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        title = serializer.validated_data['title']
+        if img_file.size > settings.IMAGE_UPLOAD_MAX_BYTES:
+            return Response(
+                {'error': 'image file is too large'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        # 同じ内容の画像がアップロード済みなら、デコードも保存もせずに既存の画像の URL を返す
+        content_hash = get_content_hash(img_file)
+        duplicate = self.create_duplicate(title, content_hash)
+        if duplicate is not None:
+            return duplicate
+
+        # 非同期モードではオリジナル画像だけを保存して、縮小画像の作成はキューに任せる
+        if settings.IMAGE_PROCESSING_MODE == 'async':
+            return self.accept(title, img_file, content_hash)
         
-        # 画像を読み込んでリサイズし、バッファに書き出す
+        # 画像を 1 回だけデコードして、設定されたサイズの表示用画像とサムネイル画像を作成する
         try:
-            # オリジナルの画像
-            original_img = Image.open(img_file)
-            original_img_buffer = BytesIO()
-            original_img.save(original_img_buffer, format='JPEG')
-            original_img_buffer.seek(0)
-
-            # 長辺 1000 ピクセルの表示用画像を作成
-            display_img = keep_aspect_image_resize(img_file, 1000)
-            display_img_buffer = BytesIO()
-            display_img.save(display_img_buffer, format='JPEG')
-            display_img_buffer.seek(0)
-
-            # 長辺 300 ピクセルのサムネイル画像を作成
-            thumbnail_img = keep_aspect_image_resize(img_file, 300)
-            thumbnail_img_buffer = BytesIO()
-            thumbnail_img.save(thumbnail_img_buffer, format='JPEG')
-            thumbnail_img_buffer.seek(0)
+            processed = process_image(img_file)
+        except ImageTooLarge as e:
+            return Response(
+                {'error': 'image is too large: ' + str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
         except Exception as e:
             return Response(
                 {'error': 'image processing failed: ' + str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
-        # UUID で名前を決定
-        original_img_filename = str(uuid.uuid4()) + ".jpg"
-        display_img_filename = str(uuid.uuid4()) + ".jpg"
-        thumbnail_img_filename = str(uuid.uuid4()) + ".jpg"
+        # 画像の内容のハッシュ値で名前を決定
+        original_img_filename = content_hash + processed.original.extension
+        uploads = rendition_uploads(content_hash, processed)
+        uploads['original'] = (
+            processed.original.buffer, original_img_filename, processed.original.content_type
+        )
 
-        # MinIO のクライアントを取得してそれぞれの画像を保存
+        # 共有の MinIO クライアントでそれぞれの画像 (srcset 用の縮小画像を含む) を並列に保存
         s3 = get_minio_client()
         bucket = get_minio_bucket_name()
-        print(bucket, original_img_filename)
         try:
-            s3.upload_fileobj(original_img_buffer, bucket, original_img_filename, ExtraArgs={'ContentType': 'image/jpeg'})
-            s3.upload_fileobj(display_img_buffer, bucket, display_img_filename, ExtraArgs={'ContentType': 'image/jpeg'})
-            s3.upload_fileobj(thumbnail_img_buffer, bucket, thumbnail_img_filename, ExtraArgs={'ContentType': 'image/jpeg'})
+            urls = upload_many(s3, bucket, uploads)
         except Exception as e:
             return Response(
                 {'error': 'MinIO upload failed: ' + str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
-        # アクセス URL の構築
-        original_url = get_minio_bucket_url() + original_img_filename
-        display_url = get_minio_bucket_url() + display_img_filename
-        thumbnail_url = get_minio_bucket_url() + thumbnail_img_filename
+        # アクセス URL
+        original_url = urls['original']
+        display_url = urls['display']
+        thumbnail_url = urls['thumbnail']
 
         # モデルに保存
-        uploaded_image = ImageModel.objects.create(
-            title=title,
-            thumbnail_url=thumbnail_url,
-            display_url=display_url,
-            original_url=original_url
-        )
+        with transaction.atomic():
+            uploaded_image = ImageModel.objects.create(
+                title=title,
+                thumbnail_url=thumbnail_url,
+                display_url=display_url,
+                original_url=original_url,
+                original_key=original_img_filename,
+                content_hash=content_hash,
+            )
+            save_renditions(uploaded_image, content_hash, processed, urls)
+        serializer = ImageSerializer(uploaded_image)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def create_duplicate(self, title, content_hash):
+        """ 同じハッシュ値の処理済み画像があれば、その URL を使って Image を作成したレスポンスを返す """
+        existing = ImageModel.objects.filter(
+            content_hash=content_hash, status=ImageModel.STATUS_READY
+        ).order_by('id').first()
+        if existing is None:
+            return None
+        with transaction.atomic():
+            uploaded_image = ImageModel.objects.create(
+                title=title,
+                thumbnail_url=existing.thumbnail_url,
+                display_url=existing.display_url,
+                original_url=existing.original_url,
+                original_key=existing.original_key,
+                content_hash=content_hash,
+            )
+            # srcset 用の縮小画像も同じオブジェクトを指す行を作る
+            ImageRendition.objects.bulk_create([
+                ImageRendition(
+                    image=uploaded_image, width=r.width, height=r.height,
+                    format=r.format, url=r.url, key=r.key, bytes=r.bytes,
+                )
+                for r in existing.renditions.all()
+            ])
+        serializer = ImageSerializer(uploaded_image)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def accept(self, title, img_file, content_hash):
+        """ オリジナル画像を保存して pending の Image を作成し、202 を返す """
+        # ヘッダだけを読んで画像の形式を確認する (デコードはワーカーで行う)
+        try:
+            img_format = Image.open(img_file).format
+        except Exception as e:
+            return Response(
+                {'error': 'invalid image file: ' + str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        img_file.seek(0)
+
+        original_img_filename = content_hash + IMAGE_EXTENSIONS.get(img_format, '')
+        s3 = get_minio_client()
+        bucket = get_minio_bucket_name()
+        try:
+            original_url = upload_buffer(
+                s3, bucket, img_file, original_img_filename,
+                Image.MIME.get(img_format, 'application/octet-stream')
+            )
+        except Exception as e:
+            return Response(
+                {'error': 'MinIO upload failed: ' + str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        with transaction.atomic():
+            uploaded_image = ImageModel.objects.create(
+                title=title,
+                original_url=original_url,
+                original_key=original_img_filename,
+                content_hash=content_hash,
+                status=ImageModel.STATUS_PENDING,
+            )
+            enqueue_image(uploaded_image.id)
+
         serializer = ImageSerializer(uploaded_image)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
\ No newline at end of file
+        return Response(
+            serializer.data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('image_detail', args=[uploaded_image.id])},
+        )
+
+
+class ImageBatchUploadView(APIView):
+    """
+    複数の画像をまとめてアップロードする
+    multipart の image にファイルを複数、title にファイルごとのタイトル (1 つなら全ファイル共通) を指定する
+    タイトルは 1 枚ずつのアップロードと同じく必須で、空や長すぎるタイトルのファイルは 400 になる
+    全て成功すれば 201 (async モードでは 202)、1 つでも失敗すれば 207 でファイルごとの結果を返す
+    """
+
+    def post(self, request):
+        files = request.FILES.getlist('image')
+        titles = request.data.getlist('title')
+        if not files:
+            return Response({'error': 'image files are required'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(files) > settings.IMAGE_BATCH_MAX_FILES:
+            return Response(
+                {'error': 'too many files (max %d)' % settings.IMAGE_BATCH_MAX_FILES},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(titles) not in (1, len(files)):
+            return Response(
+                {'error': 'give one title, or one title per image file'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        items = upload_batch(files, titles)
+        # 作成した画像を縮小画像と合わせて 2 クエリで読み直す
+        images = ImageModel.objects.prefetch_related('renditions').in_bulk(
+            [item.image.pk for item in items if item.image is not None]
+        )
+        results = [
+            item.as_dict(ImageSerializer(images[item.image.pk]).data if item.image else None)
+            for item in items
+        ]
+        statuses = {item.status for item in items}
+        if len(statuses) == 1 and not items[0].error:
+            response_status = statuses.pop()
+        else:
+            response_status = status.HTTP_207_MULTI_STATUS
+        return Response({'results': results}, status=response_status)
+
+
+class UploadSessionView(APIView):
+    """
+    ブラウザからオブジェクトストレージに直接アップロードするための、署名付き URL を発行する
+    画像のバイト列は Django を通らず、完了したら complete_url に POST してもらう
+    """
+
+    def post(self, request):
+        serializer = UploadSessionCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if data['size'] > settings.IMAGE_UPLOAD_MAX_BYTES:
+            return Response(
+                {'error': 'image file is too large'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        try:
+            session, upload = create_session(
+                data['title'], data['filename'], data['content_type'], data['size'], data['method']
+            )
+        except Exception as e:
+            return Response(
+                {'error': 'MinIO request failed: ' + str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        return Response({
+            'token': session.token,
+            'key': session.key,
+            'expires_at': session.expires_at,
+            'upload': upload,
+            'complete_url': reverse('upload_session_complete', args=[session.token]),
+        }, status=status.HTTP_201_CREATED)
+
+
+class UploadSessionDetailView(APIView):
+    def delete(self, request, token):
+        """ アップロードを中止する """
+        session = get_object_or_404(UploadSession, token=token)
+        try:
+            abort_session(session)
+        except UploadRejected as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionCompleteView(APIView):
+    def post(self, request, token):
+        """
+        アップロードの完了を受け付けて pending の Image を作り、202 を返す
+        マルチパートのときは parts に各パートの part_number と、PUT のレスポンスの ETag を指定する
+        """
+        session = get_object_or_404(UploadSession, token=token)
+        parts = ()
+        if session.is_multipart:
+            # パート番号はそのまま boto3 に渡すので、整数であることと範囲をここで確かめる
+            serializer = UploadSessionCompleteSerializer(data=request.data)
+            if not serializer.is_valid():
+                return Response(
+                    {'error': 'parts must be a list of {part_number, etag}', 'parts': serializer.errors.get('parts')},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            parts = serializer.validated_data['parts']
+        try:
+            image = complete_session(session, parts)
+        except UploadRejected as e:
+            return Response({'error': str(e)}, status=e.status)
+        serializer = ImageSerializer(image)
+        return Response(
+            serializer.data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('image_detail', args=[image.id])},
+        )
+
+
+class ImageDetailView(APIView):
+    """ アップロードした画像の処理状況と URL を返す """
+    # ?wait= で待てる最大秒数
+    max_wait = 30
+
+    def get(self, request, pk):
+        image = get_object_or_404(ImageModel, pk=pk)
+        # ?wait=<秒> を指定すると、縮小画像ができるまで (または指定時間が経つまで) 待ってから返す
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), self.max_wait)
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        while image.status in (ImageModel.STATUS_PENDING, ImageModel.STATUS_PROCESSING) \
+                and time.monotonic() < deadline:
+            time.sleep(0.2)
+            image.refresh_from_db()
+
+        serializer = ImageSerializer(image)
+        return Response(serializer.data)
+
+
+class ImageRenditionView(APIView):
+    """
+    枠に収まるように縮小した画像にリダイレクトする (GET /api/image/<id>/<幅>x<高さ>.<形式>)
+    初めて要求された大きさと形式なら、オリジナル画像から作って保存する
+    """
+
+    def get(self, request, pk, width, height, fmt):
+        fmt = FORMAT_ALIASES.get(fmt.lower(), fmt.lower())
+        if not is_allowed(width, height, fmt):
+            return Response(
+                {'error': 'unsupported rendition: %dx%d.%s' % (width, height, fmt)},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        image = get_object_or_404(ImageModel, pk=pk)
+        # original_key を保存する前の画像は、オリジナル画像の URL からキーを求める
+        image.original_key = get_original_key(image)
+        if not image.original_key:
+            return Response(
+                {'error': 'the original image is not stored'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        try:
+            rendition = get_rendition(image, (width, height), fmt)
+        except TimeoutError:
+            return Response(
+                {'error': 'the rendition is still being generated'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '1'},
+            )
+        except Exception as e:
+            return Response(
+                {'error': 'image processing failed: ' + str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        response = Response(status=status.HTTP_302_FOUND, headers={'Location': rendition.url})
+        # 保存した縮小画像のキーは変わらないので、リダイレクトもキャッシュしてよい
+        patch_cache_control(response, public=True, max_age=settings.IMAGE_TRANSFORM_REDIRECT_MAX_AGE)
+        return response
@@ -0,0 +1,45 @@
+import { timingSafeEqual } from "node:crypto";
+import { revalidatePath, revalidateTag } from "next/cache";
+import { NextRequest, NextResponse } from "next/server";
+
+// Django (backend/app/revalidation.py) から、記事や画像が変わったときに呼ばれる Webhook
+// 受け取ったパスとタグのページだけを作り直す
+// 記事のデータを fetch するときは { next: { tags: ["articles", `article:${id}`] } } のようにタグを付けておく
+
+type RevalidationRequest = {
+  paths?: string[];
+  tags?: string[];
+};
+
+const SECRET_HEADER = "x-revalidate-secret";
+
+function isAuthorized(request: NextRequest): boolean {
+  const expected = process.env.REVALIDATION_WEBHOOK_SECRET;
+  const actual = request.headers.get(SECRET_HEADER);
+  if (!expected || !actual) {
+    return false;
+  }
+  const a = Buffer.from(actual);
+  const b = Buffer.from(expected);
+  return a.length === b.length && timingSafeEqual(a, b);
+}
+
+export async function POST(request: NextRequest) {
+  if (!isAuthorized(request)) {
+    return NextResponse.json({ error: "invalid secret" }, { status: 401 });
+  }
+
+  let body: RevalidationRequest;
+  try {
+    body = await request.json();
+  } catch {
+    return NextResponse.json({ error: "invalid JSON" }, { status: 400 });
+  }
+
+  const paths = (body.paths ?? []).filter((path) => typeof path === "string" && path.startsWith("/"));
+  const tags = (body.tags ?? []).filter((tag) => typeof tag === "string" && tag.length > 0);
+  paths.forEach((path) => revalidatePath(path));
+  tags.forEach((tag) => revalidateTag(tag));
+
+  return NextResponse.json({ revalidated: true, paths, tags, now: Date.now() });
+}